@@ -0,0 +1,190 @@
+""" This file implements a write-behind buffer for `$set` updates to MongoDB.
+Updates are merged per document in memory, values that haven't changed are
+dropped, and the remaining changes are written by a background thread with a
+single `bulk_write`, so that the caller never waits on the database.
+"""
+import copy
+import time
+import logging
+import threading
+import pymongo
+from typing import Dict, Tuple
+
+
+class WriteBuffer(object):
+    """ This class buffers `$set` updates to the documents of a collection.
+
+    Each document is identified by a query (i.e. {'name': 'Sirius'}). The
+    fields set for each document are merged until the next flush, which happens
+    every `interval` seconds, or immediately when `set` is called with `flush=True`
+    (i.e. at important state transitions). Fields are given in the same
+    (possibly dotted) form as `$set`.
+    """
+
+    def __init__(self, collection: pymongo.collection.Collection, interval: float = 0.5,
+                 ttl: float = 60., log: logging.Logger = None):
+        """ Create a new buffer, and start the thread that flushes it.
+
+        Parameters
+        ----------
+        collection: pymongo.collection.Collection
+            The collection to write to
+        interval: float
+            The time (in seconds) between flushes
+        ttl: float
+            The time (in seconds) for which a written value is assumed to still be in the
+            database; values equal to it are dropped. This bounds how long a change
+            made by another writer can hide an update.
+        log: logging.Logger
+            The logger to use
+        """
+        self.collection = collection
+        self.interval = interval
+        self.ttl = ttl
+        self.log = log or logging.getLogger('database')
+
+        # the fields waiting to be written to each document
+        self.pending: Dict[Tuple, Dict] = {}
+
+        # the last (value, time) written to each field of each document
+        self.written: Dict[Tuple, Dict[str, Tuple]] = {}
+
+        # the number of updates received, and the number actually written
+        self.received = 0
+        self.writes = 0
+
+        # the flushing thread
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='write-buffer', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def key(query: Dict) -> Tuple:
+        """ Return a hashable key for the document given by `query`.
+        """
+        return tuple(sorted(query.items()))
+
+    @staticmethod
+    def related(first: str, second: str) -> bool:
+        """ Check whether two dotted fields are the same, or one contains the other.
+        """
+        return first == second or first.startswith(second + '.') or second.startswith(first + '.')
+
+    @staticmethod
+    def merge(document: Dict, field: str, value) -> Dict:
+        """ Return a copy of `document` with the dotted `field` set to `value`.
+        """
+        document = copy.deepcopy(document)
+        *parents, last = field.split('.')
+        inner = document
+        for parent in parents:
+            if not isinstance(inner.get(parent), dict):
+                inner[parent] = {}
+            inner = inner[parent]
+        inner[last] = value
+
+        return document
+
+    def set(self, query: Dict, values: Dict, flush: bool = False) -> bool:
+        """ Buffer a `$set` of `values` on the document given by `query`.
+
+        This never blocks on the database.
+
+        Parameters
+        ----------
+        query: Dict
+            The query that selects the document to update
+        values: Dict
+            The (possibly dotted) fields to set, and their values
+        flush: bool
+            If True, write the buffer as soon as possible
+        """
+        now = time.time()
+        key = self.key(query)
+        with self.lock:
+            self.received += 1
+            pending = self.pending.setdefault(key, {})
+            written = self.written.setdefault(key, {})
+
+            for field, value in values.items():
+
+                # skip values that are already in the database
+                if field in written and not any(self.related(other, field) for other in pending):
+                    old, when = written[field]
+                    if old == value and now - when < self.ttl:
+                        continue
+
+                # a field can't be set along with one that contains it, so we
+                # merge it into a pending parent, or replace any pending children
+                parent = next((other for other in pending if field.startswith(other + '.')), None)
+                if parent is not None and isinstance(pending[parent], dict):
+                    pending[parent] = self.merge(pending[parent], field[len(parent)+1:], value)
+                    continue
+                for other in [other for other in pending if self.related(other, field)]:
+                    del pending[other]
+                pending[field] = value
+
+            if not pending:
+                del self.pending[key]
+
+        if flush:
+            self.wakeup.set()
+
+        return True
+
+    def flush(self) -> int:
+        """ Write every buffered update with a single bulk write.
+
+        Returns the number of documents that were updated.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return 0
+
+        try:
+            self.collection.bulk_write([pymongo.UpdateOne(dict(key), {'$set': values})
+                                        for key, values in pending.items()], ordered=False)
+        except Exception as e:
+            self.log.warning(f'Unable to write buffered updates: {e}')
+
+            # put back any fields that haven't been updated since
+            with self.lock:
+                for key, values in pending.items():
+                    newer = self.pending.setdefault(key, {})
+                    for field, value in values.items():
+                        if not any(self.related(other, field) for other in newer):
+                            newer[field] = value
+            return 0
+
+        # remember what we wrote
+        now = time.time()
+        with self.lock:
+            self.writes += 1
+            for key, values in pending.items():
+                written = self.written.setdefault(key, {})
+                for field, value in values.items():
+                    for other in [other for other in written if self.related(other, field)]:
+                        del written[other]
+                    written[field] = (value, now)
+
+        return len(pending)
+
+    def run(self) -> None:
+        """ Flush the buffer every `interval` seconds, or whenever we are woken up.
+        """
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self) -> None:
+        """ Stop the flushing thread and write anything that is left.
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
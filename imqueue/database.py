@@ -5,6 +5,11 @@ import colorlog
 from config import config
 from telescope.exception import *
 
+# the fields of an observation that are used by the schedulers and executor
+OBSERVATION_FIELDS = {field: 1 for field in ['target', 'RA', 'Dec', 'email', 'program', 'completed',
+                                             'exposure_time', 'exposure_count', 'binning', 'filters',
+                                             'options', 'totalTime', 'execDate']}
+
 class Database(object):
     """ Manages connection to MongoDB and provides a number of utility
     functions for accessing/finding/querying the database.
@@ -36,11 +41,30 @@ class Database(object):
         self.log.critical(errmsg)
         raise ConnectionException(errmsg)
 
+    # the index required by each collection; this is (collection, keys)
+    indexes = [('observations', [('program', pymongo.ASCENDING), ('completed', pymongo.ASCENDING)]),
+               ('sessions', [('end', pymongo.ASCENDING), ('start', pymongo.ASCENDING)]),
+               ('users', [('emails.address', pymongo.ASCENDING)]),
+               ('telescopes', [('name', pymongo.ASCENDING)]),
+               # the executor looks up the program of a session on every pass of its queue
+               ('programs', [('sessions', pymongo.ASCENDING)])]
+
+    # the queries that are run repeatedly; none of these may scan a whole collection
+    hot_queries = [('observations', {'program': {'$in': [None]}, 'completed': False}),
+                   ('sessions', {'end': {'$gte': 0, '$lt': 0}, 'start': {'$gt': 0}}),
+                   ('users', {'emails.address': ''}),
+                   ('telescopes', {'name': ''}),
+                   ('programs', {'sessions': None})]
+
+    # whether we have already created and checked the indexes
+    has_indexes = False
+
     # default logger
     log = None
 
     def __init__(self):
-        """ Right now, this just attempts to initialize the logging system
+        """ Initialize the logging system, check the connection to the database,
+        and create any missing indexes.
         """
         # initialize logging system
         if not Database.log:
@@ -57,6 +81,68 @@ class Database(object):
             self.log.critical(errmsg)
             raise ConnectionException(errmsg)
 
+        # make sure that the hot queries are indexed
+        if not Database.has_indexes:
+            self.create_indexes()
+            for collection, query in self.hot_queries:
+                self.check_query(collection, query)
+            Database.has_indexes = True
+
+    def create_indexes(self) -> None:
+        """ Create every index in `Database.indexes` that is missing. If there is
+        already an index on the same keys (i.e. the unique index that Meteor creates
+        on users.emails.address), it is used whatever its options, as creating
+        another with different options would fail.
+        """
+        for collection, keys in self.indexes:
+            try:
+                # the shell stores directions as floats, and special indexes as strings
+                existing = {name: [(field, order if isinstance(order, str) else int(order))
+                                   for field, order in index['key']]
+                            for name, index in self.database[collection].index_information().items()}
+                name = next((name for name, key in existing.items() if key == keys), None)
+                if name is None:
+                    name = self.database[collection].create_index(keys)
+                self.log.debug(f'Using index {name} on {collection}')
+            except pymongo.errors.OperationFailure as e:
+                self.log.error(f'Unable to create index {keys} on {collection}: {e}')
+
+    def check_query(self, collection: str, query: dict) -> bool:
+        """ Check the query plan of `query` on `collection`, and raise
+        a DatabaseException if it requires a full collection scan.
+
+        Parameters
+        ----------
+        collection: str
+            The name of the collection
+        query: dict
+            The query to check
+
+        Returns
+        -------
+        indexed: bool
+            True if the query is served by an index
+        """
+        plan = self.database[collection].find(query).explain().get('queryPlanner', {}).get('winningPlan', {})
+
+        # walk the (nested) stages of the plan
+        stages, scans = [plan], []
+        while stages:
+            stage = stages.pop()
+            if isinstance(stage, list):
+                stages.extend(stage)
+            elif isinstance(stage, dict):
+                if stage.get('stage') == 'COLLSCAN':
+                    scans.append(stage)
+                stages.extend(value for value in stage.values() if isinstance(value, (dict, list)))
+
+        if scans:
+            errmsg = f'Query {query} on {collection} requires a collection scan. Is the index missing?'
+            self.log.critical(errmsg)
+            raise DatabaseException(errmsg)
+
+        return True
+
 
     @classmethod
     def __init_log(cls) -> bool:
@@ -10,6 +10,7 @@ import datetime
 import pymongo
 import logging
 import colorlog
+import threading
 import astroplan
 import telescope
 import schedule as run
@@ -18,6 +19,8 @@ from astropy.time import Time
 import imqueue.calendar as calendar
 import imqueue.database as database
 import imqueue.schedule as schedule
+import imqueue.plan as plan
+from routines import ephemeris, lookup, cutouts
 from config import config
 from typing import List, Dict
 #from slacker_log_handler import SlackerLogHandler
@@ -67,6 +70,11 @@ class Executor(object):
         # designated start time (in the servers timezone)
         run.every().day.at(config.queue.start_time).do(self.start)
 
+        # keep the finder images of pending observations available offline; this
+        # runs in the background so that it can't delay (or crash) the queue
+        self.prefetcher = None
+        run.every(3).hours.do(self.start_prefetch)
+
         # the execution loop; this waits until the appropriate time
         # and then runs self.start()
         while True:
@@ -243,18 +251,20 @@ class Executor(object):
 
             if program:
                 return list(self.db.observations.find({'program': program['_id'],
-                                                    'completed': False})), program
+                                                       'completed': False},
+                                                      database.OBSERVATION_FIELDS)), program
             else:
                 self.log.debug('Unable to find program for this session. Cancelling this session...')
                 return None, None
         else: # TODO: figure priority between multiple public programs
-            programs = list(self.db.programs.find())
+            programs = list(self.db.programs.find({}, {'_id': 1}))
             #programs = list(self.db.programs.find({'name': 'General'}))
 
-            # find all observations that are in these programs
-            observations = sum([list(self.db.observations.find({'program': program['_id'],
-                                                             'completed': False}))
-                                for program in programs], [])
+            # find all observations that are in these programs in one query
+            observations = list(self.db.observations.find({'program': {'$in': [program['_id']
+                                                                               for program in programs]},
+                                                           'completed': False},
+                                                          database.OBSERVATION_FIELDS))
 
             # construct a general program
             program = {'_id': None, 'name': 'General', 'executor': 'general',
@@ -265,6 +275,48 @@ class Executor(object):
             self.log.debug(observations)
             return observations, program
 
+    def start_prefetch(self) -> bool:
+        """ Start prefetching the finder images in a background thread, unless
+        the previous prefetch is still running. Returns True if it was started.
+        """
+        if self.prefetcher is not None and self.prefetcher.is_alive():
+            self.log.debug('The previous prefetch of finder images is still running.')
+            return False
+
+        self.prefetcher = threading.Thread(target=self.prefetch_previews, daemon=True,
+                                           name='Preview prefetch')
+        self.prefetcher.start()
+
+        return True
+
+    def prefetch_previews(self) -> int:
+        """ Download the survey cutouts of every uncompleted observation into the
+        local cutout store, so that the previews of the web app don't need
+        to download them. Returns the number of cutouts that are stored (0 if
+        the prefetch failed).
+        """
+        try:
+            programs = list(self.db.programs.find({}, {'_id': 1}))
+            observations = list(self.db.observations.find({'program': {'$in': [program['_id']
+                                                                               for program in programs]},
+                                                           'completed': False},
+                                                          {'target': 1, 'RA': 1, 'Dec': 1}))
+
+            # resolve the names of targets without coordinates
+            names = lookup.prefetch([obs.get('target') for obs in observations
+                                     if obs.get('target') and not (obs.get('RA') and obs.get('Dec'))])
+            points = [(obs['RA'], obs['Dec']) if obs.get('RA') and obs.get('Dec')
+                      else names.get(obs.get('target'), (None, None)) for obs in observations]
+
+            count = cutouts.prefetch([point for point in points if point[0] and point[1]])
+        except Exception as e:
+            self.log.warning(f'Unable to prefetch finder images: {e}')
+            return 0
+
+        self.log.info(f'{count} finder images are available for {len(observations)} observations.')
+
+        return count
+
     def open_telescope(self):
         """ Open up the telescope, enable tracking, and set
         the dome to stay on.
@@ -373,6 +425,10 @@ class Executor(object):
             # wait until the session is meant to start
             self.telescope.wait((session['start'] - datetime.datetime.now()).seconds)
 
+        # the plan for the rest of the night; this is only updated
+        # where the queue has changed since the last observation
+        night_plan = plan.NightPlan(self.log)
+
         # continually execute observations from the queue
         while True:
 
@@ -385,15 +441,32 @@ class Executor(object):
                 self.log.debug('No uncompleted observations left in program...')
                 return
 
-            # run the scheduler and get the next observation to complete
-            self.log.debug(f'Calling the {program.get("executor")} scheduler...')
-            observing_schedule = schedule.schedule(observations, session, program)
+            # resolve the names of all targets without coordinates concurrently
+            lookup.prefetch([obs.get('target') for obs in observations
+                             if not (obs.get('RA') and obs.get('Dec')) and ':' not in (obs.get('target') or '')])
+
+            # make sure every pending target is in tonight's ephemeris; only new
+            # targets are transformed, so this is cheap after the first pass
+            ephemeris.tonight().add([(obs['RA'], obs['Dec']) for obs in observations
+                                     if obs.get('RA') and obs.get('Dec')])
+
+            # apply any changes to the queue to the plan, and get the next observation to complete;
+            # if we can't plan, fall back to scheduling a single observation, and replan next time
+            self.log.debug(f'Updating the plan for the {program.get("executor")} program...')
+            try:
+                night_plan.update(observations)
+                observing_schedule = night_plan.next()
+            except Exception as e:
+                self.log.warning(f'Unable to update the plan: {e}. Calling the scheduler...', exc_info=True)
+                night_plan = plan.NightPlan(self.log)
+                observing_schedule = schedule.schedule(observations, session, program)
+
+                # the schedulers return a start time in the past if nothing else can be observed
+                if observing_schedule is not None and observing_schedule[1] < -30:
+                    observing_schedule = None
+
+            # if the plan (or scheduler) has no observations left, we are done
             if observing_schedule is None:
-                self.log.error('Scheduler did not return a valid schedule.')
-                break
-            # if the scheduler returns no observations, we are done
-            if (observing_schedule[1]<-30) | (len(observing_schedule)<1):
-            #if len(observing_schedule.scheduled_blocks) == 0:
                 self.log.debug('Scheduler reports no observations left for this session...')
                 break
 
@@ -426,6 +499,7 @@ class Executor(object):
 
                 # record that we completed this observation
                 self.completed_observations.append(observation)
+                night_plan.complete(observation)
 
             except Exception as e:
                 self.log.warn(f'Error while executing {observation}', exc_info=True)
@@ -0,0 +1,160 @@
+""" This file implements the executor's plan for the rest of the night. Instead
+of rescheduling every pending observation after each exposure, the plan is kept
+in memory and only the part of it affected by changes to the queue is replanned.
+"""
+import json
+import hashlib
+import logging
+import astropy.units as units
+from astropy.time import Time
+from typing import List, Dict, Tuple
+import imqueue.schedulers.constraint_scheduler as constraint
+
+# the fields of an observation that affect where it is scheduled
+PLAN_FIELDS = ['target', 'RA', 'Dec', 'exposure_time', 'exposure_count',
+               'filters', 'binning', 'options', 'totalTime']
+
+
+class NightPlan(object):
+    """ This class stores the ordered (observation, start time) plan for the
+    rest of the night, and updates it as the queue changes.
+
+    Each time the queue is reloaded, we compare it against the plan and find the
+    observations that have been inserted, edited, or deleted (or completed by
+    someone else). Entries planned before the earliest point affected by these
+    changes are kept, and only the tail of the plan is recomputed. If we have
+    fallen behind the plan (i.e. we waited for the weather), the tail starts now.
+    If the change is large, we replan the whole night.
+    """
+
+    def __init__(self, log: logging.Logger = None, max_delta: float = 0.25, tolerance: float = 300):
+        """ Create a new, empty plan.
+
+        Parameters
+        ----------
+        log: logging.Logger
+            The logger to report replans to
+        max_delta: float
+            The fraction of the queue that must change to trigger a full replan
+        tolerance: float
+            How far (in seconds) we can fall behind the plan before replanning
+        """
+        self.log = log or logging.getLogger('executor')
+        self.max_delta = max_delta
+        self.tolerance = tolerance
+
+        # the ordered list of (observation, start time)
+        self.entries: List[Tuple[Dict, Time]] = []
+
+        # the fingerprint of every observation in the queue when it was last planned
+        self.fingerprints: Dict[str, str] = {}
+
+    @staticmethod
+    def fingerprint(observation: Dict) -> str:
+        """ Return a hash of the fields of an observation that affect its scheduling.
+        """
+        fields = {field: observation.get(field) for field in PLAN_FIELDS}
+        return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def replan(self, observations: List[Dict], start: Time = None, keep: int = 0) -> None:
+        """ Keep the first `keep` entries of the plan, and replan the
+        remaining observations after them.
+
+        Parameters
+        ----------
+        observations: List[Dict]
+            Every uncompleted observation in the queue
+        start: Time
+            The earliest time at which the tail can start (default: now)
+        keep: int
+            The number of entries at the head of the plan to keep
+        """
+        start = start or Time.now()
+        head = self.entries[:keep]
+
+        # the tail can't start until the head is finished
+        if head:
+            observation, begin = head[-1]
+            start = max(start, begin + constraint.duration(observation)*units.second)
+
+        # plan everything that isn't in the head
+        planned = {str(observation['_id']) for observation, _ in head}
+        tail = constraint.plan([observation for observation in observations
+                                if str(observation['_id']) not in planned], start)
+
+        self.entries = head + tail
+        self.fingerprints = {str(observation['_id']): self.fingerprint(observation)
+                             for observation in observations}
+
+        self.log.debug(f'Kept {len(head)} and replanned {len(tail)} observations starting at {start.isot}')
+
+    def update(self, observations: List[Dict]) -> None:
+        """ Update the plan to reflect the current state of the queue.
+
+        Parameters
+        ----------
+        observations: List[Dict]
+            Every uncompleted observation in the queue
+        """
+        now = Time.now()
+        current = {str(observation['_id']): observation for observation in observations}
+
+        # find how the queue has changed since we last planned
+        inserted = [key for key in current if key not in self.fingerprints]
+        deleted = [key for key in self.fingerprints if key not in current]
+        edited = [key for key in current if key in self.fingerprints
+                  and self.fingerprint(current[key]) != self.fingerprints[key]]
+        changes = len(inserted) + len(deleted) + len(edited)
+
+        # the first plan of the night, or a large change to the queue
+        if not self.fingerprints or changes > self.max_delta*len(self.fingerprints):
+            self.log.info(f'Replanning the night for {len(observations)} observations...')
+            return self.replan(observations, now)
+
+        # we are behind the plan, so everything from now on may change
+        if self.entries and (now - self.entries[0][1]).sec > self.tolerance:
+            self.log.info('Executor has fallen behind the plan; replanning the night...')
+            return self.replan(observations, now)
+
+        # nothing to do
+        if not changes:
+            return
+
+        # the first entry that depends on a deleted or edited observation
+        tail = len(self.entries)
+        for position, (observation, start) in enumerate(self.entries):
+            if str(observation['_id']) in deleted or str(observation['_id']) in edited:
+                tail = position
+                break
+
+        # new and edited observations can only displace entries
+        # that start at or after they could first be observed
+        for key in inserted + edited:
+            earliest = constraint.plan([current[key]], now, limit=1)
+            if earliest:
+                tail = min([tail] + [position for position, (_, start) in enumerate(self.entries)
+                                     if start >= earliest[0][1]])
+
+        self.log.info(f'Queue has {len(inserted)} new, {len(edited)} edited, and {len(deleted)} '
+                      f'removed observations; replanning from entry {tail} of {len(self.entries)}...')
+
+        return self.replan(observations, now, keep=tail)
+
+    def complete(self, observation: Dict) -> None:
+        """ Remove an observation that has been executed from the plan.
+        """
+        key = str(observation['_id'])
+        self.entries = [entry for entry in self.entries if str(entry[0]['_id']) != key]
+        self.fingerprints.pop(key, None)
+
+    def next(self) -> (Dict, int):
+        """ Return the next observation in the plan, and the time (in seconds)
+        to wait before it starts. Returns None if nothing else can be observed tonight.
+        """
+        if not self.entries:
+            return None
+
+        observation, start = self.entries[0]
+
+        # we may be slightly behind the plan; start immediately
+        return observation, max(int((start - Time.now()).sec), 0)
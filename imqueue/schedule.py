@@ -2,6 +2,7 @@ import pymongo
 import importlib
 import imqueue
 import imqueue.schedulers.astroplan_scheduler as general
+import imqueue.schedulers.constraint_scheduler as constraint
 #import imqueue.schedulers.basic_general_old as general
 from typing import List, Dict
 
@@ -37,23 +38,13 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
     # elif program.get('executor') == 'asteroid':
     #     return asteroid.schedule(observations, program)
 
-    # try and load the scheduler dynamically
-    # else:
-        # try and load module with that name
+    # the vectorized scheduler; if it fails, fall back to the general scheduler
     try:
-        scheduler = importlib.import_module(f'imqueue.schedulers.{program.get("executor")}')
-
-        # check that it provides both schedule and execute commands
-        # temporary commented
-        #if 'schedule' in dir(scheduler) and 'execute' in dir(scheduler):
-        #    return scheduler.schedule(observations, session, program)
-        return general.schedule(observations, session, program)
-        # if the above does not work, use general scheduler
+        return constraint.schedule(observations, session, program)
     except Exception as e:
-        imqueue.Executor.log.warning('Unable to load desired scheduler. Using "general" scheduler...')
+        imqueue.Executor.log.warning('Unable to use the constraint scheduler. Using "general" scheduler...')
         imqueue.Executor.log.debug(e)
         return general.schedule(observations, session, program)
-        #return scheduler.general.schedule(observations, session, program)
 
 
 def execute(observation: Dict, program: Dict, telescope, db) -> bool:
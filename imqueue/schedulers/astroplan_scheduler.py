@@ -5,7 +5,8 @@ import numpy as np
 import imqueue.database as database
 from config import config
 from typing import List, Dict
-from routines import pinpoint, lookup
+from routines import pinpoint, lookup, ephemeris, focus
+from routines.lookup import resolve
 import telescope.ssh_telescope as Telescope
 
 import datetime
@@ -114,7 +115,8 @@ def lookup(obs):
                 celestial_body.dec.to_string(unit=u.degree,sep=':'))
     else: # stellar body
         try:
-            target_coordinates = astropy.coordinates.SkyCoord.from_name(target)
+            ra, dec = resolve(target)
+            target_coordinates = SkyCoord(ra, dec, unit=(u.hourangle, u.deg))
             return FixedTarget(coord=target_coordinates,name=target+" "+obs['_id'])
 
         except Exception as e:
@@ -174,6 +176,13 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
     #night = TimeConstraint(sunset_tonight, sunrise_tomorrow)
     night = TimeConstraint(sunset_tonight, sunrise_tomorrow)
     obstime_constraint = TimeConstraint(time, sunrise_tomorrow)
+
+    # the shared ephemeris for tonight; used to drop targets that can never
+    # satisfy the global constraints before building their blocks
+    tonight = ephemeris.tonight()
+    remaining = tonight.remaining(time)
+    dark = tonight.sun_alt[remaining] < -18
+
     # Create ObservingBlocks for each filter and target with our time
     # constraint, and durations determined by the exposures needed
     for j,obs in enumerate(observations):
@@ -196,6 +205,12 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
             database.Database.observations.update_one({'_id': observation['_id']},
                                                       {'$set':{'RA': ra, 'DEC': dec}})
 
+        # skip targets that never rise above 30 degrees during astronomical night
+        target_alt = tonight.altitude(ra, dec)
+        if target_alt is None or not np.any((target_alt[remaining] >= 30) & dark):
+            print(f'{obs.get("target")} is not observable for the rest of the night.')
+            continue
+
 
 
         for i,filt in enumerate(obs['filters']):
@@ -270,16 +285,8 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
     seq_scheduler(blocks, sequential_schedule)
     
 
-    # Initialize the priority scheduler with the constraints and transitioner
-    prior_scheduler = PriorityScheduler(constraints = global_constraints,
-                                        observer = seo,
-                                        transitioner = transitioner)
-    # Initialize a Schedule object, to contain the new schedule
-    priority_schedule = Schedule(sunset_tonight, sunrise_tomorrow)
-
-    print(priority_schedule)
-    # Call the schedule with the observing blocks and schedule to schedule the blocks
-    prior_scheduler(blocks, priority_schedule)
+    # NB: only the sequential schedule is used, so we no longer run the
+    # (much slower) PriorityScheduler over the same blocks
 
     tab = to_table(sequential_schedule, show_transitions=True)
     print(tab)
@@ -338,8 +345,9 @@ def execute(observation: Dict, program: Dict, telescope, db) -> bool:
     # we must enable tracking before we start slewing
     telescope.enable_tracking()
 
-    # try and point object roughly
-    if telescope.goto_point(observation['RA'], observation['Dec']) is False:
+    # try and point object roughly; the slew is corrected by the pointing model
+    commanded = pinpoint.slew(observation['RA'], observation['Dec'], telescope)
+    if commanded is None:
         telescope.log.warn('Object is not currently visible. Skipping...')
         return False
     # create basename for observations
@@ -392,7 +400,7 @@ def execute(observation: Dict, program: Dict, telescope, db) -> bool:
         telescope.log.warn('Skipping pinpoint for solar system object.')
     else:
         pinpointed = pinpoint.point(
-            observation['RA'], observation['Dec'], telescope, False)
+            observation['RA'], observation['Dec'], telescope, False, commanded)
 
     if not pinpointed:
         telescope.log.error('Pinpoint failed. Aborting observation...')
@@ -441,6 +449,13 @@ def execute(observation: Dict, program: Dict, telescope, db) -> bool:
             filt_name = "SII"
         else:
             filt_name = filt
+        # move the focuser for this filter and the current temperature; this
+        # only runs a (short) focus sweep if the image quality has degraded
+        try:
+            focus.model().adjust(telescope, filt)
+        except Exception as e:
+            telescope.log.warning(f'Unable to adjust focus: {e}')
+
         # take exposures!
         telescope.take_exposure(basename_science.replace(
             '{filter}', filt_name), exposure_time, exposure_count, binning, filt)
@@ -1,3 +1,4 @@
+import re
 import sys
 import numpy as np
 import astropy.units as u
@@ -6,6 +7,8 @@ from astroplan import Observer
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz, get_sun
 import matplotlib.pyplot as plt
 import datetime
+import imqueue.database as database
+from routines import lookup, ephemeris
 
 #
 #an astronomical observation
@@ -147,46 +150,51 @@ class Scheduler():
     def __init__(self, observatory, observations):
         self.observatory = observatory
         self.observations = observations
+        self.ephemeris = None #the NightEphemeris for tonight
 
     def whatsNext(self):
         max_altitude_time = {'target':[], 'altitude':[], 'time':[], 'wait':[]}
 
-        observatory_location = EarthLocation(lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
-
-        #build alt-az coordinate frame for observatory over next 15 hours
-        obs_time = Time.now()
-        delta_obs_time = np.linspace(0, 15, 1000)*u.hour
-        #the next 15 hours
-        times = obs_time+delta_obs_time
-        #build frame
-        frame = AltAz(obstime=times, location=observatory_location)
-        #print frame
-
-        #get *nearest* sunset and *next* sunrise times
-        #still not a big fan of this!
-        observatory_location_obsplan = Observer(longitude=self.observatory.longitude*u.deg, latitude=self.observatory.latitude*u.deg, elevation=self.observatory.altitude*u.m, name=self.observatory.code, timezone=self.observatory.timezone)
-        sundown_time = observatory_location_obsplan.sun_set_time(Time.now(), which="nearest")
-        sunup_time = observatory_location_obsplan.sun_rise_time(Time.now(), which="next")
-        #print 'sundown=%s'%sundown_time.iso
-        #print 'sunup=%s'%sunup_time.iso
+        #compute the ephemeris of all targets once, then reuse it
+        if self.ephemeris is None:
+            observatory_location = EarthLocation(lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
+
+            #get *nearest* sunset and *next* sunrise times
+            #still not a big fan of this!
+            observatory_location_obsplan = Observer(longitude=self.observatory.longitude*u.deg, latitude=self.observatory.latitude*u.deg, elevation=self.observatory.altitude*u.m, name=self.observatory.code, timezone=self.observatory.timezone)
+            sundown_time = observatory_location_obsplan.sun_set_time(Time.now(), which="nearest")
+            sunup_time = observatory_location_obsplan.sun_rise_time(Time.now(), which="next")
+            #print 'sundown=%s'%sundown_time.iso
+            #print 'sunup=%s'%sunup_time.iso
+
+            self.ephemeris = ephemeris.NightEphemeris(sundown_time, sunup_time, observatory_location)
+
+        #only look at the rest of the night
+        remaining = self.ephemeris.remaining()
+        times = self.ephemeris.times[remaining]
+        delta_obs_time = (times - Time.now()).to(u.second)
 
         # list solar system objects
         solar_system = ['mercury','venus','moon','mars','jupiter','saturn','uranus','neptune','pluto']
         too_bright = False
 
+        #add all targets with known coordinates in one transform
+        self.ephemeris.add([(observation['RA'], observation['Dec']) for observation in self.observations
+                            if observation.get('RA') and observation.get('Dec')])
+
         #loop thru observations, suggest the next best target
         for i,observation in enumerate(self.observations):
 
             # the observation is missing RA/Dec
             if not observation.get('RA') or not observation.get('Dec'):
 
-            # if the target name is a RA/Dec string
-            if re.search(r'\d{1,2}:\d{2}:\d{1,2}.\d{1,2}\s[+-]\d{1,2}:\d{2}:\d{1,2}.\d{1,2}', observation.get('target')):
-                ra, dec = observation.get('target').strip().split(' ')
-                observation['RA'] = ra; observation['Dec'] = dec;
-            else: # try and lookup by name
-                if observation.get('target').lower() in solar_system:
-                    too_bright = True
+                # if the target name is a RA/Dec string
+                if re.search(r'\d{1,2}:\d{2}:\d{1,2}.\d{1,2}\s[+-]\d{1,2}:\d{2}:\d{1,2}.\d{1,2}', observation.get('target')):
+                    ra, dec = observation.get('target').strip().split(' ')
+                    observation['RA'] = ra; observation['Dec'] = dec;
+                else: # try and lookup by name
+                    if observation.get('target').lower() in solar_system:
+                        too_bright = True
                     ra, dec = lookup.lookup(observation.get('target'))
 
                     if not ra or not dec:
@@ -211,32 +219,27 @@ class Scheduler():
             if observation.get('Dec') is None:
                 continue
 
-            # target coordinates
-
-            input_coordinates = ra+" "+dec
-
-            max_altitude_time['target'].append(observation.target.getName())
-
-            try:
-                target_coordinates = SkyCoord(input_coordinates, unit=(u.hourangle, u.deg))
-            except:
+            # target altitudes for the rest of the night
+            target_alt = self.ephemeris.altitude(observation['RA'], observation['Dec'])
+            if target_alt is None or not len(times):
                 continue
+            target_alt = target_alt[remaining]
 
-            target_altaz = target_coordinates.transform_to(frame)
+            max_altitude_time['target'].append(observation.get('target'))
 
-            if (np.max(target_altaz.alt)) > self.min_target_alt*u.degree:
-                max_altitude_time['altitude'].append(np.max(target_altaz.alt))
+            if (np.max(target_alt)) > self.min_target_alt:
+                max_altitude_time['altitude'].append(np.max(target_alt)*u.degree)
             else:
                 max_altitude_time['altitude'].append(0*u.degree)
 
-            aux_time = times[np.argmax(target_altaz.alt)]
+            aux_time = times[np.argmax(target_alt)]
             max_altitude_time['time'].append(aux_time)
 
-            aux_delta_time = delta_obs_time[np.argmax(target_altaz.alt)]
+            aux_delta_time = delta_obs_time[np.argmax(target_alt)]
 
-            #print max_altitude_time['altitude'][i], times[np.argmax(target_altaz.alt)], sundown_time, sunup_time
-            if (max_altitude_time['altitude'][i]>0*u.degree) & (times[np.argmax(target_altaz.alt)] > sundown_time) & (times[np.argmax(target_altaz.alt)] < sunup_time):
-                max_altitude_time['wait'].append(aux_delta_time.to(u.second))
+            #every sample time is between sundown and sunup
+            if max_altitude_time['altitude'][-1]>0*u.degree:
+                max_altitude_time['wait'].append(aux_delta_time)
             else:
                 max_altitude_time['wait'].append(-1*u.s)
 
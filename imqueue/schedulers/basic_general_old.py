@@ -7,7 +7,7 @@ from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz, get_sun
 from typing import List, Dict
 from config import config
-from routines import pinpoint, lookup
+from routines import pinpoint, lookup, ephemeris
 from astropy.coordinates import Angle
 from astroplan import FixedTarget, Observer, download_IERS_A
 import re
@@ -40,29 +40,20 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
                                 lon=config.general.longitude*units.deg,
                                 height=config.general.altitude*units.m)
 
-    # compute necessary time variables
-    start_time = str(Time.now())[:10]+" 00:00:00"
-    fixed_start = Time(start_time, scale="utc")
-    delta_fixed_start = np.linspace(0, 15, 50000)*units.hour
-    fixed = fixed_start+delta_fixed_start
-    altazframe = AltAz(obstime=fixed, location=observatory)
-    sun_altaz = get_sun(fixed).transform_to(altazframe)
-
-    # get times for sunset and sunrise
-    observatory_location_obsplan = Observer(longitude=config.general.longitude*units.deg,latitude=config.general.latitude*units.deg, elevation=config.general.altitude*units.m, name="G52", timezone="US/Pacific")
-    sunset_time = observatory_location_obsplan.twilight_evening_nautical(Time.now(), which="nearest")
-    sunrise_time = observatory_location_obsplan.twilight_morning_nautical(Time.now(), which="next")
-    #sunset_time = fixed[np.where(
-    #    (sun_altaz.alt < -18*units.deg) == True)[0][0]]
-    #sunrise_time = fixed[np.where(
-    #    (sun_altaz.alt < -18*units.deg) == True)[0][-1]]
-
-    # compute time and coordinates
-    delta_obs_time = np.linspace(0, 15, 50000)*units.hour
-    times = Time.now()+delta_obs_time
+    # the shared ephemeris for tonight
+    night = ephemeris.tonight()
+
+    # add every observation that already has coordinates in one transform
+    night.add([(observation['RA'], observation['Dec']) for observation in observations
+               if observation.get('RA') and observation.get('Dec')])
+
+    # only consider the times remaining tonight
     print(Time.now(), file=f)
-    times = times[np.where((times > sunset_time) & (times < sunrise_time))]
-    frame = AltAz(obstime=times, location=observatory)
+    now = Time.now()
+    remaining = night.remaining(now)
+    times = night.times[remaining]
+    if not len(times):
+        return None, -1
 
     # iterate over all the observations
     for i, observation in enumerate(observations):
@@ -133,22 +124,22 @@ def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, i
         # except:
         #    continue
 
-        target_altaz = target_coordinates.transform_to(frame)
-        if (np.max(target_altaz.alt)) > config.telescope.min_alt*units.degree:
-            max_altitude_time['altitude'].append(np.max(target_altaz.alt))
+        target_alt = night.altitude(observation['RA'], observation['Dec'])[remaining]
+        if np.max(target_alt) > config.telescope.min_alt:
+            max_altitude_time['altitude'].append(np.max(target_alt)*units.degree)
             #logme('debuggingggggg...', max_altitude_time['target'])
         else:
             max_altitude_time['altitude'].append(0*units.degree)
             #logme('Not visible :(', max_altitude_time['target'])
 
-        aux_time = times[np.argmax(target_altaz.alt)]
+        aux_time = times[np.argmax(target_alt)]
         max_altitude_time['time'].append(aux_time)
 
-        aux_delta_time = delta_obs_time[np.argmax(target_altaz.alt)]
+        aux_delta_time = (aux_time - now).to(units.second)
 
-        if (max_altitude_time['altitude'][i] > config.telescope.min_alt*units.degree) and (times[np.argmax(target_altaz.alt)] > sunset_time)\
-           and (times[np.argmax(target_altaz.alt)] < sunrise_time):  # and (times[np.argmax(target_altaz.alt)] < Time(endtime)):
-            max_altitude_time['wait'].append(aux_delta_time.to(units.second))
+        # every sample time is between sunset and sunrise
+        if max_altitude_time['altitude'][-1] > config.telescope.min_alt*units.degree:
+            max_altitude_time['wait'].append(aux_delta_time)
         else:
             max_altitude_time['wait'].append(-1*units.s)
 
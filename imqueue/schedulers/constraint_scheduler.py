@@ -0,0 +1,263 @@
+""" This file implements a scheduler that evaluates every observing constraint
+as a NumPy matrix over the shared ephemeris time grid, instead of looping over
+astroplan ObservingBlocks and time slots in Python.
+"""
+import re
+import numpy as np
+import imqueue.database as database
+from config import config
+from typing import List, Dict, Tuple
+from astropy.time import Time
+from routines import lookup, ephemeris
+from imqueue.schedulers.astroplan_scheduler import execute
+
+# the default priority of an observation; lower values are scheduled first
+DEFAULT_PRIORITY = 10.
+
+# the sun must be below this altitude (astronomical twilight)
+MAX_SUN_ALT = -18.
+
+# the shortest exposure we plan for, and the readout time, in seconds
+MIN_EXPOSURE = 30
+READ_OUT = 1
+
+# the overheads (in seconds) that execute() pays for every observation: the slew
+# and pinpoint, changing filter and adjusting focus for each filter, and the
+# biases (10 to clear the CCD, and 10 per exposure) taken at the end
+SLEW = 60
+PINPOINT = 90
+FILTER_CHANGE = 20
+CLEAR_BIASES = 10
+BIASES_PER_EXPOSURE = 10
+
+
+def coordinates(observation: Dict) -> (str, str):
+    """ Return the (RA, Dec) strings of an observation, converting the target
+    name if the observation does not have coordinates yet. The coordinates are
+    saved into the observation and the database.
+
+    Returns (None, None) if the target could not be found.
+    """
+    # the observation already has coordinates
+    if observation.get('RA') and observation.get('Dec'):
+        return observation['RA'], observation['Dec']
+
+    # if the target name is a RA/Dec string
+    if re.search(r'\d{1,2}:\d{2}:\d{1,2}(.\d{1,2})?\s[+-]?\d{1,2}:\d{2}:\d{1,2}(.\d{1,2})?',
+                 observation.get('target', '')):
+        ra, dec = observation.get('target').strip().split(' ')
+    else:  # try and lookup by name
+        ra, dec = lookup.lookup(observation.get('target', ''))
+
+        if not ra or not dec:
+            print(f'Unable to compute RA/Dec for {observation.get("target")}.')
+            if database.Database.is_connected:
+                database.Database.observations.update_one({'_id': observation['_id']},
+                                                          {'$set': {'error': 'lookup'}})
+            return None, None
+
+        if database.Database.is_connected:
+            database.Database.observations.update_one({'_id': observation['_id']},
+                                                      {'$set': {'RA': ra, 'Dec': dec}})
+
+    # save the RA/Dec
+    observation['RA'] = ra
+    observation['Dec'] = dec
+
+    return ra, dec
+
+
+def duration(observation: Dict) -> float:
+    """ Return the time (in seconds) needed to complete an observation,
+    including the overheads of execute().
+    """
+    filters = [filt for filt in observation.get('filters', []) if filt != 'dark'] or ['clear']
+    count = int(observation.get('exposure_count') or 1)
+    exposure = max(float(observation.get('exposure_time') or 0), MIN_EXPOSURE) + READ_OUT
+
+    # slewing and pinpointing, and the filter change and focus of each set
+    overhead = SLEW + PINPOINT + FILTER_CHANGE*len(filters)
+
+    # the biases, and the darks (one per exposure) if they were requested
+    overhead += (CLEAR_BIASES + BIASES_PER_EXPOSURE*count)*READ_OUT
+    if 'dark' in observation.get('filters', []):
+        overhead += exposure*count
+
+    if observation.get('totalTime'):
+        return float(observation['totalTime']) + overhead
+
+    # every filter except darks is a separate set of exposures
+    return exposure*count*len(filters) + overhead
+
+
+def option(observation: Dict, name: str, default: float) -> float:
+    """ Return the numerical value of an observation option, or default
+    if it is not set.
+    """
+    value = (observation.get('options') or {}).get(name)
+    try:
+        return float(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        return default
+
+
+def evaluate(observations: List[Dict], start: Time = None):
+    """ Evaluate the constraints of every observation at every sample time between
+    `start` (default: now) and the end of tonight's ephemeris.
+
+    Every constraint (altitude, darkness, airmass, moon separation and
+    illumination, and the remaining night) is evaluated for every observation
+    at every sample time as one boolean matrix. An observation can start at a
+    sample time if its constraints hold for its full duration.
+
+    Returns
+    -------
+    candidates: List[Dict]
+        The observations whose coordinates could be found
+    times: Time
+        The sample times
+    fits: np.ndarray
+        (candidates x times) boolean matrix; whether each observation can start at each time
+    score: np.ndarray
+        (candidates x times) matrix of priority-weighted altitudes; -inf where it does not fit
+    samples: np.ndarray
+        The number of samples needed by each observation
+    """
+    # the shared ephemeris for the rest of tonight
+    night = ephemeris.tonight()
+    remaining = night.remaining(start)
+    times = night.times[remaining]
+    if len(times) < 2:
+        return [], times, None, None, None
+
+    # find the coordinates of every observation
+    candidates = [observation for observation in observations
+                  if coordinates(observation)[0] is not None]
+    night.add([(observation['RA'], observation['Dec']) for observation in candidates])
+    candidates = [observation for observation in candidates
+                  if night.row(observation['RA'], observation['Dec']) is not None]
+    if not candidates:
+        return [], times, None, None, None
+
+    rows = np.array([night.row(observation['RA'], observation['Dec'])
+                     for observation in candidates])
+
+    # (observations x times) matrices for the rest of the night
+    alt = night.alt[rows, remaining]
+    airmass = night.airmass[rows, remaining]
+    moon_sep = night.moon_separation(rows)[:, remaining]
+    moon_down = night.moon_alt[remaining] < 0
+
+    # per-observation limits as columns
+    max_airmass = np.array([option(obs, 'airmass', np.inf) for obs in candidates])[:, None]
+    max_illumination = np.array([option(obs, 'moon_illumination', 1.) for obs in candidates])[:, None]
+    min_moon_sep = np.array([option(obs, 'moon', config.queue.moon_separation)
+                             for obs in candidates])[:, None]
+    priority = np.array([option(obs, 'priority', DEFAULT_PRIORITY) for obs in candidates]).clip(1e-3)
+
+    # evaluate every constraint at every time
+    valid = ((alt >= config.telescope.min_alt) &
+             (night.sun_alt[remaining] < MAX_SUN_ALT) &
+             (airmass <= max_airmass) &
+             ((moon_sep >= min_moon_sep) | moon_down) &
+             ((night.moon_illumination[remaining] <= max_illumination) | moon_down))
+
+    # the number of samples that each observation needs
+    step = (times[1] - times[0]).sec
+    samples = np.ceil([duration(obs)/step for obs in candidates]).astype(int).clip(1)
+
+    # an observation fits at a time if all of its next `samples` samples are valid
+    ntimes = valid.shape[1]
+    index = np.arange(ntimes)
+    cumulative = np.zeros((len(candidates), ntimes + 1), dtype=np.int32)
+    cumulative[:, 1:] = np.cumsum(valid, axis=1)
+    end = np.minimum(index[None, :] + samples[:, None], ntimes)
+    window = np.take_along_axis(cumulative, end, axis=1) - cumulative[:, :ntimes]
+    fits = (window == samples[:, None]) & (index[None, :] + samples[:, None] <= ntimes)
+
+    # rank observations by priority-weighted altitude
+    score = np.where(fits, np.sin(np.radians(alt))/priority[:, None], -np.inf).astype(np.float32)
+
+    return candidates, times, fits, score, samples
+
+
+def plan(observations: List[Dict], start: Time = None, limit: int = None) -> List[Tuple[Dict, Time]]:
+    """ Greedily plan the observations for the rest of the night, starting at `start`.
+
+    At each step we take the earliest time at which any remaining observation
+    can start and, at that time, the observation with the best priority-weighted
+    altitude. The next step starts once that observation is complete.
+
+    Parameters
+    ----------
+    observations: List[Dict]
+        A list of dictionaries representing the observations to be scheduled
+    start: Time
+        The time at which the plan starts (default: now)
+    limit: int
+        The maximum number of observations to plan (default: all)
+
+    Returns
+    -------
+    plan: List[Tuple[Dict, Time]]
+        The planned observations and their start times, in order
+    """
+    candidates, times, fits, score, samples = evaluate(observations, start)
+    if not candidates:
+        return []
+
+    entries = []
+    taken = np.zeros(len(candidates), dtype=bool)
+    column = 0
+    while column < len(times) and (limit is None or len(entries) < limit):
+
+        # the first time at which any remaining observation can start
+        startable = np.any(fits[~taken, column:], axis=0)
+        if not np.any(startable):
+            break
+        first = column + int(np.argmax(startable))
+
+        # and the best observation at that time
+        best = int(np.argmax(np.where(taken, -np.inf, score[:, first])))
+        entries.append((candidates[best], times[first]))
+
+        taken[best] = True
+        column = first + samples[best]
+
+    return entries
+
+
+def schedule(observations: List[Dict], session: Dict, program: Dict) -> (Dict, int):
+    """ Return the next object to be imaged, and the time that the executor must wait
+    before imaging this observation.
+
+    This is the first step of `plan`; we pick the earliest time at which
+    anything can start, and at that time, the observation with the best
+    priority-weighted altitude.
+
+    Parameters
+    ----------
+    observations: List[Dict]
+        A list of dictionaries representing the observations to be scheduled
+    session: Dict
+        The session that these observations are being executed in
+    program: Dict
+        The Program object containing the configuration of this observational program
+
+    Returns
+    -------
+    obs: Dict
+        The next observation to be executed
+    wait: int
+         The time (in seconds) to wait before imaging this observation.
+    """
+    now = Time.now()
+    entries = plan(observations, now, limit=1)
+
+    # nothing can be observed for the rest of the night
+    if not entries:
+        return None
+
+    observation, start = entries[0]
+
+    return observation, int((start - now).sec)
@@ -0,0 +1,3 @@
+from . import server
+
+IngestServer = server.IngestServer
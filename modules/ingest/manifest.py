@@ -0,0 +1,107 @@
+""" This file implements the persistent manifest of the ingest server; every frame
+that we have seen on the telescope control server, where it was copied to, its
+checksum, and (for an interrupted transfer) which chunks have been written.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+# where we persist the manifest
+MANIFEST_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                             'config', 'ingest.sqlite')
+
+
+class Manifest(object):
+    """ A SQLite manifest of the frames on the telescope control server.
+
+    Each frame is identified by its remote path, size and modification time;
+    a frame that has been transferred and verified is 'done' (and one that
+    repeatedly failed is 'abandoned'), and is never transferred again unless
+    it changes on the server.
+    """
+
+    def __init__(self, filename: str = MANIFEST_FILE):
+        """ Open (and create if necessary) the manifest at `filename`.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (remote TEXT PRIMARY KEY, local TEXT, '
+                        'size INTEGER, mtime REAL, sha256 TEXT, status TEXT, chunks TEXT, '
+                        'attempts INTEGER, updated REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_status ON files (status)')
+        self.db.commit()
+
+    def get(self, remote: str) -> Optional[Dict]:
+        """ Return the entry of the frame at `remote`, if there is one.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT remote, local, size, mtime, sha256, status, chunks, attempts '
+                                  'FROM files WHERE remote = ?', (remote,)).fetchone()
+        if row is None:
+            return None
+
+        entry = dict(zip(['remote', 'local', 'size', 'mtime', 'sha256', 'status', 'chunks', 'attempts'], row))
+        entry['chunks'] = json.loads(entry['chunks'] or '[]')
+
+        return entry
+
+    def needed(self, remote: str, size: int, mtime: float) -> bool:
+        """ Whether the frame at `remote`, with `size` and `mtime`, still has to be transferred.
+        """
+        entry = self.get(remote)
+        return not (entry and entry['status'] in ('done', 'abandoned') and
+                    entry['size'] == size and entry['mtime'] == mtime)
+
+    def start(self, remote: str, local: str, size: int, mtime: float, checksum: str) -> Dict:
+        """ Record that we are transferring the frame at `remote` to `local`, and
+        return its entry. If we were already transferring the same version of it,
+        the chunks that were written are kept so that the transfer can resume.
+
+        `attempts` is the number of copies of this version that failed their
+        checksum; interrupted transfers (i.e. a dropped connection) don't count.
+        """
+        entry = self.get(remote)
+        resume = (entry is not None and entry['status'] != 'done' and entry['size'] == size
+                  and entry['mtime'] == mtime and entry['sha256'] == checksum)
+        chunks = entry['chunks'] if resume else []
+        attempts = (entry['attempts'] or 0) if resume else 0
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (remote, local, size, mtime, checksum, 'partial', json.dumps(chunks),
+                             attempts, time.time()))
+            self.db.commit()
+
+        return {'remote': remote, 'local': local, 'size': size, 'mtime': mtime,
+                'sha256': checksum, 'status': 'partial', 'chunks': chunks, 'attempts': attempts}
+
+    def chunk(self, remote: str, offset: int) -> None:
+        """ Record that the chunk at `offset` of the frame at `remote` has been written.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT chunks FROM files WHERE remote = ?', (remote,)).fetchone()
+            chunks = json.loads(row[0] or '[]') if row else []
+            self.db.execute('UPDATE files SET chunks = ?, updated = ? WHERE remote = ?',
+                            (json.dumps(chunks + [offset]), time.time(), remote))
+            self.db.commit()
+
+    def finish(self, remote: str, status: str = 'done') -> None:
+        """ Record that the transfer of the frame at `remote` has finished
+        with `status` ('done', 'failed' or 'abandoned'); a copy that 'failed'
+        its checksum counts as an attempt.
+        """
+        with self.lock:
+            self.db.execute('UPDATE files SET status = ?, chunks = ?, updated = ?, '
+                            'attempts = attempts + ? WHERE remote = ?',
+                            (status, '[]' if status == 'done' else None, time.time(),
+                             1 if status == 'failed' else 0, remote))
+            self.db.commit()
+
+    def counts(self) -> Dict[str, int]:
+        """ Return the number of frames with each status.
+        """
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
@@ -0,0 +1,265 @@
+import os
+import time
+import shlex
+import threading
+import concurrent.futures
+from typing import Dict, List, Tuple
+from config import config
+from modules.template import base
+from modules.ingest import manifest
+from telescope import connection, transfer
+
+
+class IngestServer(base.MQTTServer):
+    """
+    This server copies new frames off the telescope control server as soon as
+    they are written. It watches the raw/science, raw/dark and raw/bias directories
+    of every observation (see schedule.execute), and copies each new frame over
+    a pool of SFTP channels into a local mirror of the data directory.
+
+    Every frame is checked against a checksum computed on the server, and is
+    recorded in a persistent manifest, so that it is never transferred twice;
+    an interrupted transfer resumes from the chunks that were already written.
+    """
+
+    # the directories (under each observation) that we copy frames from
+    directories = ['raw/science', 'raw/dark', 'raw/bias']
+
+    # the interval (in seconds) between scans of the server for new frames,
+    # and how far back (in minutes) a regular scan looks; every `full_scan`
+    # seconds, the whole data directory is scanned
+    interval: float = 2.
+    lookback: int = 30
+    full_scan: float = 3600.
+
+    # a frame that hasn't been modified for `settle` seconds (by the server's clock)
+    # has finished being written, so it is copied without waiting for another scan
+    settle: float = 10.
+
+    # the number of SFTP channels, and of frames that are copied at once
+    channels: int = 4
+    files: int = 2
+
+    # the number of copies of a frame that can fail their checksum before we give
+    # up on it; interrupted transfers are always resumed, however often they fail
+    max_attempts: int = 5
+
+    def __init__(self):
+        """
+        We initialize the super class (which handles all MQTT configuration),
+        connect to the telescope control server, and start listening.
+        """
+
+        # MUST INIT SUPERCLASS FIRST
+        super().__init__("Ingest Server")
+
+        # where frames are on the server, and where we copy them to
+        ingest = getattr(config, 'ingest', None)
+        self.remote_root = getattr(ingest, 'remote_directory', None) or \
+            '/'.join(['', 'home', config.telescope.username, 'data'])
+        self.local_root = getattr(ingest, 'directory', None) or \
+            os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data')
+
+        # our own connection to the telescope control server
+        self.log.info('Connecting to the telescope control server...')
+        self.connection = connection.SSHConnection(config.telescope.host, config.telescope.username,
+                                                   log=self.log)
+        self.connection.connect()
+        self.pool = transfer.SFTPPool(self.connection, size=self.channels)
+
+        self.manifest = manifest.Manifest()
+        self.log.info(f'Manifest has {self.manifest.counts()} frames')
+
+        # the (size, mtime) of each frame that is still needed when we last saw it;
+        # a frame is only copied once it has stopped changing
+        self.seen: Dict[str, Tuple[int, float]] = {}
+
+        # frames that are being copied; this also guards `seen`
+        self.active = set()
+        self.active_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.files,
+                                                              thread_name_prefix='ingest')
+
+        # set to scan immediately (i.e. when an exposure finishes)
+        self.wake = threading.Event()
+        self.scanner = threading.Thread(target=self.scan_forever, daemon=True, name='Ingest scanner')
+        self.scanner.start()
+
+        # MUST END WITH start() - THIS BLOCKS
+        self.log.info('Ingest Server starting to listen to MQTT messages...')
+        self.start()
+
+
+    def topics(self) -> [str]:
+        """ This function must return a list of topics that you wish the server
+        to subscribe to. i.e. ['/seo/queue'] etc.
+        """
+
+        return ['/'.join(['', config.mqtt.root, 'telescope'])]
+
+
+    def process_message(self, topic: str, msg: Dict[str, str]):
+        """ This function is given a JSON dictionary message from the broker
+        and must decide how to process the message given the servers purpose. This
+        is automatically called whenever a message is received
+        """
+        # a frame has just been written (see SSHTelescope.publish), so look for it now
+        if msg.get('event') == 'exposure':
+            self.wake.set()
+
+        return
+
+    def scan_forever(self) -> None:
+        """ Scan the server for new frames every `interval` seconds, or as soon
+        as we are woken, and copy any that have finished being written.
+        """
+        last_full = 0.
+        while True:
+            full = time.time() - last_full > self.full_scan
+            try:
+                frames, now = self.scan(None if full else self.lookback)
+                if full:
+                    last_full = time.time()
+                self.ingest(frames, now, full)
+            except Exception as e:
+                self.log.warning(f'Unable to scan for new frames: {e}')
+
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def scan(self, lookback: int = None) -> Tuple[List[Tuple[str, int, float]], float]:
+        """ Return the (path, size, mtime) of every frame on the server that
+        was modified in the last `lookback` minutes (default: all frames), and
+        the time on the server. This is a single command on the server.
+        """
+        paths = ' -o '.join(f"-path '*/{directory}/*'" for directory in self.directories)
+        recent = f' -mmin -{int(lookback)}' if lookback else ''
+        command = (f'date +%s; find {shlex.quote(self.remote_root)} -type f \\( {paths} \\) '
+                   f"\\( -name '*.fits' -o -name '*.fit' \\){recent} -printf '%s %T@ %p\\n' 2>/dev/null")
+
+        exit_code, output = self.connection.run(command, timeout=60, name='ingest scan')
+
+        lines = output.splitlines()
+        try:
+            now = float(lines.pop(0))
+        except (IndexError, ValueError):
+            now = None
+
+        frames = []
+        for line in lines:
+            try:
+                size, mtime, path = line.split(' ', 2)
+                frames.append((path, int(size), float(mtime)))
+            except ValueError:
+                continue
+
+        return frames, now
+
+    def ingest(self, frames: List[Tuple[str, int, float]], now: float = None, full: bool = False) -> int:
+        """ Start copying every frame in `frames` that we haven't already copied, and
+        that hasn't changed since the last scan or was last modified `settle` seconds
+        before `now` (the time on the server). If this is a `full` scan, frames
+        that are no longer on the server are forgotten.
+
+        Returns the number of frames that were started.
+        """
+        started = 0
+        present = set()
+        for path, size, mtime in frames:
+            present.add(path)
+
+            # we only remember frames that still have to be copied
+            if not self.manifest.needed(path, size, mtime):
+                with self.active_lock:
+                    self.seen.pop(path, None)
+                continue
+
+            with self.active_lock:
+                unchanged = self.seen.get(path) == (size, mtime)
+                self.seen[path] = (size, mtime)
+
+                # the frame may still be being written
+                settled = now is not None and mtime < now - self.settle
+                if not (unchanged or settled) or path in self.active:
+                    continue
+                self.active.add(path)
+
+            self.executor.submit(self.copy, path, size, mtime)
+            started += 1
+
+        if full:
+            with self.active_lock:
+                for path in set(self.seen) - present - self.active:
+                    del self.seen[path]
+
+        return started
+
+    def local_path(self, remote: str) -> str:
+        """ Return where the frame at `remote` is copied to; the layout of
+        the data directory is kept.
+        """
+        return os.path.join(self.local_root, os.path.relpath(remote, self.remote_root))
+
+    def checksum(self, remote: str) -> str:
+        """ Return the SHA-256 of the frame at `remote`, computed on the server.
+        """
+        exit_code, output = self.connection.run(f'sha256sum {shlex.quote(remote)}', timeout=60,
+                                                name='ingest checksum')
+        if exit_code != 0 or not output.strip():
+            raise IOError(f'Unable to compute the checksum of {remote}')
+
+        return output.split()[0]
+
+    def copy(self, remote: str, size: int, mtime: float) -> bool:
+        """ Copy the frame at `remote` and verify it, resuming an earlier transfer
+        of it if possible. Returns True if the frame was copied.
+        """
+        local = self.local_path(remote)
+        try:
+            start = time.time()
+            checksum = self.checksum(remote)
+            entry = self.manifest.start(remote, local, size, mtime, checksum)
+            if entry['attempts'] >= self.max_attempts:
+                self.log.error(f'Giving up on {remote} after {entry["attempts"]} corrupt copies')
+                self.manifest.finish(remote, 'abandoned')
+                with self.active_lock:
+                    self.seen.pop(remote, None)
+                return False
+
+            copied = self.pool.get(remote, local, size=size, done=entry['chunks'],
+                                   progress=lambda offset: self.manifest.chunk(remote, offset))
+
+            # a corrupt copy is discarded, and copied again on the next scan
+            if copied != checksum:
+                self.log.warning(f'Checksum of {local} does not match {remote}. Discarding...')
+                os.remove(local)
+                self.manifest.finish(remote, 'failed')
+                with self.active_lock:
+                    self.seen.pop(remote, None)
+                return False
+
+            self.manifest.finish(remote, 'done')
+            with self.active_lock:
+                self.seen.pop(remote, None)
+            self.log.info(f'Copied {remote} ({size/1e6:.1f} MB) in {time.time() - start:.1f}s')
+            return True
+
+        except Exception as e:
+            # the chunks that were written are kept, so the next attempt resumes
+            self.log.warning(f'Unable to copy {remote}: {e}')
+            return False
+
+        finally:
+            with self.active_lock:
+                self.active.discard(remote)
+
+    def close(self):
+        """ This function is called when the server receives a shutdown
+        signal (Ctrl+C) or SIGINT signal from the OS. Use this to close
+        down open files or connections.
+        """
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        self.connection.close()
+
+        return
@@ -0,0 +1,128 @@
+""" This file implements a two-tier (memory and disk) cache for the images
+served by the ResourceServer, so that each plot is only rendered once.
+"""
+import os
+import time
+import hashlib
+import threading
+import collections
+from typing import Hashable, Optional
+
+# where rendered plots are kept between restarts
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'config', 'plots')
+
+
+class PlotCache(object):
+    """ A cache of rendered images, keyed by any hashable value.
+
+    The most recently used `size` images are kept in memory; every
+    image is also written to `directory`, so that it survives restarts
+    and can be shared between processes. Images on disk that are older
+    than `max_age` seconds are ignored, and removed by `prune`.
+    """
+
+    def __init__(self, name: str, size: int = 128, max_age: float = None,
+                 directory: str = CACHE_DIR):
+        """ Create a new cache called `name`, storing its files
+        in a subdirectory of `directory`.
+        """
+        self.size = size
+        self.max_age = max_age
+        self.directory = os.path.join(directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # the in-memory cache, from key to (image, etag), in order of use
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # the number of requests answered by memory, disk, and neither
+        self.hits = {'memory': 0, 'disk': 0, 'miss': 0}
+
+    def filename(self, key: Hashable) -> str:
+        """ Return the path of the file that stores the image for `key`.
+        """
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.png')
+
+    @staticmethod
+    def etag(image: bytes) -> str:
+        """ Return the entity tag of an image.
+        """
+        return hashlib.sha1(image).hexdigest()
+
+    def get(self, key: Hashable) -> Optional[tuple]:
+        """ Return the (image, etag) stored for `key`, or None if
+        it is not in the cache.
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+                return self.memory[key]
+
+        # try and load it from disk
+        filename = self.filename(key)
+        try:
+            if self.max_age is None or time.time() - os.path.getmtime(filename) < self.max_age:
+                with open(filename, 'rb') as f:
+                    image = f.read()
+                entry = (image, self.etag(image))
+                self.remember(key, entry)
+                with self.lock:
+                    self.hits['disk'] += 1
+                return entry
+        except OSError as _:
+            pass
+
+        with self.lock:
+            self.hits['miss'] += 1
+
+        return None
+
+    def put(self, key: Hashable, image: bytes) -> tuple:
+        """ Store `image` for `key`, and return its (image, etag).
+        """
+        entry = (image, self.etag(image))
+        self.remember(key, entry)
+
+        # write to a temporary file first so readers never see part of an image
+        filename = self.filename(key)
+        temporary = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(image)
+            os.replace(temporary, filename)
+        except OSError as _:
+            pass
+
+        return entry
+
+    def remember(self, key: Hashable, entry: tuple) -> None:
+        """ Add an entry to the in-memory cache, evicting the
+        least recently used entries if it is full.
+        """
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def prune(self) -> int:
+        """ Remove any images on disk that are older than `max_age`.
+
+        Returns the number of images that were removed.
+        """
+        if self.max_age is None:
+            return 0
+
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(filename) > self.max_age:
+                    os.remove(filename)
+                    removed += 1
+            except OSError as _:
+                pass
+
+        return removed
@@ -0,0 +1,143 @@
+""" This file implements a pool of worker processes that render the plots served
+by the ResourceServer. Matplotlib is CPU-bound and not thread-safe, so each plot
+is rendered in its own process, and the web server only waits for the PNG.
+"""
+import io
+import os
+import logging
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+
+class OverloadedException(Exception):
+    """ Raised when too many plots are already waiting to be rendered.
+    """
+    pass
+
+
+def warm() -> None:
+    """ Prepare a worker process; import matplotlib, astropy and our
+    plotting code, load the stylesheet, and draw a figure so that the
+    fonts are cached before the first request arrives.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from routines import plots
+
+    fig, ax = plt.subplots()
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def render(kind: str, target: str, **kwargs) -> Optional[bytes]:
+    """ Render a plot in a worker process and return it as PNG bytes,
+    or None if it could not be created.
+
+    Parameters
+    ----------
+    kind: str
+        'visibility' or 'preview'
+    target: str
+        The name of the target
+    """
+    import matplotlib.pyplot as plt
+    from routines import plots
+
+    if kind == 'visibility':
+        fig = plots.visibility_curve(target, logging.getLogger('resource'),
+                                     figsize=kwargs.get('figsize', (8, 4)))
+    else:
+        fig = plots.target_preview(target)
+
+    if not fig:
+        return None
+
+    img = io.BytesIO()
+    fig.savefig(img, format='png', bbox_inches='tight', transparent=(kind == 'preview'))
+    plt.close(fig)
+
+    return img.getvalue()
+
+
+class Renderer(object):
+    """ A pool of pre-warmed processes that render plots.
+
+    At most `workers` plots are rendered at once, and at most `queue_size`
+    more wait for a process; further requests raise OverloadedException
+    immediately, rather than waiting behind a long queue.
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = 16, timeout: float = 30):
+        """ Create the pool, and start and warm up every process.
+
+        Parameters
+        ----------
+        workers: int
+            The number of processes; by default, the number of cores
+        queue_size: int
+            The maximum number of plots waiting for a process
+        timeout: float
+            The time (in seconds) to wait for a plot before giving up
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.start()
+
+    def start(self) -> None:
+        """ Start (or restart) the worker processes.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                               initializer=warm)
+
+            # the pool starts its processes lazily, so give every process something to do
+            for _ in range(self.workers):
+                self.pool.submit(os.getpid)
+
+    def render(self, kind: str, target: str, **kwargs) -> Optional[bytes]:
+        """ Render a plot in the pool and return it as PNG bytes (or None).
+
+        Raises OverloadedException if the queue is full, and
+        concurrent.futures.TimeoutError if the plot takes too long.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise OverloadedException('Too many plots are waiting to be rendered')
+
+        try:
+            try:
+                future = self.pool.submit(render, kind, target, **kwargs)
+            except BrokenProcessPool as _:
+                # a worker died; start a new pool and try once more
+                self.start()
+                future = self.pool.submit(render, kind, target, **kwargs)
+        except Exception as _:
+            self.slots.release()
+            raise
+
+        # the slot is freed when the plot is done, even if we stop waiting for it
+        future.add_done_callback(lambda _: self.slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError as _:
+            future.cancel()
+            raise
+        except BrokenProcessPool as _:
+            self.start()
+            return None
+
+    def close(self) -> None:
+        """ Stop the worker processes.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
@@ -1,12 +1,18 @@
-import io
+import os
+import json
+import time
 import flask
 import base64
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from typing import Dict
-from routines import plots
+import struct
+import numpy as np
+import concurrent.futures
+import astropy.units as units
+from astropy.time import Time
+from typing import Dict, List, Tuple
+from routines import lookup, ephemeris
 from config import config
+from modules.resource.cache import PlotCache
+from modules.resource.renderer import Renderer, OverloadedException
 import logging
 import colorlog
 #from flask_cors import CORS
@@ -20,6 +26,26 @@ class ResourceServer(object):
     # logger for class
     log = None
 
+    # visibility curves are reused for this many seconds
+    bucket = 600
+
+    # how long (in seconds) clients may cache a preview
+    preview_age = 24*60*60
+
+    # the number of HTTP worker processes, and threads in each
+    http_workers = 2
+    http_threads = 8
+
+    # the maximum number of plots waiting to be rendered by each HTTP worker,
+    # and how long (in seconds) a request waits for its plot
+    render_queue = 16
+    render_timeout = 30
+
+    # the largest batch of visibility curves that we compute at once
+    max_targets = 500
+    max_hours = 72
+    max_points = 2000
+
     def __init__(self):
         """ We create the app, register routes, and runz.
         """
@@ -28,6 +54,14 @@ class ResourceServer(object):
         if not ResourceServer.log:
             ResourceServer.__init_log()
 
+        # rendered plots; visibility curves change with time, previews don't
+        self.visibility_cache = PlotCache('visibility', max_age=2*self.bucket)
+        self.preview_cache = PlotCache('preview')
+
+        # the rendering processes; these are started by each HTTP worker
+        self._renderer = None
+        self._renderer_pid = None
+
         # create the Flask app
         app = flask.Flask("Resource Server")
 
@@ -38,70 +72,250 @@ class ResourceServer(object):
         def visibility(target: str, **kwargs) -> Dict[str, str]:
             return self.visibility(target, **kwargs)
 
+        @app.route('/visibility', methods=['GET', 'POST'])
+        def visibility_batch() -> Dict[str, str]:
+            return self.visibility_batch()
+
         @app.route('/preview/<string:target>', methods=['GET'])
         def preview(target: str, **kwargs) -> Dict[str, str]:
             return self.preview(target, **kwargs)
 
+        @app.errorhandler(OverloadedException)
+        def overloaded(error):
+            response = flask.Response("{'error': 'The server is busy; try again shortly'}",
+                                      status=503, mimetype='application/json')
+            response.headers['Retry-After'] = '5'
+            return response
+
+        @app.errorhandler(concurrent.futures.TimeoutError)
+        def timeout(error):
+            return flask.Response("{'error': 'Timed out creating plot'}",
+                                  status=504, mimetype='application/json')
+
         # start it
-        app.run(host='0.0.0.0', port=config.queue.resource_port)
+        self.app = app
+        self.serve()
 
-    def make_plot_response(self, figure: matplotlib.figure.Figure, **kwargs):
-        """ Given a matplotlib figure, base64 encode the figure and
-        make the appropriate HTML response.
+    def serve(self) -> None:
+        """ Serve the app with gunicorn, using `http_workers` processes
+        with `http_threads` threads each. If gunicorn is not installed,
+        fall back to the (single process) Flask development server.
         """
-        # create bytes object to store image
-        img = io.BytesIO()
+        host, port = '0.0.0.0', config.queue.resource_port
+
+        try:
+            import gunicorn.app.base
+        except ImportError:
+            self.log.warning('gunicorn is not installed; using the Flask development server')
+            self.renderer
+            self.app.run(host=host, port=port, threaded=True)
+            return
+
+        server = self
+
+        class Application(gunicorn.app.base.BaseApplication):
+
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', server.http_workers)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('threads', server.http_threads)
+                self.cfg.set('timeout', server.render_timeout + 30)
+
+                # start the rendering processes before the worker starts any threads
+                self.cfg.set('post_fork', lambda arbiter, worker: server.renderer)
+
+            def load(self):
+                return server.app
+
+        Application().run()
+
+    @property
+    def renderer(self) -> Renderer:
+        """ The rendering processes of this HTTP worker; the cores are
+        shared between the HTTP workers.
+        """
+        if self._renderer is None or self._renderer_pid != os.getpid():
+            self._renderer_pid = os.getpid()
+            self._renderer = Renderer(workers=max(1, (os.cpu_count() or 1) // self.http_workers),
+                                      queue_size=self.render_queue, timeout=self.render_timeout)
+
+        return self._renderer
+
+    def render(self, cache: PlotCache, key, kind: str, target: str, **kwargs) -> tuple:
+        """ Return the (PNG image, etag) for `key` from `cache`, rendering
+        the plot if it is not cached. Returns None if the plot can't be made.
+        """
+        entry = cache.get(key)
+        if entry is None:
+            image = self.renderer.render(kind, target, **kwargs)
+            if not image:
+                return None
+
+            entry = cache.put(key, image)
+
+        return entry
 
-        # save the figure into bytes
-        self.log.debug('make_plot_response')
-        figure.savefig(img, format='png', bbox_inches='tight', **kwargs)
-        figure.savefig('/tmp/test.png', format='png',
-                       bbox_inches='tight', **kwargs)
-        img.seek(0)
+    def make_plot_response(self, image: bytes, etag: str, max_age: int):
+        """ Given a PNG image, make the appropriate HTML response; the image
+        is base64 encoded unless the request asks for ?format=png.
+
+        The response can be cached by the client for `max_age` seconds, and
+        is empty (304) if the client already has this image.
+        """
+        raw = flask.request.args.get('format') == 'png'
 
         # construct HTML response from image
-        response = flask.make_response(
-            base64.b64encode(img.getvalue()).decode())
+        if raw:
+            response = flask.make_response(image)
+        else:
+            response = flask.make_response(base64.b64encode(image).decode())
+            response.headers['Content-Transfer-Encoding'] = 'BASE64'
         response.headers['Content-Type'] = 'image/png'
-        response.headers['Content-Transfer-Encoding'] = 'BASE64'
+
+        # let clients cache the image, and revalidate it with If-None-Match
+        response.set_etag(etag if raw else etag + '-base64')
+        response.cache_control.public = True
+        response.cache_control.max_age = max(int(max_age), 0)
 
         # support CORS
         # response.headers['Access-Control-Allow-Origin'] = (
         #     flask.request.headers.get('ORIGIN') or 'https://queue.stoneedgeobservatory.com' or 'https://sirius.stoneedgeobservatory.com:8179/*')
 
-        # close image and figures
-        img.close()
-
-        return response
+        return response.make_conditional(flask.request)
 
     def visibility(self, target: str) -> Dict[str, str]:
         """ This endpoint produces a visibility curve (using code in /routines)
         for the object provided by 'target', and returns it to the requester.
+
+        Curves are cached for each target in `bucket` second intervals.
         """
+        figsize = (8, 4)
+        now = time.time()
+        bucket = int(now // self.bucket)
 
-        self.log.info('visibility called!')
-        fig = plots.visibility_curve(target, self.log, figsize=(8, 4))
-        self.log.debug("got past vis curve")
-        self.log.debug(fig)
-        if fig:
-            response = self.make_plot_response(fig, transparent=False)
-            plt.close(fig)
+        # remove old curves from disk when we start a new interval
+        if bucket != getattr(self, 'last_bucket', None):
+            self.last_bucket = bucket
+            self.visibility_cache.prune()
 
-            return response
+        key = (lookup.NameCache.normalize(target), bucket, figsize)
+        entry = self.render(self.visibility_cache, key, 'visibility', target, figsize=figsize)
+        if entry:
+            return self.make_plot_response(*entry, max_age=(bucket+1)*self.bucket - now)
 
         return flask.Response("{'error': 'Unable to create visibility plot'}", status=500, mimetype='application/json')
 
+    @staticmethod
+    def locate(target) -> Tuple[str, str]:
+        """ Convert a target given as a name ('M31'), a coordinate string
+        ('00:42:44 +41:16:09'), an [RA, Dec] pair or an {'ra': , 'dec': }
+        dictionary to an (RA, Dec) string pair; (None, None) if it can't be found.
+        """
+        if isinstance(target, dict):
+            return str(target.get('ra')), str(target.get('dec'))
+        if isinstance(target, (list, tuple)) and len(target) == 2:
+            return str(target[0]), str(target[1])
+        if isinstance(target, str) and ':' in target and len(target.split()) == 2:
+            return tuple(target.split())
+        try:
+            return lookup.lookup(str(target))
+        except Exception as _:
+            return None, None
+
+    def visibility_batch(self) -> Dict[str, str]:
+        """ This endpoint computes the visibility of many targets over a window,
+        so that the client can draw the curves itself.
+
+        The targets are given by a JSON body {'targets': [...], 'start': unix time,
+        'hours': 24, 'points': 288}, or by the query string of a GET
+        (?targets=M31,M42&hours=12). Everything but the targets is optional;
+        by default the window is the next 24 hours in 5 minute steps.
+
+        The response contains, for every sample time, the hours since the start
+        of the window and the altitude of the sun and, for each target, its
+        altitude, azimuth, airmass and separation from the moon (in degrees).
+        With ?format=float32, these are returned as packed little-endian float32
+        arrays, preceded by a 4-byte length and a JSON header that describes them.
+        """
+        request = flask.request.get_json(silent=True) or {}
+        args = flask.request.args
+        targets = request.get('targets') or [target for target in args.get('targets', '').split(',') if target]
+
+        try:
+            hours = float(request.get('hours', args.get('hours', 24)))
+            npoints = int(request.get('points', args.get('points', 288)))
+            start = request.get('start', args.get('start'))
+            start = None if start is None else Time(float(start), format='unix')
+        except (TypeError, ValueError) as _:
+            return flask.Response("{'error': 'Invalid visibility window'}", status=400, mimetype='application/json')
+
+        if not targets or len(targets) > self.max_targets:
+            return flask.Response(f"{{'error': 'Between 1 and {self.max_targets} targets are required'}}",
+                                  status=400, mimetype='application/json')
+        if not (0 < hours <= self.max_hours and 2 <= npoints <= self.max_points):
+            return flask.Response("{'error': 'Invalid visibility window'}", status=400, mimetype='application/json')
+
+        # the default window is shared with the visibility plots
+        if start is None and hours == 24 and npoints == 288:
+            window = ephemeris.window(hours=24, npoints=288, bucket=self.bucket)
+            max_age = window.start.unix + self.bucket - time.time()
+        else:
+            start = start or Time.now()
+            window = ephemeris.NightEphemeris(start, start + hours*units.hour, npoints=npoints)
+            max_age = 0
+
+        # locate every target, and transform them all at once
+        points = [self.locate(target) for target in targets]
+        window.add([point for point in points if point[0] and point[1]])
+        rows = [window.rows.get(window.key(*point)) if point[0] and point[1] else None
+                for point in points]
+        found = [row for row in rows if row is not None]
+        names = [target if isinstance(target, str) else json.dumps(target)
+                 for target, row in zip(targets, rows) if row is not None]
+        missing = [target for target, row in zip(targets, rows) if row is None]
+
+        # the arrays for the found targets
+        found = np.array(found, dtype=int)
+        fields = {'alt': window.alt[found], 'az': window.az[found], 'airmass': window.airmass[found],
+                  'moon_separation': window.moon_separation(found)}
+        offsets = ((window.times - window.start).to_value('hr')).astype(np.float32)
+
+        if args.get('format') == 'float32':
+            header = json.dumps({'start': window.start.unix, 'points': len(offsets), 'targets': names,
+                                 'missing': missing, 'fields': list(fields),
+                                 'layout': ['hours', 'sun_alt', 'fields x targets x points']}).encode()
+            body = b''.join([struct.pack('<I', len(header)), header,
+                             offsets.astype('<f4').tobytes(), window.sun_alt.astype('<f4').tobytes()] +
+                            [np.asarray(values, dtype='<f4').tobytes() for values in fields.values()])
+            response = flask.make_response(body)
+            response.headers['Content-Type'] = 'application/octet-stream'
+        else:
+            def values(array: np.ndarray) -> List:
+                # JSON has no infinity, so use null (i.e. the airmass below the horizon)
+                array = np.round(array.astype(float), 3)
+                return np.where(np.isfinite(array), array, None).tolist()
+
+            response = flask.make_response(json.dumps(
+                {'start': window.start.unix, 'hours': values(offsets),
+                 'sun_alt': values(window.sun_alt), 'missing': missing,
+                 'targets': [dict({'target': name}, **{field: values(array[i]) for field, array in fields.items()})
+                             for i, name in enumerate(names)]}, separators=(',', ':')))
+            response.headers['Content-Type'] = 'application/json'
+
+        response.cache_control.public = True
+        response.cache_control.max_age = max(int(max_age), 0)
+
+        return response
+
     def preview(self, target: str) -> Dict[str, str]:
         """ This endpoint uses astroplan to produce a preview image
 
         """
-        fig = plots.target_preview(target)
-        
-        if fig:
-            response = self.make_plot_response(fig, transparent=True)
-            plt.close(fig)
-
-            return response
+        key = lookup.NameCache.normalize(target)
+        entry = self.render(self.preview_cache, key, 'preview', target)
+        if entry:
+            return self.make_plot_response(*entry, max_age=self.preview_age)
 
         return flask.Response("{'error': 'Unable to create target preview'}", status=500, mimetype='application/json')
 
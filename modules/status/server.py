@@ -3,7 +3,8 @@ import paramiko
 import logging
 import colorlog
 import scp as SCP
-from imqueue import database
+import threading
+from imqueue import database, buffer
 from typing import Dict
 from config import config
 from modules.template import base
@@ -14,6 +15,9 @@ class StatusServer(base.MQTTServer):
     the webapp to get access to Telescope operation.
     """
 
+    # the fields of the telescope document that we keep track of
+    fields = ['slit', 'status', 'filter', 'focus', 'location', 'lock', 'wait', 'weather', 'progress']
+
     def __init__(self):
         """
         We initialize the super class (which handles all MQTT configuration)
@@ -28,6 +32,13 @@ class StatusServer(base.MQTTServer):
         # get a connection to the database
         self.db = database.Database()
 
+        # our state of each telescope, by name; this is authoritative
+        self.state: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+        # changes to the state are written to the database in the background
+        self.buffer = buffer.WriteBuffer(self.db.telescopes, interval=1., log=self.log)
+
         # MUST END WITH start() - THIS BLOCKS
         self.log.info('Status Server starting to listen to MQTT messages...')
         self.start()
@@ -54,78 +65,98 @@ class StatusServer(base.MQTTServer):
     def handle_telescope_msg(self, msg: Dict[str, str]):
         """ Handle and process messages received on the telescopee
         topic.
+
+        Each event is applied to our in-memory state of the telescope;
+        the fields that actually changed are written to the database
+        in the background, and a snapshot of the new state is published.
         """
         event = msg.get('event')
-        name = config.general.name # telescope name
+        name = msg.get('telescope') or config.general.name # telescope name
+        state = self.get_state(name)
+
         if event == 'opening':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'slit': 'opening', 'status': 'opening'}})
+            changes = {'slit': 'opening', 'status': 'opening'}
         elif event == 'openup':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'slit': 'open', 'status': 'open'}})
+            changes = {'slit': 'open', 'status': 'open'}
         elif event == 'closing':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'slit': 'closing', 'status': 'closing'}})
+            changes = {'slit': 'closing', 'status': 'closing'}
         elif event == 'closedown':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'slit': 'closed', 'status': 'closed'}})
+            changes = {'slit': 'closed', 'status': 'closed'}
         elif event == 'filterchange':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'filter': 'changing'}})
+            changes = {'filter': 'changing'}
         elif event == 'filter':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'filter': msg.get('filter')}})
+            changes = {'filter': msg.get('filter')}
         elif event == 'focus':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'focus': msg.get('focus')}})
+            changes = {'focus': msg.get('focus')}
         elif event == 'slew':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'location': msg.get('location'),
-                                                    'status': 'slewing'}})
+            changes = {'location': msg.get('location'), 'status': 'slewing'}
         elif event == 'point':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'location': msg.get('location'),
-                                                    'location': 'open'}})
+            changes = {'location': msg.get('location'), 'status': 'open'}
         elif event == 'lock':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'lock': msg.get('username')}})
+            changes = {'lock': msg.get('username')}
         elif event == 'unlock':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'lock': None}})
+            changes = {'lock': None}
         elif event == 'wait':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'wait': msg.get('wait'),
-                                                    'status': 'sleeping'}})
+            changes = {'wait': msg.get('wait'), 'status': 'sleeping'}
         elif event == 'wake':
-            slit = self.db.telescopes.find_one({'name': name}).get('slit')
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'wait': 0,
-                                                    'status': slit}})
+            # we already know the state of the slit
+            changes = {'wait': 0, 'status': state.get('slit')}
         elif event == 'weather':
-            weather = {'sun': msg.get('sun'), 'moon': msg.get('moon'),
-                       'rain': msg.get('rain'), 'cloud': msg.get('cloud'),
-                       'dew': msg.get('dew')}
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'weather': weather}})
+            changes = {'weather': {'sun': msg.get('sun'), 'moon': msg.get('moon'),
+                                   'rain': msg.get('rain'), 'cloud': msg.get('cloud'),
+                                   'dew': msg.get('dew')}}
         elif event == 'exposing':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'status': 'exposing',
-                                                    'progress': 0}})
+            changes = {'status': 'exposing', 'progress': 0}
         elif event == 'exposure':
-            self.db.telescopes.update_one({'name': name},
-                                          {'$set': {'status': 'open',
-                                                    'progress': 100}})
+            changes = {'status': 'open', 'progress': 100}
         else:
             self.log.warning('Unknown telescope event message')
+            return
+
+        self.apply(name, changes)
 
         return
 
+    def get_state(self, name: str) -> Dict:
+        """ Return our state of the telescope `name`, loading
+        it from the database the first time it is used.
+        """
+        if name not in self.state:
+            document = self.db.telescopes.find_one({'name': name}, {field: 1 for field in self.fields})
+            self.state[name] = {field: (document or {}).get(field) for field in self.fields}
+
+        return self.state[name]
+
+    def apply(self, name: str, changes: Dict) -> Dict:
+        """ Apply `changes` to the state of the telescope `name`, save the fields that
+        changed, and publish a snapshot of the state if anything changed.
+
+        Returns the fields that changed.
+        """
+        with self.lock:
+            state = self.get_state(name)
+            changed = {field: value for field, value in changes.items() if state.get(field) != value}
+            state.update(changed)
+            snapshot = dict(state, name=name)
+
+        if changed:
+            # state transitions are written immediately, everything else is batched
+            self.buffer.set({'name': name}, changed,
+                            flush=not {'status', 'slit', 'lock'}.isdisjoint(changed))
+
+            # consumers can read the retained snapshot instead of the database
+            self.publish('/'.join(['', config.mqtt.root, 'telescope', name, 'state']), snapshot,
+                         retain=True)
+
+        return changed
+
     def close(self):
         """ This function is called when the server receives a shutdown
         signal (Ctrl+C) or SIGINT signal from the OS. Use this to close
         down open files or connections.
         """
 
-        # USER [OPTIONAL]
+        # write any changes that haven't been saved
+        self.buffer.close()
 
         return
@@ -3,8 +3,11 @@ import os
 import atexit
 import json
 import time
+import queue
 import logging
 import colorlog
+import threading
+import zlib
 import paho.mqtt.client as mqtt
 from typing import List, Dict
 from config import config
@@ -19,6 +22,17 @@ class MQTTServer(object):
     # logger
     log = None
 
+    # the number of threads processing messages; messages on the same
+    # topic are always processed by the same thread, in order
+    workers: int = 4
+
+    # the maximum number of messages waiting for each thread
+    queue_size: int = 1000
+
+    # what to do with a new message when its queue is full; 'block' (wait, and so
+    # slow down the broker connection), 'drop_newest' or 'drop_oldest'
+    policy: str = 'block'
+
     def __init__(self, name: str):
         """ This creates a new server listening on a user-defined set of topics
         on the MQTT broker specified in config
@@ -32,6 +46,19 @@ class MQTTServer(object):
         self.client = self.__connect()
         self.log.info(f'Creating new {name}...')
 
+        # message statistics
+        self.stats = {'received': 0, 'processed': 0, 'dropped': 0, 'errors': 0,
+                      'latency': 0., 'max_latency': 0., 'wait': 0.}
+        self.stats_lock = threading.Lock()
+
+        # start the threads that process messages
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.threads = [threading.Thread(target=self.__work, args=(q,), daemon=True,
+                                         name=f'{name} worker {i}')
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
         # register atexit handler
         atexit.register(self.__handle_exit)
 
@@ -65,11 +92,12 @@ class MQTTServer(object):
         return
 
 
-    def publish(self, topic: str, message: Dict) -> True:
+    def publish(self, topic: str, message: Dict, retain: bool = False) -> True:
         """ This method converts the message to JSON and publishes
-        it on the topic given by topic.
+        it on the topic given by topic. If retain is True, the broker
+        keeps the message and sends it to any new subscribers.
         """
-        self.client.publish(topic, json.dumps(message))
+        self.client.publish(topic, json.dumps(message, separators=(',', ':')), retain=retain)
         return True
 
 
@@ -101,22 +129,99 @@ class MQTTServer(object):
         on the specified port until it receives a request
         """
         self.client.on_message = self.__process_message
-        for topic in self.topics():
-            self.client.subscribe(topic)
-            self.client.loop_forever()
+        self.client.on_connect = self.__subscribe
+        self.client.loop_forever()
+
+
+    def metrics(self) -> Dict:
+        """ Return the message statistics of this server; the number of messages
+        received, processed, dropped and that raised errors, the mean and maximum
+        time (in seconds) spent in process_message, the mean time spent waiting
+        in the queue, and the number of messages currently waiting.
+        """
+        with self.stats_lock:
+            stats = dict(self.stats)
+
+        processed = max(stats['processed'], 1)
+        return {'received': stats['received'], 'processed': stats['processed'],
+                'dropped': stats['dropped'], 'errors': stats['errors'],
+                'latency': stats['latency']/processed, 'max_latency': stats['max_latency'],
+                'wait': stats['wait']/processed, 'depth': sum(q.qsize() for q in self.queues)}
+
+
+    def __subscribe(self, client, userdata, flags, rc):
+        """ Subscribe to every topic at once; this is called whenever
+        we (re)connect to the broker.
+        """
+        topics = self.topics()
+        if topics:
+            self.client.subscribe([(topic, 0) for topic in topics])
+            self.log.info(f'Subscribed to {", ".join(topics)}')
 
 
     def __process_message(self, client, userdata, msg):
-        """ This function is called whenever a message is received.
+        """ This function is called by the MQTT client whenever a message is
+        received; the message is queued for the thread that handles its topic.
         """
-        topic = msg.topic
+        with self.stats_lock:
+            self.stats['received'] += 1
+
+        # messages on the same topic always go to the same queue
+        q = self.queues[zlib.crc32(msg.topic.encode()) % len(self.queues)]
+        item = (msg.topic, msg.payload, time.time())
+
+        if self.policy == 'block':
+            q.put(item)
+            return
+
         try:
-            payload = json.loads(msg.payload.decode())
-            self.process_message(topic, payload)
-        except json.decoder.JSONDecodeError:
-            self.log.warning(f'Invalid Message: \'{msg.payload.decode()}\'')
-        except Exception as e:
-            self.log.error(f'An error ocurred during processing of a message {e}')
+            q.put_nowait(item)
+        except queue.Full:
+            if self.policy == 'drop_oldest':
+                try:
+                    q.get_nowait()
+                    q.task_done()
+                except queue.Empty:
+                    pass
+                q.put_nowait(item)
+            with self.stats_lock:
+                self.stats['dropped'] += 1
+                dropped = self.stats['dropped']
+            if dropped == 1 or dropped % 100 == 0:
+                self.log.warning(f'Message queue is full; {dropped} messages dropped so far')
+
+
+    def __work(self, q: queue.Queue):
+        """ Process the messages in a queue, one at a time, forever.
+        """
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+
+            topic, payload, received = item
+            start = time.time()
+            error = False
+            try:
+                self.process_message(topic, json.loads(payload.decode()))
+            except json.decoder.JSONDecodeError:
+                self.log.warning(f'Invalid Message: \'{payload.decode(errors="replace")}\'')
+                error = True
+            except Exception as e:
+                self.log.error(f'An error ocurred during processing of a message {e}')
+                error = True
+            finally:
+                q.task_done()
+
+            # record how long this took
+            latency = time.time() - start
+            with self.stats_lock:
+                self.stats['processed'] += 1
+                self.stats['errors'] += error
+                self.stats['latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+                self.stats['wait'] += start - received
 
 
     def __handle_exit(self, *_):
@@ -127,6 +232,15 @@ class MQTTServer(object):
 
         try:
 
+            # let the workers finish the messages that they have
+            for q in self.queues:
+                try:
+                    q.put(None, timeout=1)
+                except queue.Full:
+                    pass
+            for thread in self.threads:
+                thread.join(timeout=5)
+
             # call user close function
             self.close()
 
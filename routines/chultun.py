@@ -30,6 +30,7 @@ import urllib2
 import ch
 import glob2
 import json
+from routines.ephemeris import NightEphemeris
 
 # set up logger
 logger = log.get_logger('chultun.log')
@@ -1103,6 +1104,7 @@ class Scheduler():
 
     sunset_time = None  # nearest sunset
     sunrise_time = None  # next sunrise
+    ephemeris = None  # NightEphemeris between sunset and sunrise
 
     # max_sun_alt = -12 #what defines dark? (deg)
     # min_target_alt = 30 #how low can you go? (deg)
@@ -1132,6 +1134,13 @@ class Scheduler():
         logger.debug('The nearest sunset is %s. The next sunrise is %s.' %
                      (self.sunset_time.iso, self.sunrise_time.iso))
 
+        # alt/az of every target between sunset and sunrise, shared by whatsNext,
+        # whatsHighest and whatsInBetween
+        observatory_location = EarthLocation(
+            lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
+        self.ephemeris = NightEphemeris(
+            self.sunset_time, self.sunrise_time, observatory_location)
+
         # add observations if provided
         if observations != None:
             self.addObservations(observations)
@@ -1156,23 +1165,13 @@ class Scheduler():
         # temp var to hold obs info
         obs = {'time': [], 'id': []}
 
-        # init observatory location
-        observatory_location = EarthLocation(
-            lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
+        # times between now (or sunset, if later) and sunrise
+        remaining = self.ephemeris.remaining()
+        times = self.ephemeris.times[remaining]
 
-        # build alt-az coordinate frame for observatory over next ? hours (e.g., nearest sunset to next sunrise)
-        # start time is sunset or current time, if later...
-        now = Time.now()
-        if (now > self.sunset_time):
-            obs_time = Time.now()
-        else:
-            obs_time = self.sunset_time
-        delta_obs_time = np.linspace(
-            0, (self.sunrise_time-obs_time).sec/3600., 1000)*u.hour
-        # array of times between sunset and sunrise
-        times = obs_time + delta_obs_time
-        # celestial frame for this observatory over times
-        frame = AltAz(obstime=times, location=observatory_location)
+        # add all active targets to the ephemeris in one transform
+        self.ephemeris.add([(observation.target.getRa(), observation.target.getDec())
+                            for observation in self.observations if observation.active])
 
         # loop thru observations, suggest the next best target based on time of max alt.
         for observation in self.observations:
@@ -1189,31 +1188,27 @@ class Scheduler():
                              observation.target.getName())
                 continue
 
-            # build target altaz relative to observatory
-            target_ra = observation.target.getRa()
-            target_dec = observation.target.getDec()
-            input_coordinates = target_ra + " " + target_dec
-            try:
-                target_coordinates = SkyCoord(
-                    input_coordinates, unit=(u.hourangle, u.deg))
-            except:
+            # target altitude relative to observatory
+            target_alt = self.ephemeris.altitude(
+                observation.target.getRa(), observation.target.getDec())
+            if target_alt is None or len(times) == 0:
                 continue
-            target_altaz = target_coordinates.transform_to(frame)
+            target_alt = target_alt[remaining]*u.degree
 
             # when is target highest *and* above minimum altitude?
             # when is it above min_obs_alt?
             valid_alt_times = times[np.where(
-                target_altaz.alt >= observation.min_obs_alt*u.degree)]
+                target_alt >= observation.min_obs_alt*u.degree)]
             # when does the max alt occur?
             if len(valid_alt_times) > 0:
                 obs['id'].append(observation.id)
                 # min time is the selection criteria
-                obs['time'].append(times[np.argmax(target_altaz.alt)])
+                obs['time'].append(times[np.argmax(target_alt)])
                 # set min and max obs times
                 observation.min_obs_time = Time(
-                    np.min(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.min(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
                 observation.max_obs_time = Time(
-                    np.max(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.max(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
 
         # get earliest max alt. from valid targets
         if len(obs['time']) > 0:
@@ -1235,23 +1230,13 @@ class Scheduler():
         # temp var to hold obs info
         obs = {'time': [], 'delta_time': [], 'id': []}
 
-        # init observatory location
-        observatory_location = EarthLocation(
-            lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
+        # times between now (or sunset, if later) and sunrise
+        remaining = self.ephemeris.remaining()
+        times = self.ephemeris.times[remaining]
 
-        # build alt-az coordinate frame for observatory over next ? hours (e.g., nearest sunset to next sunrise)
-        # start time is sunset or current time, if later...
-        now = Time.now()
-        if (now > self.sunset_time):
-            obs_time = Time.now()
-        else:
-            obs_time = self.sunset_time
-        delta_obs_time = np.linspace(
-            0, (self.sunrise_time-obs_time).sec/3600., 1000)*u.hour
-        # array of times between sunset and sunrise
-        times = obs_time + delta_obs_time
-        # celestial frame for this observatory over times
-        frame = AltAz(obstime=times, location=observatory_location)
+        # add all active targets to the ephemeris in one transform
+        self.ephemeris.add([(observation.target.getRa(), observation.target.getDec())
+                            for observation in self.observations if observation.active])
 
         # loop thru observations, suggest the next best target based on time of max alt.
         for observation in self.observations:
@@ -1268,34 +1253,30 @@ class Scheduler():
                              observation.target.getName())
                 continue
 
-            # build target altaz relative to observatory
-            target_ra = observation.target.getRa()
-            target_dec = observation.target.getDec()
-            input_coordinates = target_ra + " " + target_dec
-            try:
-                target_coordinates = SkyCoord(
-                    input_coordinates, unit=(u.hourangle, u.deg))
-            except:
+            # target altitude relative to observatory
+            target_alt = self.ephemeris.altitude(
+                observation.target.getRa(), observation.target.getDec())
+            if target_alt is None or len(times) == 0:
                 continue
-            target_altaz = target_coordinates.transform_to(frame)
+            target_alt = target_alt[remaining]*u.degree
 
             # when is target highest *and* above minimum altitude?
             # when is it above min_obs_alt?
             valid_alt_times = times[np.where(
-                target_altaz.alt >= observation.min_obs_alt*u.degree)]
+                target_alt >= observation.min_obs_alt*u.degree)]
             # when does the max alt occur?
             if len(valid_alt_times) > 0:
                 obs['id'].append(observation.id)
                 # min time is the selection criteria
-                obs['time'].append(times[np.argmax(target_altaz.alt)])
-                delta_time = times[np.argmax(target_altaz.alt)]-Time.now()
+                obs['time'].append(times[np.argmax(target_alt)])
+                delta_time = times[np.argmax(target_alt)]-Time.now()
                 delta_time = abs(delta_time.sec)
                 obs['delta_time'].append(delta_time)
                 # set min and max obs times
                 observation.min_obs_time = Time(
-                    np.min(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.min(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
                 observation.max_obs_time = Time(
-                    np.max(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.max(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
 
         # get earliest max alt. from valid targets
         if len(obs['time']) > 0:
@@ -1317,23 +1298,13 @@ class Scheduler():
         # temp var to hold obs info
         obs = {'time': [], 'id': []}
 
-        # init observatory location
-        observatory_location = EarthLocation(
-            lat=self.observatory.latitude*u.deg, lon=self.observatory.longitude*u.deg, height=self.observatory.altitude*u.m)
+        # times between now (or sunset, if later) and sunrise
+        remaining = self.ephemeris.remaining()
+        times = self.ephemeris.times[remaining]
 
-        # build alt-az coordinate frame for observatory over next ? hours (e.g., nearest sunset to next sunrise)
-        # start time is sunset or current time, if later...
-        now = Time.now()
-        if (now > self.sunset_time):
-            obs_time = Time.now()
-        else:
-            obs_time = self.sunset_time
-        delta_obs_time = np.linspace(
-            0, (self.sunrise_time-obs_time).sec/3600., 1000)*u.hour
-        # array of times between sunset and sunrise
-        times = obs_time + delta_obs_time
-        # celestial frame for this observatory over times
-        frame = AltAz(obstime=times, location=observatory_location)
+        # add all active targets to the ephemeris in one transform
+        self.ephemeris.add([(observation.target.getRa(), observation.target.getDec())
+                            for observation in self.observations if observation.active])
 
         # loop thru observations, suggest the next best target based on time of max alt.
         for observation in self.observations:
@@ -1350,34 +1321,30 @@ class Scheduler():
                              observation.target.getName())
                 continue
 
-            # build target altaz relative to observatory
-            target_ra = observation.target.getRa()
-            target_dec = observation.target.getDec()
-            input_coordinates = target_ra + " " + target_dec
-            try:
-                target_coordinates = SkyCoord(
-                    input_coordinates, unit=(u.hourangle, u.deg))
-            except:
+            # target altitude relative to observatory
+            target_alt = self.ephemeris.altitude(
+                observation.target.getRa(), observation.target.getDec())
+            if target_alt is None or len(times) == 0:
                 continue
-            target_altaz = target_coordinates.transform_to(frame)
+            target_alt = target_alt[remaining]*u.degree
 
             # when is target above minimum altitude?
             # when is it above min_obs_alt?
             valid_alt_times = times[np.where(
-                target_altaz.alt >= observation.min_obs_alt*u.degree)]
+                target_alt >= observation.min_obs_alt*u.degree)]
             # when does the max alt occur?
             if len(valid_alt_times) > 0:
                 # set min and max obs times
                 observation.min_obs_time = Time(
-                    np.min(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.min(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
                 observation.max_obs_time = Time(
-                    np.max(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.max(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
                 observation.max_alt_time = Time(
-                    times[np.argmax(target_altaz.alt)])
+                    times[np.argmax(target_alt)])
                 obs['id'].append(observation.id)
                 # remember the end time too
                 obs['time'].append(
-                    np.max(times[np.where(target_altaz.alt > observation.min_obs_alt*u.degree)]))
+                    np.max(times[np.where(target_alt > observation.min_obs_alt*u.degree)]))
 
         # get earliest max. time from valid targets
         if len(obs) > 0:
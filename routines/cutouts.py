@@ -0,0 +1,167 @@
+""" This file provides a local store of survey cutouts (i.e. DSS images) around
+targets, so that finder images can be drawn without downloading a new cutout
+from SkyView for every request, and without a network once a cutout is cached.
+"""
+import os
+import threading
+import numpy as np
+import astropy.units as units
+import astropy.io.fits as fits
+from astropy.coordinates import SkyCoord, Angle
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional
+
+# where we keep downloaded cutouts
+CUTOUT_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'cutouts')
+
+# the survey and field of view (radius, in arcminutes) of our finder images
+SURVEY = 'DSS'
+FOV = 26.
+
+# the fraction of the field of view that positions are rounded to; a target
+# within this of a cached cutout uses that cutout
+GRID = 0.1
+
+# only one thread downloads a given cutout
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def key(ra: float, dec: float, fov: float = FOV, survey: str = SURVEY) -> Tuple[float, float, float, str]:
+    """ Return the key of the cutout around (ra, dec), in degrees; the position
+    is rounded to a grid of `GRID` times the field of view.
+    """
+    step = GRID*fov/60.
+    return (round(round(ra/step)*step % 360, 6), round(round(dec/step)*step, 6), fov, survey)
+
+
+def filename(ra: float, dec: float, fov: float = FOV, survey: str = SURVEY) -> str:
+    """ Return the path of the cached cutout around (ra, dec), in degrees.
+    """
+    ra, dec, fov, survey = key(ra, dec, fov, survey)
+    return os.path.join(CUTOUT_DIR, survey.replace(' ', '_'), f'{fov:g}', f'{ra:.6f}{dec:+.6f}.fits')
+
+
+def parse(ra: str, dec: str) -> Tuple[float, float]:
+    """ Convert an (RA, Dec) string pair of the form ('hh:mm:ss', 'dd:mm:ss')
+    to degrees.
+    """
+    return Angle(ra, unit=units.hourangle).degree, Angle(dec, unit=units.deg).degree
+
+
+def download(ra: float, dec: float, fov: float = FOV, survey: str = SURVEY) -> Optional[str]:
+    """ Download the cutout around (ra, dec), in degrees, from SkyView into the
+    store, unless it is already there.
+
+    Returns the path of the cutout, or None if it could not be downloaded.
+    """
+    path = filename(ra, dec, fov, survey)
+    if os.path.exists(path):
+        return path
+
+    with _locks_lock:
+        lock = _locks.setdefault(path, threading.Lock())
+
+    with lock:
+        # another thread may have just downloaded it
+        if os.path.exists(path):
+            return path
+
+        from astroquery.skyview import SkyView
+
+        # the cutout is centered on the grid point, so it is shared by nearby targets
+        center_ra, center_dec = key(ra, dec, fov, survey)[:2]
+        try:
+            hdu = SkyView.get_images(position=SkyCoord(center_ra*units.deg, center_dec*units.deg),
+                                     coordinates='icrs', survey=survey, radius=fov*units.arcmin)[0][0]
+        except Exception as _:
+            return None
+
+        # write to a temporary file first so readers never see part of a cutout
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            hdu.writeto(temporary, overwrite=True)
+            os.replace(temporary, path)
+        except Exception as _:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return None
+
+    return path
+
+
+def load(ra: float, dec: float, fov: float = FOV, survey: str = SURVEY,
+         fetch: bool = True) -> Optional[np.ndarray]:
+    """ Return the image of the cutout around (ra, dec), in degrees, from the
+    store; if it is not cached and `fetch` is True, it is downloaded first.
+
+    Returns None if the cutout is not available.
+    """
+    path = filename(ra, dec, fov, survey)
+    if not os.path.exists(path) and not (fetch and download(ra, dec, fov, survey)):
+        return None
+
+    try:
+        return np.asarray(fits.getdata(path, memmap=False), dtype=np.float32)
+    except Exception as _:
+        return None
+
+
+def render(image: np.ndarray, ax) -> None:
+    """ Draw a cutout on `ax`, with a logarithmic stretch between the
+    1st and 99.5th percentiles.
+    """
+    image = np.nan_to_num(image, nan=np.nanmin(image))
+    low, high = np.percentile(image, [1, 99.5])
+    image = np.log10(1 + 1000*np.clip((image - low)/max(high - low, 1e-12), 0, 1))
+    ax.imshow(image, origin='lower', cmap='Greys', interpolation='nearest')
+
+
+def fetch(ra: float, dec: float, fov: float = FOV, survey: str = SURVEY) -> Optional[str]:
+    """ Download a cutout like `download`, but return None instead of raising on
+    any error, so that one bad cutout can't stop a prefetch.
+    """
+    try:
+        return download(ra, dec, fov, survey)
+    except Exception as _:
+        return None
+
+
+def prefetch(points: List[Tuple[str, str]], fov: float = FOV, survey: str = SURVEY,
+             workers: int = 4) -> int:
+    """ Download the cutouts around a list of (RA, Dec) string pairs concurrently,
+    so that later finder images are drawn from the store.
+
+    Parameters
+    ----------
+    points: List[Tuple[str, str]]
+        The positions of the targets; positions that can't be parsed are skipped
+    fov: float
+        The field of view (radius, in arcminutes) of the cutouts
+    survey: str
+        The SkyView survey to use
+    workers: int
+        The maximum number of concurrent downloads
+
+    Returns
+    -------
+    count: int
+        The number of cutouts that are now in the store
+    """
+    # only fetch each cutout once
+    positions = {}
+    for ra, dec in points:
+        try:
+            position = parse(ra, dec)
+        except Exception as _:
+            continue
+        positions.setdefault(filename(*position, fov, survey), position)
+
+    if not positions:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(positions)))) as pool:
+        paths = list(pool.map(lambda position: fetch(*position, fov, survey), positions.values()))
+
+    return sum(path is not None for path in paths)
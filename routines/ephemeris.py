@@ -0,0 +1,279 @@
+""" This file provides a shared ephemeris for the current night. The altitude,
+azimuth and airmass of every pending target are computed over a common grid of
+times in a single vectorized transform, and then reused by every scheduler.
+Ephemerides over fixed windows (i.e. the next 24 hours) are shared in the same
+way by the plotting code.
+"""
+import threading
+import numpy as np
+import astropy.units as units
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, AltAz, Angle, SkyCoord, get_sun, get_body
+from astroplan import Observer, moon_illumination
+from config import config
+from typing import List, Tuple
+
+
+class NightEphemeris(object):
+    """ This class stores the alt/az/airmass of a set of targets sampled
+    over a fixed grid of times (usually sunset to sunrise).
+
+    All values are stored as (targets x times) float32 arrays. Targets are
+    identified by their (RA, Dec) string pair, so observations of the same
+    target share one row. New targets can be added at any time; only the
+    new targets are transformed.
+    """
+
+    def __init__(self, start: Time, end: Time, location: EarthLocation = None,
+                 npoints: int = 1000):
+        """ Create a new ephemeris sampling `npoints` times between `start` and `end`.
+
+        Parameters
+        ----------
+        start: Time
+            The first sample time (usually sunset)
+        end: Time
+            The last sample time (usually sunrise)
+        location: EarthLocation
+            The location of the observatory; defaults to the location in config
+        npoints: int
+            The number of samples in the time grid
+        """
+        # location of observatory
+        self.location = location if location is not None else \
+            EarthLocation(lat=config.general.latitude*units.deg,
+                          lon=config.general.longitude*units.deg,
+                          height=config.general.altitude*units.m)
+
+        # build the shared time grid and alt-az frame
+        self.start = start
+        self.end = end
+        self.times = start + np.linspace(0, (end - start).sec, npoints)*units.second
+        self.jd = self.times.jd
+        self.frame = AltAz(obstime=self.times, location=self.location)
+
+        # the sun is the same for every target
+        self.sun_alt = get_sun(self.times).transform_to(self.frame).alt.deg.astype(np.float32)
+
+        # as is the moon
+        moon = get_body('moon', self.times, self.location).transform_to(self.frame)
+        self.moon_alt = moon.alt.deg.astype(np.float32)
+        self.moon_az = moon.az.deg.astype(np.float32)
+        self.moon_illumination = moon_illumination(self.times).astype(np.float32)
+
+        # the local sidereal time (in hours) at each sample time
+        self.lst = self.times.sidereal_time('mean', longitude=self.location.lon).hour
+
+        # map from (RA, Dec) to the row of that target
+        self.rows = {}
+
+        # the RA (in degrees) of each target
+        self.ra = np.empty(0)
+
+        # the (targets x times) arrays
+        self.alt = np.empty((0, npoints), dtype=np.float32)
+        self.az = np.empty((0, npoints), dtype=np.float32)
+        self.airmass = np.empty((0, npoints), dtype=np.float32)
+
+        # the executor and servers may share one ephemeris
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(ra: str, dec: str) -> Tuple[str, str]:
+        """ Return the key used to identify the target at (ra, dec).
+        """
+        return (str(ra).strip(), str(dec).strip())
+
+    def add(self, points: List[Tuple[str, str]]) -> int:
+        """ Add the targets given by a list of (RA, Dec) string pairs, of the form
+        ('hh:mm:ss', 'dd:mm:ss'), to the ephemeris.
+
+        Targets that are already present, or whose coordinates cannot be
+        parsed, are skipped. All new targets are transformed at once.
+
+        Returns the number of targets that were added.
+        """
+        with self.lock:
+
+            # parse the coordinates of any targets we haven't seen before
+            keys, ras, decs = [], [], []
+            for ra, dec in points:
+                key = self.key(ra, dec)
+                if key in self.rows or key in keys:
+                    continue
+                try:
+                    ras.append(Angle(key[0], unit=units.hourangle).degree)
+                    decs.append(Angle(key[1], unit=units.deg).degree)
+                    keys.append(key)
+                except Exception as e:
+                    continue
+
+            if not keys:
+                return 0
+
+            # transform every new target at every sample time in one go
+            coords = SkyCoord(ra=np.array(ras)[:, None]*units.deg,
+                              dec=np.array(decs)[:, None]*units.deg)
+            altaz = coords.transform_to(self.frame)
+            alt = altaz.alt.deg.astype(np.float32)
+            az = altaz.az.deg.astype(np.float32)
+
+            # plane-parallel airmass; infinite when below the horizon
+            with np.errstate(divide='ignore'):
+                airmass = np.where(alt > 0, 1/np.sin(np.radians(alt)), np.inf).astype(np.float32)
+
+            # and append them to the arrays
+            for key in keys:
+                self.rows[key] = len(self.rows)
+            self.alt = np.vstack([self.alt, alt])
+            self.az = np.vstack([self.az, az])
+            self.airmass = np.vstack([self.airmass, airmass])
+            self.ra = np.concatenate([self.ra, ras])
+
+            return len(keys)
+
+    def row(self, ra: str, dec: str) -> int:
+        """ Return the row of the target at (ra, dec), adding it if necessary.
+
+        Returns None if the coordinates cannot be parsed.
+        """
+        key = self.key(ra, dec)
+        if key not in self.rows:
+            self.add([key])
+
+        return self.rows.get(key)
+
+    def altitude(self, ra: str, dec: str) -> np.ndarray:
+        """ Return the altitude (in degrees) of the target at (ra, dec)
+        at every sample time.
+        """
+        row = self.row(ra, dec)
+        return None if row is None else self.alt[row]
+
+    def azimuth(self, ra: str, dec: str) -> np.ndarray:
+        """ Return the azimuth (in degrees) of the target at (ra, dec)
+        at every sample time.
+        """
+        row = self.row(ra, dec)
+        return None if row is None else self.az[row]
+
+    def airmasses(self, ra: str, dec: str) -> np.ndarray:
+        """ Return the airmass of the target at (ra, dec) at every sample time.
+        """
+        row = self.row(ra, dec)
+        return None if row is None else self.airmass[row]
+
+    def moon_separation(self, rows: np.ndarray) -> np.ndarray:
+        """ Return the angular separation (in degrees) between the moon and
+        each of the targets in `rows` at every sample time.
+        """
+        alt, az = np.radians(self.alt[rows]), np.radians(self.az[rows])
+        moon_alt, moon_az = np.radians(self.moon_alt), np.radians(self.moon_az)
+
+        # spherical law of cosines in the shared alt-az frame
+        cos_sep = (np.sin(alt)*np.sin(moon_alt) +
+                   np.cos(alt)*np.cos(moon_alt)*np.cos(az - moon_az))
+
+        return np.degrees(np.arccos(np.clip(cos_sep, -1, 1))).astype(np.float32)
+
+    def hour_angle(self, rows: np.ndarray) -> np.ndarray:
+        """ Return the hour angle (in hours, between -12 and 12) of each
+        of the targets in `rows` at every sample time.
+        """
+        return np.mod(self.lst - np.atleast_1d(self.ra[rows])[:, None]/15 + 12, 24) - 12
+
+    def remaining(self, time: Time = None) -> slice:
+        """ Return a slice selecting the sample times after `time` (default: now).
+        """
+        time = time or Time.now()
+        return slice(int(np.searchsorted(self.jd, time.jd)), len(self.jd))
+
+    def covers(self, time: Time = None) -> bool:
+        """ Check whether `time` (default: now) is before the end of this ephemeris.
+        """
+        time = time or Time.now()
+        return time < self.end
+
+
+# the ephemeris shared by the executor and schedulers
+_tonight: NightEphemeris = None
+_tonight_lock = threading.Lock()
+
+
+def tonight(npoints: int = 1000) -> NightEphemeris:
+    """ Return the ephemeris for the current night (nautical twilight to nautical
+    twilight), creating it if it does not exist or has expired.
+
+    Parameters
+    ----------
+    npoints: int
+        The number of samples in the time grid if a new ephemeris is created
+
+    Returns
+    -------
+    ephemeris: NightEphemeris
+        The shared ephemeris for tonight
+    """
+    global _tonight
+
+    with _tonight_lock:
+        if _tonight is None or not _tonight.covers():
+
+            # get times for sunset and sunrise
+            observer = Observer(longitude=config.general.longitude*units.deg,
+                                latitude=config.general.latitude*units.deg,
+                                elevation=config.general.altitude*units.m,
+                                name=config.general.name, timezone='UTC')
+            now = Time.now()
+
+            # if it is already night, the night starts now; otherwise at the next sunset
+            if observer.is_night(now, horizon=-12*units.deg):
+                sunset = now
+            else:
+                sunset = observer.twilight_evening_nautical(now, which='next')
+            sunrise = observer.twilight_morning_nautical(sunset, which='next')
+
+            _tonight = NightEphemeris(sunset, sunrise, observer.location, npoints)
+
+        return _tonight
+
+
+# ephemerides over fixed windows, by (bucket, hours, npoints)
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def window(hours: float = 24, npoints: int = 288, bucket: float = 600) -> NightEphemeris:
+    """ Return an ephemeris for the next `hours` hours, shared by every caller
+    in the same `bucket` second interval; the window starts at the beginning
+    of the current interval.
+
+    Parameters
+    ----------
+    hours: float
+        The length of the window
+    npoints: int
+        The number of samples in the time grid
+    bucket: float
+        The length (in seconds) of the interval that an ephemeris is reused for
+
+    Returns
+    -------
+    ephemeris: NightEphemeris
+        The shared ephemeris for this interval
+    """
+    now = Time.now()
+    index = int(now.unix // bucket)
+    key = (index, hours, npoints)
+
+    with _windows_lock:
+        if key not in _windows:
+
+            # forget any windows from earlier intervals
+            for old in [old for old in _windows if old[0] < index]:
+                del _windows[old]
+
+            start = Time(index*bucket, format='unix')
+            _windows[key] = NightEphemeris(start, start + hours*units.hour, npoints=npoints)
+
+        return _windows[key]
@@ -1,16 +1,476 @@
 """ This function uses a connected telescope object to take a series of
 flats.
+
+The exposure time of each flat is predicted by a model of the brightness of
+the twilight sky, which is fit to the mean counts of every flat that we have
+taken before; test exposures are only taken for a filter that has never been
+flat-fielded.
 """
 from astropy.io import fits
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, AltAz, get_sun
+import astropy.units as units
 from config import config
+from typing import Dict, Tuple
+import numpy as np
+import threading
+import tempfile
 import datetime
+import sqlite3
 import time
 import os
 
+# where we persist the mean counts of every flat
+FLATS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'flats.sqlite')
+
+# only flats from the last MAX_AGE days are used to fit the sky model
+MAX_AGE = 365
+
+# the change in log10(counts per second) per degree of sun altitude that
+# we assume until the flats span at least MIN_SPAN degrees
+SLOPE = 0.35
+MIN_SPAN = 1.
+
+# flats with a mean above this are (partly) saturated, and aren't used for the model;
+# their mean is only a lower bound on the sky, so the correction for tonight's sky is
+# raised to at least that bound, plus SATURATED_STEP (in dex)
+SATURATION = 50000.
+SATURATED_STEP = np.log10(2.)
+
+# the weight of each new flat in the correction of the model for tonight's sky
+SMOOTHING = 0.5
+
+# the longest that we wait for the sky to reach a usable brightness (in seconds),
+# and the most test exposures that we take in a new filter
+MAX_WAIT = 1800
+MAX_TESTS = 10
+
+# the sets of flats that we take each twilight; the planner chooses their order
+FLATS_SEQUENCE = [
+    #(bin,   filter,     count)
+    (1,     'h-alpha',  5),
+    (2,     'h-alpha',  5),
+    (1,     'z-band',  5),
+    (1,     'r-band',  5),
+    (1,     'i-band',  5),
+    (1,     'g-band',  5),
+    (2,     'z-band',  5),
+    (2,     'r-band',  5),
+    (1,     'clear',   10),
+    (2,     'i-band',  5),
+    (2,     'g-band',  5),
+    (2,     'clear',   10)
+]
+
+# the rough throughput of each filter relative to clear; this only orders
+# filters that we have never taken flats in
+THROUGHPUT = {'clear': 1., 'g-band': 0.3, 'r-band': 0.3, 'i-band': 0.25, 'z-band': 0.1,
+              'h-alpha': 0.01, 'oiii': 0.01, 'sii': 0.01}
+
+# our initial estimate of the time (in seconds) between flats, besides the exposure;
+# this is updated from the flats that we take
+OVERHEAD = 20.
+
+# the flats are dithered in a 3x3 grid of positions with this spacing (in degrees)
+DITHER_STEP = 0.05
+DITHER_PATTERN = [(0, 0), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+
+
+def sun_altitude(time: Time = None) -> float:
+    """ Return the altitude of the sun (in degrees) at the observatory at `time` (default: now).
+    """
+    time = time or Time.now()
+    location = EarthLocation(lat=config.general.latitude*units.deg,
+                             lon=config.general.longitude*units.deg,
+                             height=config.general.altitude*units.m)
+
+    return float(get_sun(time).transform_to(AltAz(obstime=time, location=location)).alt.deg)
+
+
+def mean_count(filename: str, step: int = 4) -> float:
+    """ Return the mean count of the central half of a FITS image, using every
+    `step`-th pixel. The image is memory-mapped, so only those pixels are read.
+    """
+    # scaling the data (i.e. unsigned 16-bit images) would read all of it,
+    # so we scale the mean instead
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdus:
+        header, data = hdus[0].header, hdus[0].data
+        ny, nx = data.shape[-2:]
+        center = data[..., ny//4:3*ny//4:step, nx//4:3*nx//4:step]
+
+        return float(header.get('BSCALE', 1)*np.mean(center, dtype=np.float64) + header.get('BZERO', 0))
+
+
+def measure(telescope: 'Telescope', filename: str) -> float:
+    """ Return the mean count of the image `filename` (without the extension) on the
+    telescope server; it is copied here and measured locally. If it can't be
+    copied, it is measured on the telescope server instead.
+
+    Returns a negative value if the mean could not be measured.
+    """
+    local = os.path.join(tempfile.gettempdir(), f'flat-{os.getpid()}.fits')
+    try:
+        if telescope.copy_remote_to_local(filename+'.fits', local):
+            return mean_count(local)
+    except Exception as e:
+        telescope.log.warning(f'Unable to measure the mean of {filename}.fits locally: {e}')
+    finally:
+        if os.path.exists(local):
+            os.remove(local)
+
+    return telescope.get_mean_image_count(filename+'.fits')
+
+
+class SkyModel(object):
+    """ A model of the brightness of the twilight sky, and the flats that it is fit to.
+
+    In twilight, the sky brightness is nearly exponential in the altitude of the sun,
+    so the model is
+
+        log10(counts per second) = intercept[filter] + 2 log10(binning) + slope*sun_alt
+
+    with a separate intercept for every filter. Until the flats span enough sun
+    altitudes, the slope is fixed at SLOPE, so that a single flat in a filter is
+    enough to predict its exposure times.
+
+    Tonight's sky may be brighter or darker than usual (i.e. clouds), so every flat
+    that is taken also updates a correction to the model for the rest of the night.
+    The model is only refit at the start of each twilight (see `reset`), so that
+    tonight's flats aren't counted in both the fit and the correction.
+    """
+
+    def __init__(self, filename: str = FLATS_FILE, max_age: float = MAX_AGE):
+        """ Open (and create if necessary) the SQLite store at `filename`,
+        and fit the model to the flats in it.
+        """
+        self.max_age = max_age
+
+        # the store is shared between threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS flats (time REAL, sun_alt REAL, filter TEXT, '
+                        'binning INTEGER, exposure REAL, mean REAL)')
+        self.db.commit()
+
+        # the fitted coefficients, and the rms (in dex) of the residuals
+        self.slope = SLOPE
+        self.intercepts: Dict[str, float] = {}
+        self.rms = None
+        self.fit()
+
+        # tonight's correction (in dex) to the model
+        self.correction = 0.
+
+    def reset(self) -> None:
+        """ Refit the model to every stored flat, and forget the correction to it;
+        this is done at the start of each twilight.
+        """
+        self.fit()
+        self.correction = 0.
+
+    def record(self, sun_alt: float, filt: str, binning: int, exposure: float, mean: float) -> None:
+        """ Store the mean count of a flat, and update tonight's correction. If we
+        have never taken a flat in `filt`, its intercept is set from this flat.
+
+        Parameters
+        ----------
+        sun_alt: float
+            The altitude of the sun (in degrees) at the middle of the exposure
+        filt: str
+            The filter of the flat
+        binning: int
+            The binning of the flat
+        exposure: float
+            The exposure time (in seconds)
+        mean: float
+            The mean count of the flat
+        """
+        if mean <= 0 or exposure <= 0:
+            return
+
+        # how much brighter the sky is than we predicted
+        predicted = self.log_rate(sun_alt, filt, binning)
+        error = None if predicted is None else np.log10(mean/exposure) - predicted
+
+        # the sky is at least this much brighter than we predicted
+        if mean >= SATURATION:
+            if error is not None:
+                self.correction += max(error, 0.) + SATURATED_STEP
+            return
+
+        if error is not None:
+            self.correction += SMOOTHING*error
+        else:
+            self.intercepts[filt] = float(np.log10(mean/exposure) - 2*np.log10(binning)
+                                          - self.slope*sun_alt - self.correction)
+
+        with self.lock:
+            self.db.execute('INSERT INTO flats VALUES (?, ?, ?, ?, ?, ?)',
+                            (time.time(), sun_alt, filt, int(binning), exposure, mean))
+            self.db.commit()
+
+    def fit(self) -> Dict[str, float]:
+        """ Fit the model to the stored flats.
+
+        Returns the fitted coefficients; the 'slope' (in dex per degree),
+        and the intercept of each filter.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT sun_alt, filter, binning, exposure, mean FROM flats '
+                                   'WHERE time > ?', (time.time() - self.max_age*24*60*60,)).fetchall()
+
+        if not rows:
+            self.slope, self.intercepts, self.rms = SLOPE, {}, None
+            return {}
+
+        sun_alt = np.array([row[0] for row in rows])
+        filters = sorted({row[1] for row in rows})
+        binning = np.array([row[2] for row in rows], dtype=float)
+        rate = np.log10([row[4]/row[3] for row in rows]) - 2*np.log10(binning)
+
+        # one column for the intercept of each filter
+        columns = [np.array([row[1] == filt for row in rows], dtype=float) for filt in filters]
+
+        # if the flats of any filter span enough of the twilight, fit the slope too
+        fit_slope = any(np.ptp(sun_alt[columns[i] > 0]) >= MIN_SPAN for i in range(len(filters)))
+        if fit_slope:
+            A = np.vstack(columns + [sun_alt]).T
+            coefficients = np.linalg.lstsq(A, rate, rcond=None)[0]
+            self.slope = float(coefficients[-1])
+        else:
+            A = np.vstack(columns).T
+            coefficients = np.linalg.lstsq(A, rate - SLOPE*sun_alt, rcond=None)[0]
+            self.slope = SLOPE
+
+        self.intercepts = dict(zip(filters, coefficients[:len(filters)].tolist()))
+        residuals = A @ coefficients - (rate if fit_slope else rate - SLOPE*sun_alt)
+        self.rms = float(np.sqrt(np.mean(residuals**2)))
+
+        return dict({'slope': self.slope}, **self.intercepts)
+
+    def log_rate(self, sun_alt: float, filt: str, binning: int) -> float:
+        """ Return log10 of the counts per second that we expect in a flat in `filt`
+        with `binning` when the sun is at `sun_alt` (in degrees), or None if we
+        have never taken a flat in `filt`.
+        """
+        if filt not in self.intercepts:
+            return None
+
+        return self.intercepts[filt] + 2*np.log10(binning) + self.slope*sun_alt + self.correction
+
+    def exposure(self, filt: str, binning: int, counts: float, sun_alt: float = None,
+                 rate: float = None) -> float:
+        """ Return the exposure time (in seconds) that gives a flat in `filt` with
+        `binning` a mean of `counts`, if it is started now. This accounts for the
+        sky changing brightness during the exposure.
+
+        Parameters
+        ----------
+        filt: str
+            The filter of the flat
+        binning: int
+            The binning of the flat
+        counts: float
+            The desired mean count
+        sun_alt: float
+            The current altitude of the sun (default: computed now)
+        rate: float
+            The rate of change of the altitude of the sun (in degrees per second)
+
+        Returns
+        -------
+        exposure: float
+            The exposure time, or None if we have never taken a flat in `filt`,
+            or if the sky will never get bright enough.
+        """
+        if sun_alt is None or rate is None:
+            sun_alt, rate = self.sun()
+
+        log_rate = self.log_rate(sun_alt, filt, binning)
+        if log_rate is None:
+            return None
+
+        # the count rate grows as exp(k t), so the counts after t seconds are
+        # rate0 (exp(k t) - 1)/k; we solve this for t
+        rate0 = 10**log_rate
+        k = np.log(10)*self.slope*rate
+        if abs(k) < 1e-9:
+            return counts/rate0
+        argument = 1 + k*counts/rate0
+        if argument <= 0:
+            return None
+
+        return float(np.log(argument)/k)
+
+    @staticmethod
+    def sun(time: Time = None) -> Tuple[float, float]:
+        """ Return the altitude of the sun (in degrees) at `time` (default: now),
+        and its rate of change (in degrees per second).
+        """
+        time = time or Time.now()
+        now, later = sun_altitude(time), sun_altitude(time + 60*units.second)
+        return now, (later - now)/60.
+
+
+# the model shared by everything in this process
+_sky: SkyModel = None
+_sky_lock = threading.Lock()
+
+
+def sky() -> SkyModel:
+    """ Return the sky model for this process, loading it if necessary.
+    """
+    global _sky
+    with _sky_lock:
+        if _sky is None:
+            _sky = SkyModel()
+
+        return _sky
+
+
+def test_exposure(telescope: 'Telescope', model: SkyModel, filter: str, binning: int,
+                  filename: str) -> bool:
+    """ Take test exposures in `filter` until the sky model can predict exposure
+    times for it; this is only needed the first time a filter is flat-fielded.
+
+    Returns False if there was an error taking or measuring the test exposures.
+    """
+    exposure = config.telescope.starting_exposure_for_flats
+    for _ in range(MAX_TESTS):
+        if model.log_rate(0., filter, binning) is not None:
+            break
+
+        sun_alt = sun_altitude()
+        if not telescope.take_exposure(filename, exposure, 1, binning, filter):
+            telescope.log.error('There was an error taking an image for sky flats. Quitting...')
+            return False
+
+        mean = measure(telescope, filename)
+        if mean < 0:
+            telescope.log.error('There was an error obtaining the mean count of the flat image. Quitting...')
+            return False
+
+        # a saturated test exposure only tells us to expose for less time
+        if mean >= SATURATION:
+            exposure = max(exposure/4, config.telescope.min_exposure_for_flats/4)
+            time.sleep(config.telescope.delay_between_test_flats)
+            continue
+
+        model.record((sun_alt + sun_altitude())/2, filter, binning, exposure, mean)
+
+    return True
+
+
+def throughput(model: SkyModel, filt: str, binning: int) -> float:
+    """ Return log10 of the relative count rate of flats in `filt` with `binning`;
+    flats with a higher throughput reach the desired counts in a darker sky.
+    """
+    log_rate = model.log_rate(0., filt, binning)
+    if log_rate is not None:
+        return log_rate
+
+    # a filter that we have never taken flats in is guessed relative to clear
+    anchor = model.log_rate(0., 'clear', 1)
+    if anchor is None:
+        anchor = max(model.intercepts.values(), default=0.)
+    return anchor + 2*np.log10(binning) + np.log10(THROUGHPUT.get(filt.strip('"[]').lower(), 0.1))
+
+
+def duration(model: SkyModel, filt: str, binning: int, count: int, counts: float,
+             sun_alt: float, rate: float, overhead: float = OVERHEAD) -> float:
+    """ Return the time (in seconds) that it takes to take `count` flats in `filt`
+    with `binning`, starting when the sun is at `sun_alt`, including any time that
+    we have to wait for the sky to darken (or brighten). The sun moves at `rate`
+    degrees per second.
+
+    Returns None if the set can't be completed in this twilight.
+    """
+    # we can't predict filters that we have never taken flats in; assume the shortest flats
+    if model.log_rate(0., filt, binning) is None:
+        return count*(config.telescope.min_exposure_for_flats + overhead)
+
+    elapsed, waited = 0., 0.
+    for _ in range(count):
+        while True:
+            exposure = model.exposure(filt, binning, counts, sun_alt + rate*elapsed, rate)
+            too_bright = exposure is not None and exposure < config.telescope.min_exposure_for_flats
+            too_dark = exposure is None or exposure > config.telescope.max_exposure_for_flats
+            if not (too_bright or too_dark):
+                break
+
+            # the sky is getting worse, or won't get better in time
+            if (too_bright and rate > 0) or (too_dark and rate < 0) or waited >= MAX_WAIT:
+                return None
+            elapsed += config.telescope.delay_between_test_flats
+            waited += config.telescope.delay_between_test_flats
+
+        elapsed += exposure + overhead
+
+    return elapsed
+
+
+def plan(model: SkyModel, sequence: list, counts: float, sun_alt: float, rate: float,
+         overhead: float = OVERHEAD) -> list:
+    """ Return the sets of flats in `sequence` that can be completed in this twilight,
+    in the order that they should be taken.
+
+    The sets are ordered by their throughput against the changing sky; in the evening,
+    when the sky is fading, the sets with the lowest throughput (i.e. narrowband filters)
+    are taken first, while the sky is still bright enough for them, and at dawn they
+    are taken last. Each set is then simulated in turn, and sets that can no
+    longer be completed are skipped.
+
+    Parameters
+    ----------
+    model: SkyModel
+        The model of the sky brightness
+    sequence: list
+        The (binning, filter, count) of each set of flats
+    counts: float
+        The desired mean count of each flat
+    sun_alt: float
+        The current altitude of the sun (in degrees)
+    rate: float
+        The rate of change of the altitude of the sun (in degrees per second)
+    overhead: float
+        The time (in seconds) between flats, besides the exposure
+
+    Returns
+    -------
+    sets: list
+        The (binning, filter, count) of the sets that should be taken, in order
+    """
+    ordered = sorted(sequence, key=lambda flat_set: throughput(model, flat_set[1], flat_set[0]),
+                     reverse=(rate > 0))
+
+    sets, elapsed = [], 0.
+    for binning, filt, count in ordered:
+        needed = duration(model, filt, binning, count, counts, sun_alt + rate*elapsed, rate, overhead)
+        if needed is not None:
+            sets.append((binning, filt, count))
+            elapsed += needed
+
+    return sets
+
+
+def dither(telescope: 'Telescope', i: int) -> bool:
+    """ Move the telescope from the `i`-th to the next position of the dither
+    pattern with a small offset, rather than slewing to a new position.
+    """
+    x0, y0 = DITHER_PATTERN[i % len(DITHER_PATTERN)]
+    x1, y1 = DITHER_PATTERN[(i + 1) % len(DITHER_PATTERN)]
+
+    return telescope.offset(DITHER_STEP*(x1 - x0), DITHER_STEP*(y1 - y0))
+
+
 def take_flats(telescope: 'Telescope') -> bool:
     """ Automatically take a series of flats
 
-    MORE DETAIL HERE
+    The sets of flats are ordered, and sets that can't be completed are skipped,
+    by `plan`. The exposure time of each flat is predicted by the sky model (see `SkyModel`),
+    and the mean of each flat (measured locally) corrects the model for the rest of
+    the twilight. If the sky is still too bright (or already too dark) for a flat,
+    we wait for it to change, or skip the set if it never will.
 
     Parameters
     ----------
@@ -23,23 +483,6 @@ def take_flats(telescope: 'Telescope') -> bool:
         True if focus was successful, False if otherwise
     """
 
-    #where should we put this?
-    flats_image_sequence = [
-        #(bin,   filter,     count)
-        (1,     'h-alpha',  5),
-        (2,     'h-alpha',  5),
-        (1,     'z-band',  5),
-        (1,     'r-band',  5),
-        (1,     'i-band',  5),
-        (1,     'g-band',  5),
-        (2,     'z-band',  5),
-        (2,     'r-band',  5),
-        (1,     'clear',   10),
-        (2,     'i-band',  5),
-        (2,     'g-band',  5),
-        (2,     'clear',   10)
-    ]
-
     #temp filename for image output
     flat_fits_file_prefix = '_flat'
 
@@ -82,60 +525,85 @@ def take_flats(telescope: 'Telescope') -> bool:
         telescope.log.error('There was an error setting up the telescope for sky flats. Quitting...')
         return False;
 
-    # get the flats!
-    for flat_image_set in flats_image_sequence:
+    # the model's correction for the sky is only valid for this twilight
+    model = sky()
+    model.reset()
+
+    # the desired mean count of each flat
+    counts = config.telescope.optimum_count_for_flats*config.telescope.exposure_scaling_fudge_for_flats
+
+    # get the flats! we replan before each set, as the sky and our model change
+    remaining = list(FLATS_SEQUENCE)
+    overhead = OVERHEAD
+    frame = 0
+    while remaining:
+        sun_alt, rate = model.sun()
+        sets = plan(model, remaining, counts, sun_alt, rate, overhead)
+        if not sets:
+            telescope.log.info(f'There is no time left for {len(remaining)} sets of flats. Skipping...')
+            break
+
         #set image parameters
-        binning = flat_image_set[0]
-        filter = flat_image_set[1]
-        count = flat_image_set[2]
-        filename = flat_fits_file_prefix
-        #start exposure at default value, e.g. 1 s
-        exposure = optimum_exposure = config.telescope.starting_exposure_for_flats
+        binning, filter, count = sets[0]
+        remaining.remove(sets[0])
+
+        # we only need test exposures for a filter that we have never taken flats in
+        if not test_exposure(telescope, model, filter, binning, flat_fits_file_prefix):
+            return False
+        if model.log_rate(0., filter, binning) is None:
+            telescope.log.warning(f'Unable to find an exposure time for {filter} flats. Skipping...')
+            continue
+
         #obtain count flats images
-        for i in range(count):
-            #take images until the exposure that gives the optimum count is greater than the min exposure allowed
-            while optimum_exposure < config.telescope.min_exposure_for_flats:
-                #change filter and take image
-                if not telescope.take_exposure(filename, exposure, 1, binning, filter):
-                    telescope.log.error('There was an error taking an image for sky flats. Quitting...')
-                    return False #should we clean up?
-                #get the mean count of the resulting fits file
-                #hdu_list = fits.open(filename+'.fits')
-                #image_data = hdu_list[0].data
-                #mean = np.mean(image_data)
-                #fits.close()
-                mean = telescope.get_mean_image_count(flat_fits_file_prefix+'.fits')
-                if mean < 0:
-                    telescope.log.error('There was an error obtaining the mean count of the flat image. Quitting...')
-                    return False;
-                #how close are we to the optimum count for flats?
-                factor = float(config.telescope.optimum_count_for_flats)/float(mean)
-                #calc new exposure time
-                optimum_exposure = factor*config.telescope.exposure_scaling_fudge_for_flats*exposure
-                if optimum_exposure > config.telescope.max_exposure_for_flats:
-                    telescope.log.error('The exposure time (%f) is too long (> %f). Quitting...'%(optimum_exposure, config.telescope.max_exposure_for_flats))
-                    return False #should we clean up?
+        i = 0
+        waited = 0
+        while i < count:
+            sun_alt, rate = model.sun()
+            exposure = model.exposure(filter, binning, counts, sun_alt, rate)
+
+            # the sky is too bright or too dark; wait if it is getting better, or stop
+            too_bright = exposure is not None and exposure < config.telescope.min_exposure_for_flats
+            too_dark = exposure is None or exposure > config.telescope.max_exposure_for_flats
+            if too_bright or too_dark:
+                if (too_bright and rate > 0) or (too_dark and rate < 0) or waited >= MAX_WAIT:
+                    telescope.log.warning(f'The sky is too {"bright" if too_bright else "dark"} '
+                                          f'for {filter} flats (exposure: {exposure}). Skipping...')
+                    break
                 time.sleep(config.telescope.delay_between_test_flats)
-                #we have our optimum exposure calculated. take a *real* flat
-            exposure = optimum_exposure #update exposure
+                waited += config.telescope.delay_between_test_flats
+                continue
+
+            start = time.time()
             flatname = 'flat_%s_%.2fsec_bin%d_%s_%s_num%d_seo'%(filter, exposure, binning, config.telescope.username, datetime.datetime.utcnow().strftime('%Y%b%d_%Hh%Mm%Ss'), i)
             if not telescope.take_exposure(flatname, exposure, 1, binning, filter):
                 telescope.log.error('There was an error taking an image for sky flats. Quitting...')
                 return False #should we clean up?
+
             #get the mean count of the resulting fits file
-            #hdu_list = fits.open(flatname)
-            #image_data = hdu_list[0].data
-            #mean = np.mean(image_data)
-            mean = telescope.get_mean_image_count(flatname+'.fits')
+            mean = measure(telescope, flatname)
             if mean < 0:
                 telescope.log.error('There was an error obtaining the mean count of the flat image. Quitting...')
                 return False;
-            #how close are we to the optimum count for flats?
-            factor = float(config.telescope.optimum_count_for_flats)/float(mean)
-            #calc new exposure time
-            optimum_exposure = factor*config.telescope.exposure_scaling_fudge_for_flats*exposure
-            #shimmy the scope pointing
-            telescope.goto_point_for_flats()
+
+            # correct the model for the rest of the twilight
+            model.record(sun_alt + rate*exposure/2, filter, binning, exposure, mean)
+            telescope.log.debug(f'Flat {flatname} has a mean of {mean:.0f} (desired {counts:.0f})')
+
+            # shimmy the scope pointing with a small offset
+            dither(telescope, frame)
+
+            # keep track of how long we spend on each flat besides the exposure
+            overhead = 0.5*overhead + 0.5*max(time.time() - start - exposure, 0.)
+
+            # a saturated flat is useless, so it doesn't count; the model now
+            # predicts a shorter exposure (or that the sky is too bright)
+            if mean >= SATURATION:
+                telescope.log.warning(f'Flat {flatname} is saturated (mean: {mean:.0f}). Retaking...')
+            else:
+                i += 1
+            frame += 1
 
     # all done!
     telescope.close_dome()
+
+    return True
@@ -1,8 +1,10 @@
 import os
-import requests
-import subprocess
+import time
+import sqlite3
 import datetime
+import threading
 from time import gmtime, strftime
+from typing import Callable, Dict, List, Tuple
 
 import numpy as np
 import astropy.table
@@ -11,19 +13,252 @@ from astropy.io import fits, ascii
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy.coordinates import Angle
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 """ This function provides utilities to evaluate the focus of a given image, and
-autofocus a connected telescope. 
+autofocus a connected telescope.
 """
 
+# where the results of each focus run are saved
+FOCUS_DIR = "/home/sirius/focus/"
 
-def focus(telescope: 'Telescope') -> bool:
-    """ Automatically focus the telescope. 
+# the range of focus positions that we search, and the initial spacing of samples
+FOCUS_RANGE = (4650, 5000)
+COARSE_POINTS = 5
 
-    Use an automated image processing routine (TODO: info here) to 
-    automatically focus the telescope; this takes multiple images and
-    evaluates their respective "focus". 
+# we stop once the best focus is known to within this many steps,
+# or after this many exposures
+FOCUS_TOLERANCE = 5.
+MAX_FRAMES = 12
+
+# the exposure time and binning of focus frames
+EXPOSURE_TIME = 30
+BINNING = 2
+
+# where we persist the result of every focus run
+FOCUS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'focus.sqlite')
+
+# only runs from the last MAX_AGE days are used to fit the focus model, and
+# we need MIN_RUNS runs spanning MIN_SPAN degrees C to fit its temperature term
+MAX_AGE = 120
+MIN_RUNS = 4
+MIN_SPAN = 2.
+
+# the filter that the focus offsets of the other filters are relative to
+REFERENCE_FILTER = 'clear'
+
+# the focus is moved to the prediction of the model when the temperature
+# changes by this many degrees C (or the filter changes)
+TEMPERATURE_STEP = 0.5
+
+# a verification sweep is run when the measured FWHM grows by this fraction;
+# it samples VERIFY_POINTS positions within VERIFY_WIDTH steps of the prediction
+DRIFT = 0.25
+VERIFY_WIDTH = 40
+VERIFY_POINTS = 3
+VERIFY_FRAMES = 6
+
+
+def background(data: np.ndarray) -> (float, float):
+    """ Estimate the sky level and noise of an image with an iteratively
+    sigma-clipped median of a subsample of its pixels.
+    """
+    sample = data[::4, ::4].ravel()
+    sample = sample[np.isfinite(sample)]
+    for _ in range(3):
+        median = np.median(sample)
+        sigma = 1.4826*np.median(np.abs(sample - median))
+        sample = sample[np.abs(sample - median) < 3*sigma]
+
+    return float(median), float(max(sigma, 1e-6))
+
+
+def find_stars(data: np.ndarray, threshold: float = 5., box: int = 7,
+               max_stars: int = 50) -> Tuple[np.ndarray, np.ndarray]:
+    """ Find the brightest isolated stars in an image.
+
+    Stars are local maxima (within a `box` x `box` window) that are more than
+    `threshold` sigma above the sky, and are not near the edge of the image or
+    saturated. Returns the (y, x) pixel coordinates of up to `max_stars` stars.
+    """
+    sky, sigma = background(data)
+    half = box // 2
+
+    # a pixel is a peak if it is the maximum of the window around it; the
+    # maximum filter is separable, so we take it along each axis in turn
+    maximum = sliding_window_view(data, box, axis=0).max(axis=-1)
+    maximum = sliding_window_view(maximum, box, axis=1).max(axis=-1)
+    peaks = (data[half:-half, half:-half] == maximum)
+    peaks &= data[half:-half, half:-half] > sky + threshold*sigma
+
+    # ignore saturated stars
+    peaks &= data[half:-half, half:-half] < 0.9*np.nanmax(data)
+
+    ys, xs = np.nonzero(peaks)
+    ys, xs = ys + half, xs + half
+
+    # keep stars whose stamp fits in the image, brightest first
+    edge = 2*box
+    inside = (ys >= edge) & (ys < data.shape[0] - edge) & (xs >= edge) & (xs < data.shape[1] - edge)
+    ys, xs = ys[inside], xs[inside]
+    order = np.argsort(data[ys, xs])[::-1][:max_stars]
+
+    return ys[order], xs[order]
+
+
+def measure_fwhm(data: np.ndarray, box: int = 15) -> float:
+    """ Measure the median FWHM (in pixels) of the stars in an image from
+    the second moments of a `box` x `box` stamp around each star.
+
+    Returns NaN if there are no stars.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    sky, sigma = background(data)
+    ys, xs = find_stars(data)
+    if len(ys) == 0:
+        return float('nan')
+
+    # cut out a stamp around every star at once
+    half = box // 2
+    offsets = np.arange(-half, half+1)
+    stamps = data[(ys[:, None] + offsets)[:, :, None], (xs[:, None] + offsets)[:, None, :]] - sky
+    # only use pixels that are clearly part of the star, so that the
+    # noise of the sky doesn't broaden small stars
+    stamps = np.where(stamps > 2*sigma, stamps, 0)
+
+    # intensity-weighted second moments of each stamp
+    total = stamps.sum(axis=(1, 2))
+    dy = offsets[None, :, None] - (stamps*offsets[None, :, None]).sum(axis=(1, 2))[:, None, None]/total[:, None, None]
+    dx = offsets[None, None, :] - (stamps*offsets[None, None, :]).sum(axis=(1, 2))[:, None, None]/total[:, None, None]
+    variance = (stamps*(dx**2 + dy**2)).sum(axis=(1, 2))/(2*total)
+
+    # a gaussian has FWHM = 2 sqrt(2 ln 2) sigma
+    fwhm = 2.3548*np.sqrt(variance[total > 0])
+
+    return float(np.median(fwhm)) if len(fwhm) else float('nan')
+
+
+def fit_focus(samples: List[Tuple[float, float]]) -> Tuple[float, float]:
+    """ Fit the focus curve to a list of (position, FWHM) samples.
+
+    Near focus, the FWHM follows a hyperbola, so FWHM^2 is a parabola in the
+    position. Returns the best position, and its uncertainty (in steps);
+    the uncertainty is infinite if the curve is not well constrained.
+    """
+    samples = np.array([sample for sample in samples if np.isfinite(sample[1])])
+    if len(samples) < 3:
+        return float('nan'), float('inf')
+
+    position, fwhm = samples[:, 0], samples[:, 1]
+    center = position.mean()
+    try:
+        # numpy can only estimate the covariance with more than 4 samples
+        if len(samples) > 4:
+            coefficients, covariance = np.polyfit(position - center, fwhm**2, 2, cov=True)
+        else:
+            coefficients, covariance = np.polyfit(position - center, fwhm**2, 2), None
+    except (ValueError, np.linalg.LinAlgError) as _:
+        return float('nan'), float('inf')
+
+    a, b, _ = coefficients
+    if a <= 0:
+        return float('nan'), float('inf')
+    best = -b/(2*a)
+
+    # propagate the uncertainty of the coefficients to the position of the minimum
+    if covariance is None:
+        return float(best + center), float('inf')
+    gradient = np.array([b/(2*a**2), -1/(2*a), 0])
+    error = np.sqrt(max(gradient @ covariance @ gradient, 0))
+
+    return float(best + center), float(error)
+
+
+def autofocus(measure: Callable[[float], float], low: float = FOCUS_RANGE[0],
+              high: float = FOCUS_RANGE[1], points: int = COARSE_POINTS,
+              tolerance: float = FOCUS_TOLERANCE, max_frames: int = MAX_FRAMES) -> Tuple[float, List]:
+    """ Find the focus position that minimizes the FWHM returned by `measure`.
+
+    We first sample `points` positions across [low, high], extending the range
+    if the minimum is at an edge. We then repeatedly fit the focus curve to the
+    samples around the minimum and measure at the predicted best position,
+    until the fit locates it to within `tolerance` steps (or we reach
+    `max_frames` exposures).
+
+    Parameters
+    ----------
+    measure: Callable[[float], float]
+        Move the focuser to a position, and return the FWHM there (NaN on failure)
+    low, high: float
+        The range of focus positions to start from
+    points: int
+        The number of positions in the initial coarse sweep
+    tolerance: float
+        The required uncertainty (in focus steps) of the best position
+    max_frames: int
+        The maximum number of measurements
+
+    Returns
+    -------
+    best: float
+        The best focus position, or NaN if it could not be found
+    samples: List
+        The (position, FWHM) pairs that were measured
+    """
+    samples = []
+    step = (high - low)/(points - 1)
+
+    def sample(position: float) -> None:
+        samples.append((float(position), measure(position)))
+
+    # coarse sweep
+    for position in np.linspace(low, high, points):
+        sample(position)
+
+    # if the minimum is at an edge, extend the bracket past it
+    while len(samples) < max_frames:
+        valid = sorted((s for s in samples if np.isfinite(s[1])), key=lambda s: s[0])
+        if len(valid) < 3:
+            return float('nan'), samples
+        minimum = min(range(len(valid)), key=lambda i: valid[i][1])
+        if minimum == 0:
+            sample(valid[0][0] - step)
+        elif minimum == len(valid) - 1:
+            sample(valid[-1][0] + step)
+        else:
+            break
+
+    # refine around the minimum until the fit is well constrained
+    best, error = float('nan'), float('inf')
+    while len(samples) < max_frames:
+        valid = sorted((s for s in samples if np.isfinite(s[1])), key=lambda s: s[0])
+        minimum = min(valid, key=lambda s: s[1])[0]
+
+        # only fit the part of the curve near the minimum, where it is a hyperbola
+        near = sorted(valid, key=lambda s: abs(s[0] - minimum))
+        best, error = fit_focus(near[:max(5, sum(abs(s[0] - minimum) <= 1.5*step for s in near))])
+        if not np.isfinite(best):
+            break
+        best = float(np.clip(best, minimum - step, minimum + step))
+        if error <= tolerance:
+            break
+
+        # measure at the predicted best focus, and narrow the search
+        if min(abs(best - s[0]) for s in samples) < tolerance/2:
+            break
+        sample(best)
+        step = max(step/2, 2*tolerance)
+
+    return best, samples
+
+
+def focus(telescope: 'Telescope') -> (bool, float):
+    """ Automatically focus the telescope.
+
+    Point at a bright standard star near zenith, and search for the focus
+    position that minimizes the FWHM of the stars in each image (see `autofocus`).
+    The FWHM is measured here, from the FITS data of each image.
 
     Parameters
     ----------
@@ -35,96 +270,328 @@ def focus(telescope: 'Telescope') -> bool:
     res: bool
         True if focus was successful, False if otherwise
     focus: float
-        The final value of the focus metric used to evaluate focus.
+        The final focus position
     """
     # wait until weather is good to observe
     telescope.wait_until_good()
-    
+
     # create tonight's focus folder
-    folder = "/home/sirius/focus/focus_"+str(strftime("%Y-%m-%d_%Hh%Mm%Ss", gmtime()))
-    subprocess.check_call(['mkdir',folder])
-    os.chdir("/home/sirius/focus/")
-    
+    folder = "focus_"+str(strftime("%Y-%m-%d_%Hh%Mm%Ss", gmtime()))
+
     # define observer parameters
     observer = astropy.coordinates.EarthLocation(lat=38.336667*u.deg, lon=-122.6675*u.deg, height=75*u.m)
     now = astropy.time.Time(datetime.datetime.utcnow(), scale='utc')
 
     altaz_frame_seo = astropy.coordinates.AltAz(obstime=now, location=observer)
-    altaz_zenith_seo = SkyCoord(0*u.degree, +90*u.degree, frame=altaz_frame_seo)
-    radec_zenith_seo = altaz_zenith_seo.transform_to("icrs")
-    
+
     # define standard star parameters
-    sdss_standard_stars = astropy.table.Table.read("SDSS_Standard_Stars", format="ascii.commented_header")
+    sdss_standard_stars = astropy.table.Table.read(os.path.join(FOCUS_DIR, "SDSS_Standard_Stars"),
+                                                   format="ascii.commented_header")
     standard_stars_name = sdss_standard_stars['StarName']
     standard_stars_ra = sdss_standard_stars['RA(J2000.0)']
     standard_stars_dec = sdss_standard_stars['DEC(J2000.0)']
 
-    standard_stars_r = sdss_standard_stars['r\'']
-    standard_stars_g = sdss_standard_stars['g\'-r\'']+standard_stars_r
-    standard_stars_i = -sdss_standard_stars['r\'-i\'']+standard_stars_r
-    standard_stars_z = -sdss_standard_stars['i\'-z\'']+standard_stars_i
-    standard_stars_u = sdss_standard_stars['u\'-g\'']+standard_stars_g
-
     # choose the standard star closest to zenith
     standard_stars_altaz = SkyCoord(ra=standard_stars_ra, dec=standard_stars_dec, unit=(u.hourangle, u.deg), frame="icrs").transform_to(altaz_frame_seo)
     standard_stars_maxalt = np.argmax(standard_stars_altaz.alt)
-    standard_stars_radec_decimaldeg = SkyCoord(ra=standard_stars_ra[standard_stars_maxalt], dec=standard_stars_dec[standard_stars_maxalt], unit=(u.hourangle, u.deg), frame="icrs")
 
     ra = str(standard_stars_ra[standard_stars_maxalt][0:2])+":"+str(standard_stars_ra[standard_stars_maxalt][3:5])+":"+str(int(round(float(standard_stars_ra[standard_stars_maxalt][6:11]))))
     dec = str(standard_stars_dec[standard_stars_maxalt][0:3])+":"+str(standard_stars_dec[standard_stars_maxalt][4:6])+":"+str(int(round(float(standard_stars_dec[standard_stars_maxalt][7:12]))))
+    star = str(standard_stars_name[standard_stars_maxalt])
+
+    telescope.log.info(f'Focusing on {star} (ra: {ra}, dec: {dec})')
+
+    # open up and point once; take_exposure keeps the dome open between frames
+    telescope.open_dome()
+    telescope.keep_open(3000)
+    telescope.enable_tracking()
+    telescope.goto_point(ra, dec)
+
+    best, samples = sweep(telescope, folder, star, *FOCUS_RANGE)
+
+    return np.isfinite(best), (best if np.isfinite(best) else telescope.get_focus())
+
+
+def temperature(telescope: 'Telescope') -> float:
+    """ Return the current temperature (in C), or None if it can't be found;
+    focusing carries on without it.
+    """
+    try:
+        return telescope.get_temperature()
+    except Exception as e:
+        telescope.log.warning(f'Unable to get the temperature: {e}')
+        return None
+
+
+def sweep(telescope: 'Telescope', folder: str, name: str, low: float, high: float,
+          points: int = COARSE_POINTS, max_frames: int = MAX_FRAMES,
+          filt: str = REFERENCE_FILTER) -> Tuple[float, List]:
+    """ Search for the best focus of the field that the telescope is pointing at
+    (see `autofocus`), starting from [low, high], and move the focuser there.
+
+    The samples are saved to FOCUS_DIR/`folder`, and the result is stored in
+    the focus model along with the current temperature and filter.
+
+    Returns the best focus position (NaN if it could not be found),
+    and the (position, FWHM) samples that were measured.
+    """
+    os.makedirs(os.path.join(FOCUS_DIR, folder), exist_ok=True)
+
+    def measure(position: float) -> float:
+        """ Move the focuser, take an image, and measure its FWHM.
+        """
+        position = int(round(position))
+        telescope.set_focus(position)
+
+        remote = f'/tmp/focus_{name}_{EXPOSURE_TIME}s_pos{position}'
+        local = os.path.join(FOCUS_DIR, folder, os.path.basename(remote) + '.fits')
+        telescope.take_exposure(remote, EXPOSURE_TIME, count=1, binning=BINNING, filt=filt)
+        if not telescope.copy_remote_to_local(remote + '.fits', local):
+            return float('nan')
+
+        fwhm = measure_fwhm(fits.getdata(local))
+        telescope.log.debug(f'FWHM at focus position {position} is {fwhm:.2f} pixels')
+        return fwhm
+
+    best, samples = autofocus(measure, low, high, points=points, max_frames=max_frames)
 
-    print("Focus star: ", standard_stars_name[standard_stars_maxalt], "ra: ", ra, "dec: ", dec)
-    
-    # initialize array covering a range of focus positions
-    pass1_array = [4650,4675,4700,4725,4750,4775,4800,4825,4850,4875,4900,4925,4950,4975,5000]
-    pass1_array_focus = np.zeros((len(pass1_array),2))
-    
-    subprocess.check_call(['openup','nocloud'])
-    subprocess.check_call(['keepopen', 'slit', 'maxtime=3000'])
-    subprocess.check_call(['tx', 'track', 'on'])
-    subprocess.check_call(['/home/mcnowinski/seo/bin/pinpoint',ra,dec])
-    
-    # calculate PSF for pass1_array focus positions
-    for i,position in enumerate(pass1_array):
-        focus_position="pos="+str(position)
-        subprocess.check_call(['tx','focus',focus_position])
-        outfile = "outfile=/home/sirius/focus/"+folder+"/focus_"+str(standard_stars_name[standard_stars_maxalt])+"_30s_"+"pos"+str(position)+".fits"
-        outfile_name = "/home/sirius/focus/"+folder+"/focus_"+str(standard_stars_name[standard_stars_maxalt])+"_30s_"+"pos"+str(position)+".fits"
-        psfex_cat = "/home/sirius/focus/"+folder+"/test.cat"
-        subprocess.check_call(['openup','nocloud'])
-        subprocess.check_call(['tx','track','on'])
-        subprocess.check_call(['keepopen', 'slit', 'maxtime=600'])
-        subprocess.check_call(['image','time=30','bin=2',str(outfile)])
-        subprocess.check_call(['/home/mcnowinski/sex/sextractor/bin/sex',str(outfile_name), '-c', 'psf.sex'])
-        subprocess.check_call(['/home/mcnowinski/psfex/bin/psfex',str(psfex_cat), '-c', 'default.psfex'])
-    
-        psf = fits.open("/home/sirius/focus/"+folder+"/test.psf")
-        fwhm = psf[1].header['PSF_FWHM']
-    
-        pass1_array_focus[i]=position,fwhm
-    
-    # fit data points to a 2nd-deg polynomial
-    pass1_fit = np.polyfit(pass1_array_focus[:,0], pass1_array_focus[:,1], 2)
-    pass1_fit_focus_pos = int(-pass1_fit[1]/(2*pass1_fit[0]))
-    
-    # set focus to minimum
-    final_focus_pos = "pos="+str(pass1_fit_focus_pos)
-    subprocess.check_call(['tx','focus',final_focus_pos])
-    
     # save focus pos array
-    np.savetxt("/home/sirius/focus/"+folder+"/"+folder+".dat", pass1_array_focus, fmt='%.5f', header='focus_pos PSF')
-    
-    # graph focus fits
-    array = np.array(pass1_array_focus)
-    plt.scatter(array[:,0], array[:,1])
-    x = np.arange(4000,5100)
-    y = pass1_fit[0]*x**2+pass1_fit[1]*x+pass1_fit[2]
-    
-    plt.plot(x,y)
-    plt.ylim(2,5.5)
-    plt.xlim(4550,5100)
-    plt.savefig("/home/sirius/focus/"+folder+"/"+folder+"_fig.png")
-    
-    
-    
+    np.savetxt(os.path.join(FOCUS_DIR, folder, folder+".dat"), np.array(samples), fmt='%.5f',
+               header='focus_pos FWHM')
+
+    if not np.isfinite(best):
+        telescope.log.warning(f'Unable to find the best focus after {len(samples)} exposures')
+        return best, samples
+
+    # set focus to minimum
+    telescope.set_focus(int(round(best)))
+    telescope.log.info(f'Set focus to {int(round(best))} after {len(samples)} exposures')
+
+    # remember where the best focus was; FWHMs are stored in unbinned pixels
+    fwhm = min(sample[1] for sample in samples if np.isfinite(sample[1]))
+    model().record(best, BINNING*fwhm, temperature(telescope), filt)
+
+    return best, samples
+
+
+class FocusModel(object):
+    """ A model of the best focus position as a function of the temperature
+    and the filter, and the history of focus runs that it is fit to.
+
+    The model is linear in the temperature, with a constant offset for each
+    filter relative to REFERENCE_FILTER:
+
+        position = zero + slope*(temperature - mean) + offset[filter]
+
+    where `mean` is the mean temperature of the runs, so that `zero` is
+    also the prediction when the temperature is unknown.
+
+    Until there are enough runs over a wide enough range of temperatures,
+    the slope is fixed at zero. The model also tracks the FWHM of the
+    stars in recent frames, so that a (short) verification sweep is only
+    run when the image quality has degraded.
+    """
+
+    def __init__(self, filename: str = FOCUS_FILE, max_age: float = MAX_AGE):
+        """ Open (and create if necessary) the SQLite store at `filename`,
+        and fit the model to the runs in it.
+        """
+        self.max_age = max_age
+
+        # the store is shared between threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (time REAL, position REAL, fwhm REAL, '
+                        'temperature REAL, filter TEXT)')
+        self.db.commit()
+
+        # the fitted coefficients, and the rms (in steps) of the residuals
+        self.zero, self.slope, self.mean = None, 0., 0.
+        self.offsets: Dict[str, float] = {}
+        self.rms = None
+        self.fit()
+
+        # the temperature and filter that the focus was last set for
+        self.temperature, self.filter = None, None
+
+        # the FWHM (in unbinned pixels) of the first frame after the focus
+        # was last verified, and of the most recent frame
+        self.reference, self.fwhm = None, None
+
+    @staticmethod
+    def normalize(filt: str) -> str:
+        """ Return the name of a filter as it is stored; the queue
+        quotes some filter names (i.e. '"[OIII]"').
+        """
+        return (filt or REFERENCE_FILTER).strip('"[]').lower()
+
+    def record(self, position: float, fwhm: float, temperature: float, filt: str) -> None:
+        """ Store the result of a focus run, and refit the model.
+
+        Parameters
+        ----------
+        position: float
+            The best focus position
+        fwhm: float
+            The FWHM (in unbinned pixels) at the best focus
+        temperature: float
+            The temperature (in C) during the run, or None if it is unknown
+        filt: str
+            The filter that the run was taken in
+        """
+        with self.lock:
+            self.db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?)',
+                            (time.time(), float(position), float(fwhm), temperature, self.normalize(filt)))
+            self.db.commit()
+
+        self.fit()
+
+        # the focus is now set for these conditions
+        self.temperature, self.filter = temperature, self.normalize(filt)
+        self.reference = None
+
+    def fit(self) -> Dict[str, float]:
+        """ Fit the model to the stored runs.
+
+        Returns the fitted coefficients; 'zero' and 'slope' (in steps and
+        steps per degree C), the 'mean' temperature, and the offset (in steps)
+        of each filter.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT position, temperature, filter FROM runs WHERE time > ? '
+                                   'ORDER BY time', (time.time() - self.max_age*24*60*60,)).fetchall()
+
+        if not rows:
+            self.zero, self.slope, self.mean, self.offsets, self.rms = None, 0., 0., {}, None
+            return {}
+
+        position = np.array([row[0] for row in rows])
+        filters = [row[2] for row in rows]
+
+        # runs without a temperature can only constrain the filter offsets,
+        # so they are only used until we can fit the temperature term
+        measured = np.array([row[1] is not None for row in rows])
+        temperature = np.array([row[1] if row[1] is not None else np.nan for row in rows])
+        fit_slope = (measured.sum() >= MIN_RUNS and
+                     np.ptp(temperature[measured]) >= MIN_SPAN)
+        if fit_slope:
+            position, temperature = position[measured], temperature[measured]
+            filters = [filt for filt, keep in zip(filters, measured) if keep]
+            self.mean = float(temperature.mean())
+        else:
+            self.mean = 0.
+
+        # the design matrix has a column for the zero point, the slope,
+        # and every filter other than the reference filter
+        others = sorted(set(filters) - {REFERENCE_FILTER})
+        columns = [np.ones(len(position))]
+        if fit_slope:
+            columns.append(temperature - self.mean)
+        columns += [np.array([filt == other for filt in filters], dtype=float) for other in others]
+
+        # if the reference filter has never been focused, the first other filter is the reference
+        A = np.vstack(columns).T
+        if REFERENCE_FILTER not in filters and others:
+            A, others = np.delete(A, 1 + fit_slope, axis=1), others[1:]
+
+        coefficients = np.linalg.lstsq(A, position, rcond=None)[0]
+        residuals = A @ coefficients - position
+
+        self.zero = float(coefficients[0])
+        self.slope = float(coefficients[1]) if fit_slope else 0.
+        self.offsets = dict(zip(others, coefficients[1 + fit_slope:].tolist()))
+        self.rms = float(np.sqrt(np.mean(residuals**2)))
+
+        return dict({'zero': self.zero, 'slope': self.slope, 'mean': self.mean}, **self.offsets)
+
+    def predict(self, temperature: float, filt: str = REFERENCE_FILTER) -> float:
+        """ Return the best focus position at `temperature` (in C) in `filt`,
+        or None if there have been no focus runs.
+        """
+        if self.zero is None:
+            return None
+
+        position = self.zero + self.offsets.get(self.normalize(filt), 0.)
+        if temperature is not None:
+            position += self.slope*(temperature - self.mean)
+
+        return position
+
+    def measured(self, fwhm: float) -> None:
+        """ Record the FWHM (in unbinned pixels) of the stars in a recent frame.
+        """
+        if not np.isfinite(fwhm):
+            return
+
+        self.fwhm = fwhm
+        if self.reference is None:
+            self.reference = fwhm
+
+    @property
+    def drifted(self) -> bool:
+        """ Whether the FWHM has grown past DRIFT since the focus was last verified.
+        """
+        return (self.reference is not None and self.fwhm is not None and
+                self.fwhm > (1 + DRIFT)*self.reference)
+
+    def adjust(self, telescope: 'Telescope', filt: str = REFERENCE_FILTER) -> float:
+        """ Keep the telescope in focus for an exposure in `filt`.
+
+        If there have never been any focus runs, the full range is searched on
+        the current field. If the image quality has drifted, a short sweep around the
+        predicted focus is run on the current field. Otherwise, the focus is
+        only moved to the prediction of the model when the temperature or the
+        filter has changed.
+
+        Returns the focus position that was set, or None if it was not changed.
+        """
+        # we have nothing to predict from, so search the whole range on this field
+        if self.zero is None:
+            telescope.log.info('There is no focus history; running a full focus sweep...')
+            folder = "focus_"+str(strftime("%Y-%m-%d_%Hh%Mm%Ss", gmtime()))
+            best, _ = sweep(telescope, folder, 'field', *FOCUS_RANGE, filt=filt)
+            return best if np.isfinite(best) else None
+
+        current = temperature(telescope)
+        prediction = self.predict(current, filt)
+
+        # the image quality has degraded, so check the prediction
+        if self.drifted:
+            telescope.log.info(f'FWHM has grown from {self.reference:.2f} to {self.fwhm:.2f} pixels; '
+                               f'verifying focus around {prediction:.0f}...')
+            folder = "verify_"+str(strftime("%Y-%m-%d_%Hh%Mm%Ss", gmtime()))
+            best, _ = sweep(telescope, folder, 'verify', prediction - VERIFY_WIDTH, prediction + VERIFY_WIDTH,
+                            points=VERIFY_POINTS, max_frames=VERIFY_FRAMES, filt=filt)
+            self.fwhm = None
+            if np.isfinite(best):
+                return best
+            self.reference = None
+
+        # only move the focuser if the conditions have changed
+        elif (self.normalize(filt) == self.filter and
+              (current is None or self.temperature is None or
+               abs(current - self.temperature) < TEMPERATURE_STEP)):
+            return None
+
+        telescope.log.info(f'Setting predicted focus of {prediction:.0f} for {self.normalize(filt)} '
+                           f'at {current} C (rms {self.rms:.1f} steps)')
+        telescope.set_focus(int(round(prediction)))
+        self.temperature, self.filter = current, self.normalize(filt)
+
+        return prediction
+
+
+# the model shared by everything in this process
+_model: FocusModel = None
+_model_lock = threading.Lock()
+
+
+def model() -> FocusModel:
+    """ Return the focus model for this process, loading it if necessary.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = FocusModel()
 
+        return _model
@@ -5,7 +5,174 @@ import astropy.units as units
 import astropy.time as time
 import astropy.coordinates as coordinates
 from astroplan import FixedTarget
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+import threading
 import datetime
+import sqlite3
+import json
+import os
+import re
+
+# where we persist resolved target names
+CACHE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'lookup.sqlite')
+
+# optional JSON file of names to seed the cache with, for use without a network
+FIXTURE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'targets.json')
+
+# how long (in seconds) we remember that a name could not be resolved
+NEGATIVE_TTL = 24*60*60
+
+# planetary bodies - TODO: Add moons
+solar_system = ['mercury','venus','moon','mars','jupiter','saturn','uranus','neptune','pluto']
+
+
+class NameCache(object):
+    """ A persistent cache mapping target names to (RA, Dec) strings.
+
+    Names are normalized before lookup so that 'M 31', 'm31' and 'M31' share
+    one entry. Names that Sesame could not resolve are also remembered, but
+    only for `negative_ttl` seconds.
+    """
+
+    def __init__(self, filename: str = CACHE_FILE, negative_ttl: int = NEGATIVE_TTL):
+        """ Open (and create if necessary) the SQLite cache at `filename`.
+        """
+        self.negative_ttl = negative_ttl
+
+        # the cache is shared between the scheduler and server threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, '
+                        'ra TEXT, dec TEXT, updated REAL)')
+        self.db.commit()
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        """ Return the normalized form of a target name; lowercase, without
+        any whitespace or underscores.
+        """
+        return re.sub(r'[\s_]+', '', name.lower())
+
+    def get(self, name: str) -> (bool, str, str):
+        """ Look up `name` in the cache.
+
+        Returns (found, ra, dec); if the name is known to be unresolvable,
+        found is True and ra and dec are None.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT ra, dec, updated FROM names WHERE name = ?',
+                                  (self.normalize(name),)).fetchone()
+
+        # we have never seen this name
+        if row is None:
+            return False, None, None
+
+        ra, dec, updated = row
+
+        # negative entries expire after negative_ttl seconds
+        if ra is None and (time.Time.now().unix - updated) > self.negative_ttl:
+            return False, None, None
+
+        return True, ra, dec
+
+    def put(self, name: str, ra: str, dec: str) -> None:
+        """ Store the (ra, dec) of `name`; ra and dec are None if the
+        name could not be resolved.
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?)',
+                            (self.normalize(name), ra, dec, time.Time.now().unix))
+            self.db.commit()
+
+    def load_fixture(self, filename: str) -> int:
+        """ Load a JSON file of the form {"M31": ["00:42:44", "+41:16:09"], ...}
+        into the cache so that lookups work without a network connection.
+
+        Returns the number of names that were loaded.
+        """
+        with open(filename) as fixture:
+            names = json.load(fixture)
+
+        for name, (ra, dec) in names.items():
+            self.put(name, ra, dec)
+
+        return len(names)
+
+
+# the cache shared by everything in this process
+_cache: NameCache = None
+
+
+def cache() -> NameCache:
+    """ Return the name cache for this process, opening it if necessary.
+    """
+    global _cache
+    if _cache is None:
+        _cache = NameCache()
+
+        # seed the cache from the local fixture if there is one
+        if os.path.exists(FIXTURE_FILE):
+            _cache.load_fixture(FIXTURE_FILE)
+
+    return _cache
+
+
+def resolve(target: str) -> (str, str):
+    """ Resolve a (non solar system) target name to an (RA, Dec) string
+    pair using the name cache, and Sesame if the name is not cached.
+
+    Returns (None, None) if the name cannot be resolved.
+    """
+    # check whether we have already seen this name
+    found, ra, dec = cache().get(target)
+    if found:
+        return ra, dec
+
+    try:
+        target_coordinates = coordinates.SkyCoord.from_name(target)
+        ra = target_coordinates.ra.to_string(unit=units.hour, sep=':')
+        dec = target_coordinates.dec.to_string(unit=units.degree, sep=':')
+    except coordinates.NameResolveError as e:
+        # only remember names that Sesame does not know; network errors are retried
+        if str(e).startswith('Unable to find coordinates'):
+            cache().put(target, None, None)
+        return None, None
+    except Exception as e:
+        return None, None
+
+    cache().put(target, ra, dec)
+    return ra, dec
+
+
+def prefetch(targets: List[str], workers: int = 8) -> Dict[str, tuple]:
+    """ Resolve a list of target names concurrently, so that later calls
+    to lookup() are answered from the cache.
+
+    Parameters
+    ----------
+    targets: List[str]
+        The target names to resolve; solar system bodies are skipped
+    workers: int
+        The maximum number of concurrent Sesame queries
+
+    Returns
+    -------
+    coordinates: Dict[str, tuple]
+        A map from each target name to its (RA, Dec) pair
+    """
+    # only query each normalized name once
+    names = {}
+    for target in targets:
+        if target and target.lower() not in solar_system:
+            names.setdefault(NameCache.normalize(target), target)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names)))) as pool:
+        resolved = dict(zip(names.values(), pool.map(resolve, names.values())))
+
+    return {target: resolved.get(names.get(NameCache.normalize(target)), (None, None))
+            for target in targets if target}
+
 
 """
 def lookup(obs):
@@ -44,7 +211,8 @@ def lookup(target: str) -> (str, str):
     of the observatory.
 
     Given a string representing a target ('M 31', 'NGC 4584', 'Horsehead Nebula')
-    return an (RA, DEC) string tuple of the form ('hh:mm:sss', 'dd:mm:ss')
+    return an (RA, DEC) string tuple of the form ('hh:mm:sss', 'dd:mm:ss'). Names
+    of stellar bodies are resolved through the persistent name cache.
 
 
     Parameters
@@ -64,38 +232,27 @@ def lookup(target: str) -> (str, str):
     Author: rprechelt
     """
 
-    # location of observatory
-    obs_location = coordinates.EarthLocation(lat=config.general.latitude*units.deg,
-                                             lon=config.general.longitude*units.deg,
-                                             height=config.general.altitude*units.m)
+    # we have a planetary body; these move so we never cache them
+    if target.lower() in solar_system:
 
-    obs_time = time.Time(datetime.datetime.utcnow(), scale='utc')
-    #obs_time = time.Time.now()
-    frame = coordinates.AltAz(obstime=obs_time, location=obs_location)
-
-    # planetary bodies - TODO: Add moons
-    solar_system = ['mercury','venus','moon','mars','jupiter','saturn','uranus','neptune','pluto']
-    coordinates.solar_system_ephemeris.set('de432s')
+        # location of observatory
+        obs_location = coordinates.EarthLocation(lat=config.general.latitude*units.deg,
+                                                 lon=config.general.longitude*units.deg,
+                                                 height=config.general.altitude*units.m)
 
-    # convert it all to lowercase
-    target = target.lower()
+        obs_time = time.Time(datetime.datetime.utcnow(), scale='utc')
+        #obs_time = time.Time.now()
+        coordinates.solar_system_ephemeris.set('de432s')
 
-    # we have a planetary body
-    if target in solar_system:
-        celestial_body = coordinates.get_body(target, obs_time, obs_location)
+        celestial_body = coordinates.get_body(target.lower(), obs_time, obs_location)
         return (celestial_body.ra.to_string(unit=units.hour, sep=':'),
                 celestial_body.dec.to_string(unit=units.degree,sep=':'))
     else: # stellar body
-        try:
-            #simbad_query = Simbad.query_object(target, True)
-            #ra = str(simbad_query['RA'][0]).replace(' ',':')
-            #dec = str(simbad_query['DEC'][0]).replace(' ',':')
-            #target_coordinates = SkyCoord(ra+' '+dec, unit=(u.hourangle, u.deg))
-            target_coordinates = coordinates.SkyCoord.from_name(target)
-            return (target_coordinates.ra.to_string(unit=units.hour,sep=':'),
-                    target_coordinates.dec.to_string(unit=units.degree,sep=':'))
-        except Exception as e:
-            return None, None
+        #simbad_query = Simbad.query_object(target, True)
+        #ra = str(simbad_query['RA'][0]).replace(' ',':')
+        #dec = str(simbad_query['DEC'][0]).replace(' ',':')
+        #target_coordinates = SkyCoord(ra+' '+dec, unit=(u.hourangle, u.deg))
+        return resolve(target)
 
 def target_visible(target: str) -> bool:
     """ Check whether an object is visible.
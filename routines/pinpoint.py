@@ -6,8 +6,10 @@ import re
 import typing
 import astropy.coordinates as coordinates
 import astropy.units as units
-from astropy.io.fits import getheader
+from astropy.io.fits import getheader, getdata
 from config import config
+from routines import focus, pointing, solver
+import tempfile
 import os
 
 # def point(ra: str, dec: str, telescope: 'Telescope') -> bool:
@@ -146,7 +148,62 @@ import os
 #     return output
 
 
-def point(ra: str, dec: str, telescope: 'Telescope', point: bool = True) -> bool:
+def remote_solve(fits_fname: str, ra: float, dec: float, telescope: 'Telescope') -> dict:
+    """ Solve an image on the telescope server with solve-field, and return the center
+    of the field (in degrees) as {'ra': , 'dec': }, or None if it couldn't be solved.
+
+    This is only used if solve-field is not installed locally.
+    """
+    astrometry = config.astrometry
+    output = telescope.run_command(
+        'cd $(mktemp -d) && /home/chultun/astrometry/bin/solve-field --no-verify --overwrite --no-remove-lines '
+        '--dir . --new-fits none --downsample %d --scale-units arcsecperpix --no-plots '
+        '--scale-low %f --scale-high %f --ra %s --dec %s --radius %f --cpulimit %d %s; '
+        'cd /tmp && rm -rf "$OLDPWD"' % (astrometry.downsample, astrometry.scale_low, astrometry.scale_high,
+                                         ra, dec, astrometry.radius, astrometry.cpu_limit, fits_fname))
+
+    # look for field center in solve-field output
+    match = re.search(
+        r'Field center\: \(RA,Dec\) \= \(([0-9\-\.\s]+)\,([0-9\-\.\s]+)\) deg\.', output)
+    if match:
+        return {'ra': float(match.group(1).strip()), 'dec': float(match.group(2).strip())}
+
+    telescope.log.error("Field center RA/DEC not found in solve-field output.")
+    return None
+
+
+def slew(ra: str, dec: str, telescope: 'Telescope', rough: bool = False) -> typing.Optional[typing.Tuple[float, float]]:
+    """ Slew the telescope to a given RA/Dec ('hh:mm:ss', 'dd:mm:ss'), corrected by the
+    pointing model so that it lands (nearly) on target.
+
+    Returns the position (in degrees) that the telescope was commanded to, which
+    should be passed to point() so that the first solve is recorded against it,
+    or None if the slew failed (i.e. the target is not visible).
+    """
+    ra_target = coordinates.Angle(ra, unit=units.hourangle).degree
+    dec_target = coordinates.Angle(dec, unit=units.deg).degree
+
+    model = pointing.model()
+    commanded = model.correct(ra_target, dec_target)
+    telescope.log.debug('Pointing model correction: dRA=%f, dDEC=%f (rms %s)' % (
+        commanded[0] - ra_target, commanded[1] - dec_target, model.rms))
+
+    if telescope.goto_point(ra=coordinates.Angle(commanded[0], unit=units.deg).to_string(unit=units.hour, sep=':'),
+                            dec=coordinates.Angle(commanded[1], unit=units.deg).to_string(unit=units.deg, sep=':'),
+                            rough=rough) is False:
+        return None
+
+    return commanded
+
+
+def point(ra: str, dec: str, telescope: 'Telescope', point: bool = True,
+          commanded: typing.Tuple[float, float] = None) -> bool:
+    """ Pinpoint the telescope to a given RA/Dec, slewing there first if `point`.
+
+    If the telescope has already been slewed (see slew()), `commanded` is the
+    position (in degrees) that it was commanded to; the first solved image is
+    recorded against it in the pointing model.
+    """
     base_path = '/tmp/'
 
     # we try and parse RA and DEC
@@ -181,9 +238,10 @@ def point(ra: str, dec: str, telescope: 'Telescope', point: bool = True) -> bool
         telescope.open_dome()
         telescope.keep_open(600)
 
-    # if initial pointing is requested, do that
+    # if initial pointing is requested, do that; the slew is corrected by
+    # the pointing model so that the first image is (nearly) on target
     if point:
-        status = telescope.goto_point(ra=str(ra), dec=str(dec), rough=True)
+        commanded = slew(ra, dec, telescope, rough=True)
 
     # get current filter
     current_filter = telescope.current_filter()
@@ -223,37 +281,34 @@ def point(ra: str, dec: str, telescope: 'Telescope', point: bool = True) -> bool
                     "RA/DEC not found in input FITS header (%s)." % fits_fname)
                 pass
 
-        astro_cmd = '/home/chultun/astrometry/bin/solve-field ' + '--no-verify ' + '--overwrite ' + '--no-remove-lines ' + '--downsample %d ' % downsample + '--scale-units ' + 'arcsecperpix ' + '--no-plots ' + \
-            '--scale-low %f ' % scale_low + '--scale-high %f ' % scale_high + '--ra %s ' % ra_target + \
-            '--dec %s ' % dec_target + '--radius %f ' % radius + \
-            '--cpulimit %d ' % cpu_limit + '%s' % fits_fname
-
-        output = telescope.run_command(astro_cmd)
-
-        # remove astrometry.net temporary files
-        try:
-            os.remove(fits_fname)
-            os.remove(base_path+'pointing-indx.xyls')
-            os.remove(base_path+'pointing.axy')
-            os.remove(base_path+'pointing.corr')
-            os.remove(base_path+'pointing.match')
-            os.remove(base_path+'pointing.rdls')
-            os.remove(base_path+'pointing.solved')
-            os.remove(base_path+'pointing.wcs')
-            os.remove(base_path+'pointing.new')
-        except:
-            pass
-
-        # look for field center in solve-field output
-        match = re.search(
-            'Field center\: \(RA,Dec\) \= \(([0-9\-\.\s]+)\,([0-9\-\.\s]+)\) deg\.', output)
-        if match:
-            RA_image = match.group(1).strip()
-            DEC_image = match.group(2).strip()
+        # copy the frame here once, and solve it locally; if we can't,
+        # fall back to solving it on the telescope server
+        solution = None
+        local_fname = os.path.join(tempfile.gettempdir(), 'pinpoint-%d.fits' % os.getpid())
+        if solver.solver_binary() and telescope.copy_remote_to_local(fits_fname, local_fname):
+            solution = solver.solver().solve(local_fname, ra_target, dec_target)
+            telescope.log.debug('Median solve time is %.1fs.' % solver.solver().median_time)
+            # the frame also tells us whether the telescope is still in focus
+            try:
+                focus.model().measured(binning*focus.measure_fwhm(getdata(local_fname)))
+            except Exception as e:
+                telescope.log.debug('Unable to measure FWHM of pinpoint image: %s' % e)
+            try:
+                os.remove(local_fname)
+            except OSError:
+                pass
         else:
-            telescope.log.error(
-                "Field center RA/DEC not found in solve-field output.")
-            pass
+            solution = remote_solve(fits_fname, ra_target, dec_target, telescope)
+
+        if solution is None:
+            telescope.log.error('Unable to solve pinpoint image.')
+            continue
+        RA_image, DEC_image = solution['ra'], solution['dec']
+
+        # the first image after a slew tells us the pointing error at the commanded position
+        if commanded is not None:
+            pointing.model().record(commanded[0], commanded[1], float(RA_image), float(DEC_image))
+            commanded = None
 
         ra_offset = float(ra_target)-float(RA_image)
         if ra_offset > 350:
@@ -283,8 +338,6 @@ def point(ra: str, dec: str, telescope: 'Telescope', point: bool = True) -> bool
         telescope.log.error(
             'Exceeded maximum number of adjustments (%d).' % max_tries)
 
-    telescope.log.debug(output)
-
     telescope.change_filter(current_filter)
 
     return status
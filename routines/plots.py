@@ -7,14 +7,14 @@ import matplotlib
 # matplotlib.use('Agg') # to stop server crashing without backend
 import numpy as np
 import astroplan
-from astroplan.plots import plot_finder_image
 import astropy.units as units
 import astropy.time as time
 import astropy.coordinates as coordinates
 import matplotlib.pyplot as plt
 import astropy.coordinates as coordinates
 from config import config
-from routines import lookup
+from routines import lookup, ephemeris, cutouts
+from typing import List, Dict
 from astropy.coordinates import Angle
 
 # load our matplotlib stylesheet from config/
@@ -35,83 +35,98 @@ def visibility_curve(target: str, logger, **kwargs) -> matplotlib.figure.Figure:
         @mcnowinski
         @rprechelt
     """
+    return visibility_curves([target], logger, **kwargs).get(target)
 
-    # convert target name to RA/Dec and make SkyCoord object
-    try:
-        ra, dec = lookup.lookup(target)
-        target_coord = coordinates.SkyCoord(Angle(ra,units.hourangle), Angle(dec,units.degree))
-    except Exception as e:
-        print('An error occured locating the object')
-        logger.debug("An error occured locating the object")
-        return None
 
-    # create observer location
-    observer = coordinates.EarthLocation(lat=config.general.latitude*units.deg,
-                                             lon=config.general.longitude*units.deg,
-                                             height=config.general.altitude*units.m)
+def visibility_curves(targets: List[str], logger, **kwargs) -> Dict[str, matplotlib.figure.Figure]:
+    """ Generate the visibility curves of many targets for the next 24 hours.
+
+    The observer, the time grid, and the sun are shared by every target (and
+    every call in the same 10 minutes), and all the targets are transformed
+    at once.
+
+    Parameters
+    ----------
+    targets: List[str]
+        The names of the targets.
+        Will be converted to RA/Dec using the code in /lookup.
+
+    Returns
+    -------
+    figures: Dict[str, matplotlib.figure.Figure]
+        The figure for each target that could be located
+    """
 
-    # compute the times at which we sample objects visibility
-    now = time.Time(datetime.datetime.utcnow(), scale='utc')
-    delta_times = np.linspace(0, 24, 12*24)*units.hour
-    sample_times = now + delta_times
+    # convert target names to RA/Dec
+    points = {}
+    for target in targets:
+        try:
+            ra, dec = lookup.lookup(target)
+            if ra is None:
+                raise ValueError(f'Unable to resolve {target}')
+            points[target] = (ra, dec)
+        except Exception as e:
+            logger.debug("An error occured locating the object")
 
-    # compute altaz for object and sun at sample times
-    sample_frames = coordinates.AltAz(obstime=sample_times, location=observer)
-    object_altaz = target_coord.transform_to(sample_frames)
-    sun_altaz = coordinates.get_sun(sample_times).transform_to(sample_frames)
+    # the ephemeris for the next 24 hours, shared with other requests
+    window = ephemeris.window(hours=24, npoints=12*24)
+    window.add(list(points.values()))
 
-    # sidereal angle at sample times
-    sample_sidereal = now.sidereal_time('mean', config.general.longitude*units.deg) + \
-                      np.linspace(0, 24, 12*24)*units.hourangle
+    # the window starts up to 10 minutes ago, so shift it to start from now
+    delta_times = np.linspace(0, 24, 12*24) + (window.start - time.Time.now()).to_value('hr')
 
-    # process hour angles so that they are always less than 18
-    hour_angles = np.zeros(len(sample_sidereal))
-    # TODO: I feel like this could be made cleanere?
-    for i, angle in enumerate((sample_sidereal - target_coord.ra).hour):
-        if angle >= 18:
-            hour_angles[i] = angle-24
-        elif angle <= -18:
-            hour_angles[i] = angle+24
-        else:
-            hour_angles[i] = angle
+    # backgrounds for night and twilight are the same for every target
+    night = window.sun_alt < -0
+    dark = window.sun_alt < -18
 
-    # create the fig
-    fig, ax = plt.subplots(subplot_kw={'facecolor': 'white'}, **kwargs)
+    figures = {}
+    for target, (ra, dec) in points.items():
+        row = window.row(ra, dec)
+        if row is None:
+            continue
 
-    # plot object altitude
-    scatter = ax.scatter(delta_times, object_altaz.alt, c=object_altaz.az, cmap='viridis', label=target)
+        # hour angles between -12 and 12
+        hour_angles = window.hour_angle(row)[0]
 
-    # fill background depending upon sun
-    ax.fill_between(delta_times.to('hr').value, 0, 90, sun_altaz.alt < -0*units.deg,
-                    color='0.5', zorder=0)
-    ax.fill_between(delta_times.to('hr').value, 0, 90, sun_altaz.alt < -18*units.deg,
-                    color='k', zorder=0)
+        # create the fig
+        fig, ax = plt.subplots(subplot_kw={'facecolor': 'white'}, **kwargs)
 
-    # fill hour angle <= 5.3
-    ax.fill_between(delta_times.to('hr').value, 0, 90, np.abs(hour_angles) <= 5.3,
-                    color='LightBlue', alpha=0.4, zorder=0)
+        # plot object altitude
+        scatter = ax.scatter(delta_times, window.alt[row], c=window.az[row], cmap='viridis', label=target)
 
-    # add colorbar
-    fig.colorbar(scatter).set_label('Azimuth [deg]')
+        # fill background depending upon sun
+        ax.fill_between(delta_times, 0, 90, night, color='0.5', zorder=0)
+        ax.fill_between(delta_times, 0, 90, dark, color='k', zorder=0)
 
-    # horizontal line at minimum-altitude
-    ax.axhline(config.telescope.min_alt, color='red', linestyle='dashed')
+        # fill hour angle <= 5.3
+        ax.fill_between(delta_times, 0, 90, np.abs(hour_angles) <= 5.3,
+                        color='LightBlue', alpha=0.4, zorder=0)
 
-    # configure x-axis
-    ax.set_xlim([0, 24])
-    ax.set_xticks(np.arange(13)*2)
-    ax.set_xlabel('Hours [from now]')
+        # add colorbar
+        fig.colorbar(scatter).set_label('Azimuth [deg]')
 
-    # configure y-axis
-    ax.set_ylim([0, 90])
-    ax.set_ylabel('Altitude [deg]')
+        # horizontal line at minimum-altitude
+        ax.axhline(config.telescope.min_alt, color='red', linestyle='dashed')
 
-    return fig
+        # configure x-axis
+        ax.set_xlim([0, 24])
+        ax.set_xticks(np.arange(13)*2)
+        ax.set_xlabel('Hours [from now]')
+
+        # configure y-axis
+        ax.set_ylim([0, 90])
+        ax.set_ylabel('Altitude [deg]')
+
+        figures[target] = fig
+
+    return figures
 
 
 def target_preview(target: str, **kwargs) -> matplotlib.figure.Figure:
     """ Generate a static image preview of a target.
 
+    The image comes from the local cutout store (see /routines/cutouts.py),
+    and is only downloaded if it is not already there.
 
     Parameters
     ----------
@@ -122,16 +137,20 @@ def target_preview(target: str, **kwargs) -> matplotlib.figure.Figure:
     -------
         @rprechelt
     """
-    # lookup target with astroquery
-    target = astroplan.FixedTarget.from_name(target)
+    # lookup target with the name cache
+    try:
+        ra, dec = lookup.lookup(target)
+        image = cutouts.load(*cutouts.parse(ra, dec))
+    except Exception as e:
+        return None
 
     # if we have found a target
-    if target:
+    if image is not None:
 
         fig, ax = plt.subplots()
 
-        # plot the finder image with astroplan
-        ax, hdu = plot_finder_image(target, fov_radius=26*units.arcmin, ax=ax)
+        # plot the finder image
+        cutouts.render(image, ax)
 
         # disable all the extraneous jazz
         ax.set_axis_off()
@@ -139,7 +158,3 @@ def target_preview(target: str, **kwargs) -> matplotlib.figure.Figure:
 
         # and we are done
         return fig
-
-
-
-
@@ -0,0 +1,206 @@
+""" This file provides a pointing model for the telescope. Every offset solved by
+pinpoint is stored, and a TPOINT-style model of the mount's pointing errors is
+fit to them, so that slews can be corrected before the first pinpoint exposure.
+"""
+import os
+import sqlite3
+import threading
+import numpy as np
+import astropy.units as units
+from astropy.time import Time
+from config import config
+from typing import Dict, Tuple
+
+# where we persist the solved pointing errors
+POINTING_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'pointing.sqlite')
+
+# only samples from the last MAX_AGE days are used in the fit
+MAX_AGE = 90
+
+# the terms of the model, and the minimum number of samples before they are fit
+BASIC_TERMS = ['IH', 'ID']
+FULL_TERMS = ['IH', 'ID', 'CH', 'NP', 'MA', 'ME', 'TF']
+MIN_SAMPLES = {'basic': 3, 'full': 12}
+
+
+class PointingModel(object):
+    """ A model of the pointing errors of an equatorial mount, and the
+    solved pointing errors that it is fit to.
+
+    The model uses the standard TPOINT terms; the index errors in HA and Dec
+    (IH, ID), the collimation error (CH), the non-perpendicularity of the axes
+    (NP), the misalignment of the polar axis in azimuth and elevation (MA, ME),
+    and tube flexure (TF). If both sides of the pier are in the data, each side
+    has its own index errors. Until there are enough samples for the full model,
+    only the index errors are fit.
+
+    Errors are in degrees, and are the position of the image minus the
+    position that the telescope was commanded to.
+    """
+
+    def __init__(self, filename: str = POINTING_FILE, max_age: float = MAX_AGE):
+        """ Open (and create if necessary) the SQLite store at `filename`,
+        and fit the model to the samples in it.
+        """
+        self.max_age = max_age
+
+        # the latitude of the observatory
+        self.latitude = np.radians(config.general.latitude)
+
+        # the store is shared between threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples (time REAL, ra REAL, dec REAL, '
+                        'ha REAL, alt REAL, az REAL, pier INTEGER, dra REAL, ddec REAL)')
+        self.db.commit()
+
+        # the fitted coefficients (in degrees) of each term, and the rms of the residuals
+        self.terms: Dict[str, float] = {}
+        self.rms = None
+        self.fit()
+
+    @staticmethod
+    def sidereal_time(time: Time = None) -> float:
+        """ Return the local mean sidereal time (in degrees) at `time` (default: now).
+        """
+        time = time or Time.now()
+        return time.sidereal_time('mean', longitude=config.general.longitude*units.deg).degree
+
+    @staticmethod
+    def pier(ha: float) -> int:
+        """ Return the side of the pier that the telescope is on when pointing at
+        hour angle `ha` (in degrees); +1 when west of the meridian, and -1 when east.
+
+        The controller doesn't report the pier side, so we infer it from the hour angle.
+        """
+        return 1 if (ha + 180) % 360 - 180 >= 0 else -1
+
+    def altaz(self, ha: np.ndarray, dec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return the (alt, az) in degrees of the given hour angles and declinations.
+        """
+        h, d, phi = np.radians(ha), np.radians(dec), self.latitude
+        alt = np.arcsin(np.sin(phi)*np.sin(d) + np.cos(phi)*np.cos(d)*np.cos(h))
+        az = np.arctan2(-np.cos(d)*np.sin(h), np.sin(d)*np.cos(phi) - np.cos(d)*np.cos(h)*np.sin(phi))
+        return np.degrees(alt), np.degrees(az) % 360
+
+    def record(self, ra: float, dec: float, ra_image: float, dec_image: float,
+               time: Time = None) -> None:
+        """ Store a solved pointing error, and refit the model.
+
+        Parameters
+        ----------
+        ra, dec: float
+            The position (in degrees) that the telescope was commanded to
+        ra_image, dec_image: float
+            The solved position (in degrees) of the center of the image
+        time: Time
+            When the image was taken (default: now)
+        """
+        time = time or Time.now()
+        ha = (self.sidereal_time(time) - ra + 180) % 360 - 180
+        alt, az = self.altaz(ha, dec)
+        dra = (ra_image - ra + 180) % 360 - 180
+        ddec = dec_image - dec
+
+        with self.lock:
+            self.db.execute('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (time.unix, ra, dec, ha, float(alt), float(az), self.pier(ha), dra, ddec))
+            self.db.commit()
+
+        self.fit()
+
+    def design(self, ha: np.ndarray, dec: np.ndarray, pier: np.ndarray, terms: list) -> np.ndarray:
+        """ Return the design matrix of the model for the given positions (in degrees).
+
+        The first half of the rows are the errors in HA (scaled by cos(dec), so that
+        every row is an angle on the sky), and the second half the errors in Dec.
+        """
+        h, d, phi = np.radians(ha), np.radians(dec), self.latitude
+        zero, one = np.zeros_like(h), np.ones_like(h)
+
+        # the effect of each term on (HA cos(dec), Dec)
+        columns = {'IH': (np.cos(d), zero),
+                   'ID': (zero, one),
+                   'CH': (one, zero),
+                   'NP': (np.sin(d), zero),
+                   'MA': (-np.cos(h)*np.sin(d), np.sin(h)),
+                   'ME': (np.sin(h)*np.sin(d), np.cos(h)),
+                   'TF': (np.cos(phi)*np.sin(h), np.cos(phi)*np.cos(h)*np.sin(d) - np.sin(phi)*np.cos(d)),
+                   'PIH': (pier*np.cos(d), zero),
+                   'PID': (zero, pier*one)}
+
+        return np.vstack([np.concatenate(columns[term]) for term in terms]).T
+
+    def fit(self) -> Dict[str, float]:
+        """ Fit the model to the stored samples, rejecting outliers.
+
+        Returns the fitted coefficients (in degrees) of each term.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT ha, dec, pier, dra, ddec FROM samples WHERE time > ?',
+                                   (Time.now().unix - self.max_age*24*60*60,)).fetchall()
+
+        # choose the terms that the data can constrain
+        if len(rows) < MIN_SAMPLES['basic']:
+            self.terms, self.rms = {}, None
+            return self.terms
+        terms = list(FULL_TERMS if len(rows) >= MIN_SAMPLES['full'] else BASIC_TERMS)
+
+        ha, dec, pier, dra, ddec = np.array(rows, dtype=float).T
+        if len(np.unique(pier)) > 1:
+            terms += ['PIH', 'PID']
+
+        # an error of +dRA in the image is an error of -dHA in the pointing
+        A = self.design(ha, dec, pier, terms)
+        b = np.concatenate([-dra*np.cos(np.radians(dec)), ddec])
+
+        # fit, then refit without any samples that are more than 3 sigma away
+        keep = np.ones(len(rows), dtype=bool)
+        for _ in range(2):
+            mask = np.concatenate([keep, keep])
+            coefficients = np.linalg.lstsq(A[mask], b[mask], rcond=None)[0]
+            residuals = np.hypot(*np.split(A @ coefficients - b, 2))
+            rms = np.sqrt(np.mean(residuals[keep]**2))
+            keep = residuals <= max(3*rms, 1/3600.)
+
+        self.terms = dict(zip(terms, coefficients.tolist()))
+        self.rms = float(rms)
+
+        return self.terms
+
+    def predict(self, ra: float, dec: float, time: Time = None) -> Tuple[float, float]:
+        """ Return the (dRA, dDec) pointing error (in degrees) that we expect when
+        pointing at (ra, dec), in degrees, at `time` (default: now).
+        """
+        if not self.terms:
+            return 0., 0.
+
+        ha = (self.sidereal_time(time) - ra + 180) % 360 - 180
+        A = self.design(np.atleast_1d(ha), np.atleast_1d(dec), np.atleast_1d(self.pier(ha)),
+                        list(self.terms))
+        dha_cos, ddec = A @ np.array(list(self.terms.values()))
+
+        return -float(dha_cos)/np.cos(np.radians(dec)), float(ddec)
+
+    def correct(self, ra: float, dec: float, time: Time = None) -> Tuple[float, float]:
+        """ Return the position (in degrees) that the telescope should be commanded
+        to in order to point at (ra, dec), in degrees, at `time` (default: now).
+        """
+        dra, ddec = self.predict(ra, dec, time)
+        return (ra - dra) % 360, float(np.clip(dec - ddec, -90, 90))
+
+
+# the model shared by everything in this process
+_model: PointingModel = None
+_model_lock = threading.Lock()
+
+
+def model() -> PointingModel:
+    """ Return the pointing model for this process, loading it if necessary.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = PointingModel()
+
+        return _model
@@ -0,0 +1,461 @@
+""" This file provides a reduction pipeline for the frames of an observation. Master
+bias, dark and flat frames are built with sigma-clipped median combines, and the
+science frames are then calibrated in a process pool and written to processed/.
+
+Every frame is read through a memory map, a band of rows at a time, and every
+output is streamed to disk in the same bands, so the memory used is bounded
+regardless of the number of frames or the size of the chip.
+
+Observations are reduced from the local copy of their frames made by the ingest
+server, with `atlas reduce DIRECTORY [--flats FLAT ...]` (or by running this
+file directly, which can also `--benchmark` the pipeline on synthetic frames).
+
+The ingest server only copies the raw/science, raw/dark and raw/bias frames of
+each observation. Sky flats are written by flats.take_flats to the home directory
+of the telescope user on the control server (as flat_<filter>_..._seo.fits), so
+the flats of a night have to be copied from there and passed with --flats.
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import collections
+import tempfile
+import numpy as np
+import concurrent.futures
+from astropy.io import fits
+from typing import Dict, List, Optional, Tuple
+
+# the memory (in bytes) that each process may use for the band of rows it is combining
+MEMORY = 256*1024*1024
+
+# the number of standard deviations at which pixels are rejected, and the
+# maximum number of rejection passes, when combining frames
+SIGMA = 3.
+ITERATIONS = 3
+
+# the header keywords that hold the exposure time and the filter
+EXPTIME_KEYS = ['EXPTIME', 'EXPOSURE']
+FILTER_KEYS = ['FILTER']
+
+
+def exposure_time(header: fits.Header) -> float:
+    """ Return the exposure time (in seconds) in `header`, or 0 if it isn't there.
+    """
+    for key in EXPTIME_KEYS:
+        if key in header:
+            return float(header[key])
+
+    return 0.
+
+
+def filter_name(header: fits.Header) -> str:
+    """ Return the name of the filter in `header`, or 'unknown' if it isn't there.
+    """
+    for key in FILTER_KEYS:
+        if key in header:
+            return str(header[key]).strip().strip('"[]').lower()
+
+    return 'unknown'
+
+
+def shape(path: str) -> Tuple[int, int]:
+    """ Return the (rows, columns) of the image in the FITS file `path`.
+    """
+    header = fits.getheader(path)
+    return header['NAXIS2'], header['NAXIS1']
+
+
+def read_rows(path: str, start: int, stop: int) -> np.ndarray:
+    """ Return rows [start, stop) of the image in the FITS file `path` as float32;
+    only those rows are read from disk.
+    """
+    # scaling the data (i.e. unsigned 16-bit images) in astropy would read all of it
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdus:
+        header, data = hdus[0].header, hdus[0].data
+        rows = np.array(data[start:stop], dtype=np.float32)
+
+    bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+    if bscale != 1:
+        rows *= np.float32(bscale)
+    if bzero != 0:
+        rows += np.float32(bzero)
+
+    return rows
+
+
+def bands(rows: int, columns: int, frames: int, memory: int = MEMORY) -> List[Tuple[int, int]]:
+    """ Return the [start, stop) of each band of rows, so that a band of `frames`
+    frames (and the temporary arrays used to combine them) fits in `memory` bytes.
+    """
+    # the stack of frames, and about three more arrays of the same size while clipping
+    height = max(1, int(memory // (4*4*max(frames, 1)*columns)))
+    return [(start, min(start + height, rows)) for start in range(0, rows, height)]
+
+
+def middle(stack: np.ndarray, first: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """ Return the median of the `count` values from index `first` along the first
+    axis of `stack`, which must be sorted along that axis.
+    """
+    low = np.take_along_axis(stack, (first + (count - 1)//2)[None], 0)[0]
+    high = np.take_along_axis(stack, (first + count//2)[None], 0)[0]
+
+    return 0.5*(low + high)
+
+
+def clipped_median(stack: np.ndarray, sigma: float = SIGMA, iterations: int = ITERATIONS) -> np.ndarray:
+    """ Return the sigma-clipped median along the first axis of `stack`. Pixels more
+    than `sigma` robust standard deviations (from the median absolute deviation)
+    from the median are rejected, and the median recomputed, until none are
+    rejected or after `iterations` passes.
+
+    `stack` is sorted in place.
+    """
+    # the stack is sorted once; as clipping is symmetric about the median, the values
+    # that remain are always a contiguous run of it, so each median is just an index
+    stack.sort(axis=0)
+    first = np.zeros(stack.shape[1:], dtype=np.intp)
+    count = np.full(stack.shape[1:], len(stack), dtype=np.intp)
+    median = middle(stack, first, count)
+    if len(stack) < 3:
+        return median
+
+    valid = np.ones(stack.shape, dtype=bool)
+    for _ in range(iterations):
+        deviation = np.abs(stack - median)
+        absolute = np.where(valid, deviation, np.inf)
+        absolute.sort(axis=0)
+        std = 1.4826*middle(absolute, np.zeros_like(first), count)
+        del absolute
+
+        keep = valid & (deviation <= sigma*np.maximum(std, np.finfo(np.float32).tiny))
+        if (keep == valid).all():
+            break
+        valid = keep
+        first = np.argmax(valid, axis=0)
+        count = np.maximum(valid.sum(axis=0), 1)
+        median = middle(stack, first, count)
+
+    return median
+
+
+def combine_band(paths: List[str], start: int, stop: int, bias: Optional[str], dark: Optional[str],
+                 exptimes: List[float], scales: List[float], sigma: float = SIGMA) -> np.ndarray:
+    """ Combine rows [start, stop) of the frames in `paths`. This runs in a worker process.
+
+    Each frame is corrected as (frame - bias - exptime*dark)/scale before the
+    frames are combined, where `bias` and `dark` are the paths of master frames
+    (or None), and `exptimes` and `scales` are given for each frame.
+    """
+    stack = np.empty((len(paths), stop - start, shape(paths[0])[1]), dtype=np.float32)
+    for i, path in enumerate(paths):
+        stack[i] = read_rows(path, start, stop)
+
+    if bias:
+        stack -= read_rows(bias, start, stop)
+    if dark:
+        stack -= np.asarray(exptimes, dtype=np.float32)[:, None, None]*read_rows(dark, start, stop)
+    stack /= np.asarray(scales, dtype=np.float32)[:, None, None]
+
+    return clipped_median(stack, sigma)
+
+
+def output_header(header: fits.Header, history: str) -> fits.Header:
+    """ Return a copy of `header` for a float32 image derived from it, with `history`.
+    """
+    header = header.copy()
+    for key in ['BZERO', 'BSCALE', 'BLANK']:
+        header.remove(key, ignore_missing=True)
+    header['BITPIX'] = -32
+    header['HISTORY'] = history
+
+    return header
+
+
+def combine(pool: concurrent.futures.Executor, paths: List[str], output: str, bias: str = None,
+            dark: str = None, scales: List[float] = None, history: str = 'Combined') -> str:
+    """ Combine the frames in `paths` with a sigma-clipped median, band by band
+    over `pool`, and stream the master frame to `output`.
+
+    Parameters
+    ----------
+    pool: concurrent.futures.Executor
+        The pool of worker processes
+    paths: List[str]
+        The frames to be combined
+    output: str
+        Where to write the master frame
+    bias, dark: str
+        The master bias, and master dark (per second), to subtract from each frame
+    scales: List[float]
+        The value to divide each frame by, after subtracting the bias and dark
+    history: str
+        The HISTORY of the master frame
+
+    Returns
+    -------
+    output: str
+        The path of the master frame
+    """
+    rows, columns = shape(paths[0])
+    headers = [fits.getheader(path) for path in paths]
+    exptimes = [exposure_time(header) for header in headers]
+    scales = scales or [1.]*len(paths)
+
+    header = output_header(headers[0], f'{history} from {len(paths)} frames')
+    header['NCOMBINE'] = len(paths)
+
+    # each band is combined by a worker, and written in order as soon as it is ready;
+    # a band is released as soon as it is written
+    temporary = output + '.part'
+    stream = fits.StreamingHDU(temporary, header)
+    try:
+        futures = collections.deque(pool.submit(combine_band, paths, start, stop, bias, dark,
+                                                exptimes, scales)
+                                    for start, stop in bands(rows, columns, len(paths)))
+        while futures:
+            stream.write(futures.popleft().result().astype(np.float32))
+    finally:
+        stream.close()
+    os.replace(temporary, output)
+
+    return output
+
+
+def level(path: str, bias: str = None, dark: str = None, step: int = 4) -> float:
+    """ Return the median of the central half of the frame `path` after subtracting
+    the bias and dark; only every `step`-th row and column is read.
+    """
+    rows, columns = shape(path)
+    center = slice(rows//4, 3*rows//4, step), slice(columns//4, 3*columns//4, step)
+
+    def sample(frame: str) -> np.ndarray:
+        with fits.open(frame, memmap=True, do_not_scale_image_data=True) as hdus:
+            header = hdus[0].header
+            data = np.array(hdus[0].data[center], dtype=np.float32)
+        return data*np.float32(header.get('BSCALE', 1)) + np.float32(header.get('BZERO', 0))
+
+    data = sample(path)
+    if bias:
+        data -= sample(bias)
+    if dark:
+        data -= exposure_time(fits.getheader(path))*sample(dark)
+
+    return float(np.median(data))
+
+
+def calibrate_frame(path: str, output: str, bias: Optional[str], dark: Optional[str],
+                    flat: Optional[str], memory: int = MEMORY) -> str:
+    """ Calibrate the science frame `path` with the master frames (or None),
+    band by band, and stream it to `output`. This runs in a worker process.
+    """
+    rows, columns = shape(path)
+    header = fits.getheader(path)
+    exptime = exposure_time(header)
+    masters = ', '.join(os.path.basename(master) for master in [bias, dark, flat] if master)
+
+    temporary = output + '.part'
+    stream = fits.StreamingHDU(temporary, output_header(header, f'Calibrated with {masters or "nothing"}'))
+    try:
+        for start, stop in bands(rows, columns, 4, memory):
+            data = read_rows(path, start, stop)
+            if bias:
+                data -= read_rows(bias, start, stop)
+            if dark:
+                data -= exptime*read_rows(dark, start, stop)
+            if flat:
+                response = read_rows(flat, start, stop)
+                data /= np.where(response > 0, response, np.nan)
+            stream.write(data)
+    finally:
+        stream.close()
+    os.replace(temporary, output)
+
+    return output
+
+
+def frames(directory: str) -> List[str]:
+    """ Return the FITS frames in `directory`, in order.
+    """
+    return sorted(glob.glob(os.path.join(directory, '*.fits')) + glob.glob(os.path.join(directory, '*.fit')))
+
+
+def reduce(directory: str, flats: List[str] = None, workers: int = None, log=None) -> List[str]:
+    """ Reduce the observation in `directory`.
+
+    The master bias is combined from raw/bias, the master dark (per second, after
+    subtracting the bias) from raw/dark, and a master flat (normalized to a median
+    of 1) from `flats` for every filter that they were taken in. The frames in
+    raw/science are then calibrated with the masters that match their filter and
+    size, and everything is written to processed/.
+
+    Parameters
+    ----------
+    directory: str
+        The directory of the observation, as created by schedule.execute
+    flats: List[str]
+        The sky flats to use; if there are none for a filter, those
+        science frames are not flat-fielded. These are not copied by the
+        ingest server; they are in the telescope user's home directory on
+        the control server (see flats.take_flats)
+    workers: int
+        The number of worker processes (default: the number of cores)
+    log: logging.Logger
+        Where to log progress; defaults to printing
+
+    Returns
+    -------
+    outputs: List[str]
+        The paths of the calibrated science frames
+    """
+    info = log.info if log else print
+    processed = os.path.join(directory, 'processed')
+    os.makedirs(processed, exist_ok=True)
+
+    science = frames(os.path.join(directory, 'raw', 'science'))
+    biases = frames(os.path.join(directory, 'raw', 'bias'))
+    darks = frames(os.path.join(directory, 'raw', 'dark'))
+    if not science:
+        info(f'There are no science frames in {directory}')
+        return []
+    if not flats:
+        info('No flats were given, so the science frames will not be flat-fielded; '
+             'flats are in the telescope user\'s home directory on the control server')
+
+    # the masters are made at the size of most of the science frames
+    shapes = [shape(path) for path in science]
+    size = max(set(shapes), key=shapes.count)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        start = time.time()
+
+        # calibration frames have to be the same size as the science frames
+        biases = [path for path in biases if shape(path) == size]
+        darks = [path for path in darks if shape(path) == size]
+
+        bias = dark = None
+        if biases:
+            bias = combine(pool, biases, os.path.join(processed, 'master_bias.fits'), history='Master bias')
+            info(f'Combined {len(biases)} biases in {time.time() - start:.1f}s')
+        if darks:
+            # the dark current is stored per second, so it can be scaled to any exposure
+            exptimes = [exposure_time(fits.getheader(path)) or 1. for path in darks]
+            dark = combine(pool, darks, os.path.join(processed, 'master_dark.fits'), bias=bias,
+                           scales=exptimes, history='Master dark (per second)')
+            info(f'Combined {len(darks)} darks in {time.time() - start:.1f}s')
+
+        # a master flat for each filter, normalized by the level of each flat
+        masters: Dict[str, str] = {}
+        by_filter: Dict[str, List[str]] = {}
+        for path in flats or []:
+            if shape(path) == size:
+                by_filter.setdefault(filter_name(fits.getheader(path)), []).append(path)
+        for filt, paths in by_filter.items():
+            scales = [level(path, bias, dark) for path in paths]
+            masters[filt] = combine(pool, paths, os.path.join(processed, f'master_flat_{filt}.fits'),
+                                    bias=bias, dark=dark, scales=scales, history=f'Master flat ({filt})')
+            info(f'Combined {len(paths)} {filt} flats in {time.time() - start:.1f}s')
+
+        # calibrate the science frames in parallel
+        start = time.time()
+        futures = []
+        for path, frame_shape in zip(science, shapes):
+
+            # a frame of another size (i.e. binning) can't be calibrated with the masters
+            if frame_shape != size:
+                info(f'{os.path.basename(path)} is {frame_shape[1]}x{frame_shape[0]}, not {size[1]}x{size[0]}; '
+                     f'it will not be calibrated')
+                futures.append(pool.submit(calibrate_frame, path, os.path.join(processed, os.path.basename(path)),
+                                           None, None, None))
+                continue
+
+            filt = filter_name(fits.getheader(path))
+            if filt not in masters:
+                info(f'There is no {filt} flat for {os.path.basename(path)}; it will not be flat-fielded')
+            futures.append(pool.submit(calibrate_frame, path, os.path.join(processed, os.path.basename(path)),
+                                       bias, dark, masters.get(filt)))
+        outputs = [future.result() for future in futures]
+        info(f'Calibrated {len(outputs)} science frames in {time.time() - start:.1f}s')
+
+    return outputs
+
+
+def synthetic(directory: str, count: int, size: Tuple[int, int], seed: int = 0) -> List[str]:
+    """ Write `count` synthetic frames of each kind (bias, dark, flat and science),
+    of `size` (rows, columns), as unsigned 16-bit images under `directory`.
+
+    Returns the paths of the flats.
+    """
+    rng = np.random.default_rng(seed)
+    rows, columns = size
+    pattern = rng.normal(0, 5, size).astype(np.float32)
+    hot = (rng.random(size) < 1e-3)*rng.uniform(1, 50, size).astype(np.float32)
+    response = (1 + 0.05*np.sin(np.arange(columns)/50.)[None, :]*np.cos(np.arange(rows)/70.)[:, None]).astype(np.float32)
+
+    def write(kind: str, i: int, data: np.ndarray, exptime: float, filt: str = 'clear') -> str:
+        path = os.path.join(directory, *(['flats'] if kind == 'flat' else ['raw', kind]), f'{kind}_{i:03d}.fits')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        hdu = fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16))
+        hdu.header['EXPTIME'] = exptime
+        hdu.header['FILTER'] = filt
+        hdu.writeto(path, overwrite=True)
+        return path
+
+    def noise(scale: float) -> np.ndarray:
+        return rng.normal(0, scale, size).astype(np.float32)
+
+    flats = []
+    for i in range(count):
+        write('bias', i, 1000 + pattern + noise(8), 0.)
+        write('dark', i, 1000 + pattern + 60*hot + noise(9), 60.)
+        flats.append(write('flat', i, 1000 + pattern + 20000*response*rng.uniform(0.9, 1.1) + noise(150), 2.))
+        write('science', i, 1000 + pattern + 60*hot + 300*response + noise(20), 60.)
+
+    return flats
+
+
+def benchmark(count: int = 20, size: Tuple[int, int] = (2048, 2048), workers: List[int] = None) -> Dict[int, float]:
+    """ Reduce a synthetic observation of `count` frames of each kind with each number
+    of worker processes in `workers`, and print (and return) the throughput in frames
+    per second.
+    """
+    workers = workers or sorted({1, 2, os.cpu_count() or 1})
+    directory = tempfile.mkdtemp(prefix='reduction-')
+    try:
+        flats = synthetic(directory, count, size)
+        throughput = {}
+        for n in workers:
+            shutil.rmtree(os.path.join(directory, 'processed'), ignore_errors=True)
+            start = time.time()
+            reduce(directory, flats, workers=n, log=None)
+            elapsed = time.time() - start
+            throughput[n] = 4*count/elapsed
+            print(f'{n} workers: {4*count} frames of {size[1]}x{size[0]} in {elapsed:.1f}s '
+                  f'({throughput[n]:.1f} frames/s)')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return throughput
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce an observation, or benchmark the reduction pipeline')
+    parser.add_argument('directory', nargs='?', help='The directory of the observation')
+    parser.add_argument('--flats', nargs='*', default=[],
+                        help='The sky flats to use; these are not ingested, so copy them from the '
+                             'home directory of the telescope user on the control server')
+    parser.add_argument('--workers', type=int, default=None, help='The number of worker processes')
+    parser.add_argument('--benchmark', action='store_true', help='Benchmark on synthetic frames')
+    parser.add_argument('--frames', type=int, default=20, help='The number of synthetic frames of each kind')
+    parser.add_argument('--size', type=int, default=2048, help='The size of the synthetic frames')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.frames, (args.size, args.size), [args.workers] if args.workers else None)
+    elif args.directory:
+        reduce(args.directory, args.flats, args.workers)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,250 @@
+""" This file provides a staged plate solver for pinpoint. Frames are copied from
+the telescope once and solved locally with astrometry.net's solve-field; a fast,
+narrow solve seeded by the last solution of the field is tried first, and wider
+searches are only run (in parallel) if it fails; the first wide search to succeed
+kills the others.
+"""
+import os
+import time
+import signal
+import shutil
+import sqlite3
+import tempfile
+import warnings
+import threading
+import subprocess
+import numpy as np
+import concurrent.futures
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from config import config
+from typing import Dict, List, Optional
+
+# where we persist the solutions of each field
+SOLUTION_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'solutions.sqlite')
+
+# fields are identified by their position rounded to this many degrees
+FIELD_GRID = 0.1
+
+# the number of solves kept for the median solve time
+HISTORY = 100
+
+
+def solve_field(filename: str, ra: float, dec: float, downsample: int, radius: float,
+                scale_low: float, scale_high: float, cpulimit: float,
+                verify: str = None, cancel: threading.Event = None) -> Optional[Dict]:
+    """ Run solve-field on a local FITS file and return the solution, or None
+    if it failed or was cancelled. This runs in a worker thread; solve-field runs
+    in its own process group, which is killed as soon as `cancel` is set.
+
+    Parameters
+    ----------
+    filename: str
+        The FITS file to solve
+    ra, dec: float
+        The estimated center of the field (in degrees)
+    downsample: int
+        The factor to downsample the image by before finding stars
+    radius: float
+        The radius (in degrees) around (ra, dec) to search
+    scale_low, scale_high: float
+        The range of pixel scales (in arcsec per pixel) to search
+    cpulimit: float
+        The maximum time (in seconds) to search for
+    verify: str
+        The header of a WCS to try first (i.e. from an earlier solution)
+    cancel: threading.Event
+        Set to stop this solve (i.e. because another one succeeded)
+
+    Returns
+    -------
+    solution: Dict
+        The center (ra, dec) and pixel scale of the solution, and its WCS header
+    """
+    with tempfile.TemporaryDirectory(prefix='solve-') as directory:
+        command = [solver_binary(), '--no-plots', '--overwrite', '--no-remove-lines', '--no-verify',
+                   '--dir', directory, '--out', 'field', '--new-fits', 'none', '--index-xyls', 'none',
+                   '--rdls', 'none', '--corr', 'none', '--match', 'none', '--temp-axy',
+                   '--downsample', str(int(downsample)), '--scale-units', 'arcsecperpix',
+                   '--scale-low', f'{scale_low:f}', '--scale-high', f'{scale_high:f}',
+                   '--ra', f'{ra:f}', '--dec', f'{dec:f}', '--radius', f'{radius:f}',
+                   '--cpulimit', str(int(np.ceil(cpulimit)))]
+
+        # try the WCS of an earlier solution of this field before searching
+        if verify:
+            with open(os.path.join(directory, 'verify.wcs'), 'wb') as f:
+                fits.PrimaryHDU(header=fits.Header.fromstring(verify)).writeto(f)
+            command.remove('--no-verify')
+            command += ['--verify', os.path.join(directory, 'verify.wcs')]
+
+        # solve-field starts several programs, so they are killed as a group
+        process = subprocess.Popen(command + [filename], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.time() + cpulimit + 30
+        while True:
+            try:
+                process.wait(timeout=0.1)
+                break
+            except subprocess.TimeoutExpired as _:
+                if (cancel is not None and cancel.is_set()) or time.time() > deadline:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError as _:
+                        pass
+                    process.wait()
+                    return None
+
+        # solve-field only writes a WCS if it succeeded
+        wcsfile = os.path.join(directory, 'field.wcs')
+        if not os.path.exists(wcsfile):
+            return None
+
+        header = fits.getheader(wcsfile)
+
+    # the center of the image, and its pixel scale
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wcs = WCS(header)
+    center = wcs.pixel_to_world((header.get('IMAGEW', 2*header['CRPIX1']) - 1)/2,
+                                (header.get('IMAGEH', 2*header['CRPIX2']) - 1)/2)
+    scale = float(np.mean(proj_plane_pixel_scales(wcs)))*3600
+
+    return {'ra': float(center.ra.degree), 'dec': float(center.dec.degree), 'scale': scale,
+            'header': header.tostring()}
+
+
+def solver_binary() -> str:
+    """ Return the path of the local solve-field binary, or None if there isn't one.
+    """
+    candidate = os.path.join(getattr(config.astrometry, 'bin_dir', '') or '', 'solve-field')
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+        return candidate
+
+    return shutil.which('solve-field')
+
+
+class Solver(object):
+    """ A plate solver with a cache of the solutions of each field.
+
+    Each solve is tried in stages. If we have solved the field before, the first
+    stage verifies the old WCS and searches a small radius around the old center,
+    at the old pixel scale, on a heavily downsampled image; otherwise it searches
+    a small radius around the requested position. Only if that fails are the wider
+    stages (the full configured radius, and then three times that) run, in parallel;
+    the first to succeed is used, and the others are killed so that they don't
+    hold up the next solve.
+    """
+
+    def __init__(self, filename: str = SOLUTION_FILE, workers: int = 2):
+        """ Open (and create if necessary) the solution cache at `filename`,
+        and start the `workers` threads that run (and wait for) solve-field.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS solutions (field TEXT PRIMARY KEY, '
+                        'ra REAL, dec REAL, scale REAL, header TEXT, updated REAL)')
+        self.db.commit()
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='solver')
+
+        # how long recent solves took (in seconds)
+        self.times: List[float] = []
+
+    @staticmethod
+    def field(ra: float, dec: float) -> str:
+        """ Return the key of the field around (ra, dec), in degrees.
+        """
+        return f'{round(ra/FIELD_GRID)*FIELD_GRID % 360:.1f} {round(dec/FIELD_GRID)*FIELD_GRID:+.1f}'
+
+    def lookup(self, ra: float, dec: float) -> Optional[Dict]:
+        """ Return the last solution of the field around (ra, dec), if there is one.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT ra, dec, scale, header FROM solutions WHERE field = ?',
+                                  (self.field(ra, dec),)).fetchone()
+
+        return None if row is None else dict(zip(['ra', 'dec', 'scale', 'header'], row))
+
+    def store(self, ra: float, dec: float, solution: Dict) -> None:
+        """ Remember the solution of the field around (ra, dec).
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.field(ra, dec), solution['ra'], solution['dec'], solution['scale'],
+                             solution['header'], time.time()))
+            self.db.commit()
+
+    def stages(self, ra: float, dec: float) -> List[Dict]:
+        """ Return the arguments of solve_field for each stage of solving
+        the field around (ra, dec), from the fastest to the slowest.
+        """
+        astrometry = config.astrometry
+        scale_low, scale_high = astrometry.scale_low, astrometry.scale_high
+        hint = self.lookup(ra, dec)
+
+        # the first stage is seeded by the last solution of this field
+        if hint and hint['scale']:
+            fast = {'ra': hint['ra'], 'dec': hint['dec'], 'verify': hint['header'],
+                    'scale_low': 0.95*hint['scale'], 'scale_high': 1.05*hint['scale']}
+        else:
+            fast = {'ra': ra, 'dec': dec, 'scale_low': scale_low, 'scale_high': scale_high}
+        fast.update({'downsample': max(4, astrometry.downsample), 'radius': astrometry.radius/4,
+                     'cpulimit': min(5, astrometry.cpu_limit)})
+
+        wide = {'ra': ra, 'dec': dec, 'scale_low': scale_low, 'scale_high': scale_high,
+                'downsample': astrometry.downsample, 'cpulimit': astrometry.cpu_limit}
+
+        return [fast, dict(wide, radius=astrometry.radius), dict(wide, radius=3*astrometry.radius)]
+
+    def solve(self, filename: str, ra: float, dec: float) -> Optional[Dict]:
+        """ Solve the local FITS file `filename`, which should be centered
+        near (ra, dec), in degrees.
+
+        Returns the center (ra, dec) and pixel scale of the solution,
+        and its WCS header, or None if it couldn't be solved.
+        """
+        start = time.time()
+        fast, *wide = self.stages(ra, dec)
+
+        solution = self.pool.submit(solve_field, filename, **fast).result()
+        if solution is None:
+            cancel = threading.Event()
+            futures = [self.pool.submit(solve_field, filename, cancel=cancel, **stage) for stage in wide]
+            for future in concurrent.futures.as_completed(futures):
+                solution = future.result()
+                if solution is not None:
+                    break
+
+            # kill the stages that are still searching, and wait for them to exit
+            cancel.set()
+            concurrent.futures.wait(futures)
+
+        self.times = (self.times + [time.time() - start])[-HISTORY:]
+
+        if solution is not None:
+            self.store(ra, dec, solution)
+
+        return solution
+
+    @property
+    def median_time(self) -> Optional[float]:
+        """ The median time (in seconds) of recent solves.
+        """
+        return float(np.median(self.times)) if self.times else None
+
+
+# the solver shared by everything in this process
+_solver: Solver = None
+_solver_lock = threading.Lock()
+
+
+def solver() -> Solver:
+    """ Return the solver for this process, starting it if necessary.
+    """
+    global _solver
+    with _solver_lock:
+        if _solver is None:
+            _solver = Solver()
+
+        return _solver
@@ -1,6 +1,8 @@
 from . import server
 from . import ssh_telescope
+from . import async_telescope
 
 SSHTelescope = ssh_telescope.SSHTelescope
 Telescope = SSHTelescope
+AsyncTelescope = async_telescope.AsyncTelescope
 TelescopeServer = server.TelescopeServer
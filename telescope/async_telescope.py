@@ -0,0 +1,97 @@
+""" This file implements an asyncio facade for SSHTelescope. Every public method
+of SSHTelescope is available as a coroutine that runs the (blocking) SSH work on
+a dedicated thread, so that an event loop using the telescope stays responsive.
+"""
+import asyncio
+import functools
+import concurrent.futures
+from telescope.ssh_telescope import SSHTelescope
+from telescope.exception import *
+
+
+class AsyncTelescope(object):
+    """ This class wraps an SSHTelescope so that its methods can be awaited.
+
+    All methods are run, in the order that they are called, on a single
+    worker thread, since the telescope can only do one thing at a time.
+    Cancelling an awaiting coroutine asks the telescope to stop; long
+    operations (wait, wait_until_good, take_exposure) stop at their next
+    check and raise CancelledException.
+    """
+
+    def __init__(self, telescope: SSHTelescope = None):
+        """ Create a new AsyncTelescope, connecting a new SSHTelescope
+        if one is not given.
+        """
+        self.telescope = telescope or SSHTelescope()
+
+        # the thread that all telescope methods are run on
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                              thread_name_prefix='telescope')
+
+        # the number of methods that are running or waiting to run
+        self.pending = 0
+
+    @property
+    def busy(self) -> bool:
+        """ Whether the telescope is running, or about to run, a method.
+        """
+        return self.pending > 0
+
+    async def run(self, name: str, *args, **kwargs):
+        """ Run the SSHTelescope method `name` on the telescope thread,
+        and return its result.
+
+        If this coroutine is cancelled, the telescope is asked to
+        stop whatever it is doing.
+        """
+        def call():
+            # any cancellation was meant for an earlier method
+            self.telescope.cancelled.clear()
+            return getattr(self.telescope, name)(*args, **kwargs)
+
+        self.pending += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, call)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        finally:
+            self.pending -= 1
+
+    def cancel(self) -> None:
+        """ Ask the telescope to stop the method that it is currently running.
+
+        This does not wait for the telescope thread, so it can be called from
+        the event loop at any time.
+        """
+        self.telescope.cancelled.set()
+
+    def close(self) -> None:
+        """ Stop any running method, shut down the telescope thread,
+        and disconnect the telescope.
+        """
+        self.cancel()
+        self.executor.shutdown(wait=False)
+        self.telescope.disconnect()
+
+
+def awaitable(name: str):
+    """ Return a coroutine method that runs the SSHTelescope method `name`.
+    """
+    method = getattr(SSHTelescope, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self.run(name, *args, **kwargs)
+
+    wrapper.__qualname__ = f'AsyncTelescope.{name}'
+    return wrapper
+
+
+# create an awaitable version of every public SSHTelescope method
+for name in dir(SSHTelescope):
+    if (not name.startswith('_') and callable(getattr(SSHTelescope, name))
+            and not hasattr(AsyncTelescope, name)):
+        setattr(AsyncTelescope, name, awaitable(name))
@@ -0,0 +1,353 @@
+""" This file implements a persistent SSH connection to the telescope control
+server. Commands are run in long-lived remote shells instead of a new exec
+channel per command, the connection is kept alive with transport-level
+keepalives, and dropped connections are re-established with exponential backoff.
+"""
+import re
+import time
+import uuid
+import select
+import logging
+import threading
+import paramiko
+from typing import Callable, Dict, List, Tuple
+from telescope.exception import *
+
+
+class SSHConnection(object):
+    """ This class manages a single SSH connection, and a small pool of
+    persistent remote shells on that connection, to the telescope control server.
+
+    Every command is written to a shell followed by a unique marker that
+    echoes the exit status of the command; the output of the command is
+    everything before the marker. Since the channels are reused, each command
+    costs a single round trip.
+
+    Each shell runs one command at a time, but a long command (i.e. an exposure)
+    only holds its own shell; other commands (i.e. telemetry and status queries)
+    run in the other shells, and only wait if all `shells` are busy.
+    """
+
+    def __init__(self, host: str, username: str, port: int = 22, keepalive: int = 30,
+                 retries: int = 6, backoff: float = 1., max_backoff: float = 60., shells: int = 3,
+                 log: logging.Logger = None, client_factory: Callable[[], paramiko.SSHClient] = None,
+                 **kwargs):
+        """ Create a new (unconnected) connection to `host`.
+
+        Parameters
+        ----------
+        host: str
+            The hostname of the telescope control server
+        username: str
+            The username to log in as
+        port: int
+            The SSH port of the server
+        keepalive: int
+            The interval (in seconds) between transport keepalive packets
+        retries: int
+            The number of attempts to reconnect before giving up
+        backoff: float
+            The initial delay (in seconds) between reconnection attempts
+        max_backoff: float
+            The maximum delay (in seconds) between reconnection attempts
+        shells: int
+            The maximum number of remote shells, and so of commands that can run at once
+        log: logging.Logger
+            The logger to use
+        client_factory: Callable[[], paramiko.SSHClient]
+            Returns a new, unconnected, SSH client (default: paramiko.SSHClient); i.e.
+            a client whose connect() uses a socket to an in-process paramiko server
+        kwargs:
+            Any further arguments are passed to paramiko.SSHClient.connect
+        """
+        self.host = host
+        self.username = username
+        self.port = port
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.shells = shells
+        self.client_factory = client_factory or paramiko.SSHClient
+        self.kwargs = kwargs
+        self.log = log or logging.getLogger('telescope')
+
+        # the SSH client
+        self.client: paramiko.SSHClient = None
+
+        # only one thread can (re)connect at a time
+        self.lock = threading.RLock()
+
+        # shells that are not running a command, and the number that are open; waiters
+        # are woken whenever a shell is released or closed
+        self.idle: List[paramiko.Channel] = []
+        self.count = 0
+        self.available = threading.Condition()
+
+        # latency statistics for each command
+        self.latency: Dict[str, Dict[str, float]] = {}
+
+    def connect(self) -> paramiko.SSHClient:
+        """ Create a SSH connection to the telescope control server.
+
+        Will raise ConnectionException if there is any error in connection to the telescope.
+        """
+        with self.lock:
+            return self._connect()
+
+    def _connect(self) -> paramiko.SSHClient:
+        """ Connect; the caller must hold `lock`.
+        """
+        self.close()
+
+        client = self.client_factory()
+
+        # load host keys for verified connection
+        client.load_system_host_keys()
+
+        # insert keys - this needs to be removed ASAP - should manually add server key
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        # connect!
+        try:
+            client.connect(self.host, port=self.port, username=self.username, **self.kwargs)
+            self.log.info('Successfully connected to the telescope control server')
+        except paramiko.AuthenticationException:  # unable to authenticate
+            self.log.critical('Unable to authenticate connection to telescope control server. '
+                              'Please check that your SSH key has been setup correctly.')
+            raise ConnectionException
+        except Exception as e:
+            self.log.critical(f'SSHTelescope has encountered an unknown error in '
+                              f'connecting to the control server. \n Error: "{e}"')
+            raise ConnectionException
+
+        # let the transport detect dead connections instead of probing with commands
+        client.get_transport().set_keepalive(self.keepalive)
+        self.client = client
+
+        return client
+
+    def is_active(self) -> bool:
+        """ Check whether the SSH transport is still active; this does not
+        require a round trip to the server.
+        """
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+    def ensure(self) -> paramiko.SSHClient:
+        """ Return an active SSH client, reconnecting with exponential
+        backoff if the connection has dropped.
+
+        Will raise ConnectionException if we are unable to reconnect.
+        """
+        with self.lock:
+            # another thread may have reconnected while we waited
+            if self.is_active():
+                return self.client
+
+            self.log.warning('Connection to the telescope control server has dropped. Reconnecting...')
+            delay = self.backoff
+            for attempt in range(self.retries):
+                try:
+                    return self._connect()
+                except ConnectionException:
+                    if attempt == self.retries - 1:
+                        raise
+                    self.log.warning(f'Unable to reconnect; trying again in {delay:.0f} seconds...')
+                    time.sleep(delay)
+                    delay = min(2*delay, self.max_backoff)
+
+    def acquire_shell(self) -> paramiko.Channel:
+        """ Return an idle remote shell, opening a new one if none are idle and
+        there are fewer than `shells`, and waiting for one otherwise.
+        """
+        while True:
+            with self.available:
+                while not self.idle and self.count >= self.shells:
+                    self.available.wait()
+
+                # reuse the most recently used shell, or open a new one
+                if self.idle:
+                    channel = self.idle.pop()
+                else:
+                    self.count += 1
+                    break
+
+            # the shell (or the connection) may have closed since it was used
+            if not (channel.closed or channel.exit_status_ready()) and self.is_active():
+                return channel
+            self.discard_shell(channel)
+
+        try:
+            channel = self.ensure().get_transport().open_session()
+            channel.exec_command('/bin/sh')
+            return channel
+        except Exception:
+            with self.available:
+                self.count -= 1
+                self.available.notify()
+            raise
+
+    def release_shell(self, channel: paramiko.Channel) -> None:
+        """ Return a shell to the pool once its command has completed.
+        """
+        with self.available:
+            self.idle.append(channel)
+            self.available.notify()
+
+    def discard_shell(self, channel: paramiko.Channel) -> None:
+        """ Close a shell that is in an unknown state, or no longer usable.
+        """
+        try:
+            channel.close()
+        except Exception as e:
+            pass
+
+        # a waiter can now open a new shell in its place
+        with self.available:
+            self.count -= 1
+            self.available.notify()
+
+    def run(self, command: str, timeout: float = None, name: str = None) -> Tuple[int, str]:
+        """ Run a command in the persistent remote shell.
+
+        Parameters
+        ----------
+        command: str
+            The command to be run
+        timeout: float
+            The maximum time (in seconds) to wait for the command to complete
+        name: str
+            The name to record the latency under (default: the first two words of the command)
+
+        Returns
+        -------
+        exit_code: int
+            The exit status of the command
+        output: str
+            The standard output of the command
+        """
+        start = time.time()
+        channel = self.acquire_shell()
+
+        # the command can't read from our shell's stdin; the marker is on its own line
+        marker = f'__atlas_{uuid.uuid4().hex}__'
+        pattern = re.compile(rb'\n' + marker.encode() + rb' (\d+)\n')
+        output, match = b'', None
+        try:
+            channel.sendall(f'{{ {command}\n}} < /dev/null\nprintf "\\n{marker} %d\\n" $?\n'.encode())
+
+            # read until we see the marker
+            while match is None:
+                remaining = None if timeout is None else timeout - (time.time() - start)
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'{command} did not complete within {timeout} seconds')
+
+                # wait until there is something to read
+                select.select([channel], [], [], remaining)
+                if channel.recv_stderr_ready():
+                    self.log.debug(f'stderr: {channel.recv_stderr(65536).decode(errors="replace").strip()}')
+                if channel.recv_ready():
+                    output += channel.recv(65536)
+                    match = pattern.search(output)
+                elif channel.exit_status_ready() or channel.closed:
+                    raise ConnectionException('Remote shell closed unexpectedly')
+        except BaseException:
+            # we don't know what state the shell is in, so start a new one
+            self.discard_shell(channel)
+            raise
+        self.release_shell(channel)
+
+        # record how long this took
+        self.record(name or ' '.join(command.split()[:2]), time.time() - start)
+
+        return int(match.group(1)), output[:match.start()].decode(errors='replace')
+
+    def batch(self, commands: List[str], timeout: float = None) -> List[Tuple[int, str]]:
+        """ Run several commands, one after the other, in a single round trip.
+
+        The output of each command is followed by a unique delimiter containing
+        its exit status, which is used to split the combined output.
+
+        Parameters
+        ----------
+        commands: List[str]
+            The commands to be run
+        timeout: float
+            The maximum time (in seconds) to wait for all the commands to complete
+
+        Returns
+        -------
+        results: List[Tuple[int, str]]
+            The exit status and standard output of each command
+        """
+        token = uuid.uuid4().hex
+        script = ''.join(f'{{ {command}\n}} < /dev/null\nprintf "\\n__batch_{token}_%d__\\n" $?\n'
+                         for command in commands)
+        exit_code, output = self.run(script, timeout, name=f'batch of {len(commands)}')
+
+        # this is [output, status, output, status, ..., trailing output]
+        parts = re.split(f'\n__batch_{token}_(\\d+)__\n', output)
+        if len(parts) != 2*len(commands) + 1:
+            raise UnknownErrorException(f'Unable to split the output of batch: {commands}')
+
+        return [(int(parts[2*i + 1]), parts[2*i]) for i in range(len(commands))]
+
+    def execute(self, command: str, timeout: float = None, wait: bool = True) -> Tuple[int, str]:
+        """ Run a command on a new exec channel; this is used for commands that
+        may not return (i.e. keepopen), so that they can't block the shell.
+
+        Parameters
+        ----------
+        command: str
+            The command to be run
+        timeout: float
+            The maximum time (in seconds) to wait for the command to complete
+        wait: bool
+            If False, start the command and return (None, '') immediately
+        """
+        start = time.time()
+        stdin, stdout, stderr = self.ensure().exec_command(command, timeout=timeout)
+        if not wait:
+            return None, ''
+
+        output = stdout.read().decode(errors='replace')
+        exit_code = stdout.channel.recv_exit_status()
+        self.record(' '.join(command.split()[:2]), time.time() - start)
+
+        return exit_code, output
+
+    def record(self, name: str, elapsed: float) -> None:
+        """ Record the latency of a command under `name`; commands are usually
+        grouped by their first two words (i.e. 'tx taux').
+        """
+        stats = self.latency.setdefault(name, {'count': 0, 'total': 0., 'max': 0., 'last': 0.})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['last'] = elapsed
+        self.log.debug(f'{name} took {1000*elapsed:.1f}ms')
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        """ Return the count, mean, max and last latency (in seconds) of each command.
+        """
+        return {name: {'count': stats['count'], 'mean': stats['total']/stats['count'],
+                       'max': stats['max'], 'last': stats['last']}
+                for name, stats in self.latency.items()}
+
+    def close_shells(self) -> None:
+        """ Close the idle remote shells; shells that are running a command
+        are closed when it completes (or when the connection is closed).
+        """
+        with self.available:
+            idle, self.idle = self.idle, []
+        for channel in idle:
+            self.discard_shell(channel)
+
+    def close(self) -> None:
+        """ Close the remote shells and the SSH connection.
+        """
+        self.close_shells()
+        if self.client is not None:
+            self.client.close()
+        self.client = None
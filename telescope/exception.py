@@ -11,3 +11,9 @@ class TelescopeInUseException(Exception): pass
 
 
 class UnknownErrorException(Exception): pass
+
+
+class DatabaseException(Exception): pass
+
+
+class CancelledException(Exception): pass
@@ -15,6 +15,8 @@ import paramiko
 import imqueue.database as database
 from config import config
 from telescope.ssh_telescope import SSHTelescope
+from telescope.async_telescope import AsyncTelescope
+from telescope.telemetry import Telemetry
 from telescope.exception import *
 
 
@@ -52,9 +54,10 @@ class TelescopeServer(object):
             self.db = None
             self.log.warning('AUTHENTICATION DISABLED!! INSECURE!!')
 
-        # telescope to execute commands
+        # telescope to execute commands; this runs every command on its own
+        # thread so that the event loop is never blocked by the telescope
         try:
-            self.telescope = SSHTelescope()
+            self.telescope = AsyncTelescope(SSHTelescope())
         except Exception as e:
             self.telescope = None
             self.log.critical(f'TelescopeServer unable to connect to telescope controller. Reason: {e}')
@@ -70,6 +73,15 @@ class TelescopeServer(object):
         # event loop to execute commands asynchronously
         self.loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
 
+        # the commands that are currently running for the client
+        self.tasks = set()
+
+        # the read-only telemetry channel; every status update of the telescope
+        # is forwarded to it from the telescope thread
+        self.telemetry = Telemetry(self.log)
+        self.telescope.telescope.listeners.append(
+            lambda values: self.loop.call_soon_threadsafe(self.telemetry.publish, values))
+
     def __del__(self):
         """ Disconnect the telescope upon garbage collection.
 
@@ -78,7 +90,7 @@ class TelescopeServer(object):
         in all programs using the server.
         """
         if self.telescope:
-            self.telescope.disconnect()
+            self.telescope.close()
 
     def start(self):
         """ Start the event loop listening for websocket
@@ -92,6 +104,9 @@ class TelescopeServer(object):
         # start the server running in aysncio/libuv
         self.log.info('Started websocket server...')
         self.loop.run_until_complete(start_server)
+
+        # and keep the telemetry up to date
+        self.loop.create_task(self.telemetry.poll(self.telescope))
         self.loop.run_forever()
 
     def command_authorized(self, user: dict, command: str):
@@ -146,7 +161,13 @@ class TelescopeServer(object):
         """ This is the handler for new websocket
         connections. This exists for the lifetime of
         the connection by a Telescope class.
+
+        Connections to /telemetry are read-only subscribers, and
+        are handled by the telemetry channel.
         """
+        if path.rstrip('/') == '/telemetry':
+            return await self.telemetry.subscribe(websocket)
+
         try:
             self.log.info('Connection request received. Awaiting authentication...')
 
@@ -248,10 +269,17 @@ class TelescopeServer(object):
                     self.log.warning(f'Received empty command message. Skipping...')
                     continue
 
+                # stop whatever the telescope is currently doing
+                if command == 'cancel':
+                    self.cancel_tasks()
+                    await self.send_message(websocket, success=True, command=command, result='CANCELLED')
+                    continue
+
                 # check if command is authorized
                 if not self.command_authorized(user, command):
                     self.log.warning(f'User attempted to execute {command} for which they are not authorized.')
                     await self.send_message(websocket, success=False, command=command, result='NOT AUTHORIZED')
+                    continue
 
                 # set last exec time
                 self.last_exec_time = datetime.datetime.now()
@@ -263,9 +291,11 @@ class TelescopeServer(object):
                 # see if method exists
                 if command in self.telescope_methods:
 
-                    # run command on the telescope
-                    result = self.run_command(command, **args)
-                    await self.send_message(websocket, success=True, command=command, result=result)
+                    # run command on the telescope in the background, so
+                    # that we keep receiving messages while it runs
+                    task = asyncio.ensure_future(self.execute(websocket, command, **args))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
 
                 # command does not exist
                 else:
@@ -278,7 +308,9 @@ class TelescopeServer(object):
         finally:
             self.log.info(f'Client disconnected')
 
-            # make sure we set the global state as disconnected
+            # stop anything the client was running, and make
+            # sure we set the global state as disconnected
+            self.cancel_tasks()
             self.disconnect_client()
 
     def connect_client(self, websocket: websockets.WebSocketServerProtocol):
@@ -297,11 +329,35 @@ class TelescopeServer(object):
         self.websocket = None
         self.last_exec_time = datetime.datetime.now()
 
-    def run_command(self, command: str, *_, **kwargs) -> str:
+    async def execute(self, websocket, command: str, **kwargs):
+        """ Run a command on the telescope and send the result to the client.
+        """
+        try:
+            result = await self.run_command(command, **kwargs)
+            reply = {'success': True, 'result': result}
+        except (asyncio.CancelledError, CancelledException) as _:
+            self.log.info(f'{command} was cancelled.')
+            reply = {'success': False, 'result': 'CANCELLED'}
+        except Exception as e:
+            self.log.error(f'Error while executing {command}: {e}')
+            reply = {'success': False, 'result': f'ERROR: {e}'}
+
+        # the client may have disconnected in the meantime
+        try:
+            await self.send_message(websocket, command=command, **reply)
+        except websockets.exceptions.ConnectionClosed as _:
+            pass
+
+    def cancel_tasks(self):
+        """ Cancel every command that is running for the client. """
+        for task in self.tasks:
+            task.cancel()
+
+    async def run_command(self, command: str, *_, **kwargs) -> str:
         """ Executes a telescope shell command either locally, or remotely via ssh.
         Returns the byte string representing the captured STDOUT
         """
-        result = getattr(SSHTelescope, command)(self.telescope, **kwargs)
+        result = await getattr(self.telescope, command)(**kwargs)
 
         return result
 
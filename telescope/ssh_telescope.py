@@ -6,6 +6,7 @@ import logging
 import colorlog
 import paramiko
 import datetime
+import threading
 import websocket as ws
 import routines.flats as flats
 import routines.lightcurve as lightcurve
@@ -13,12 +14,16 @@ import routines.focus as focus
 import paho.mqtt.client as mqtt
 import routines.lookup as lookup
 import config.telescope as telescope_cmds 
+import telescope.connection as connection
+import telescope.transfer as transfer
 # config.telescope "obviously" points to a python script containing the list of all telescope commands...
 import routines.pinpoint as pinpoint
 from config import config
 from imqueue import database
+from imqueue import buffer
 from telescope.exception import *
 import random
+from typing import List
 from slacker_log_handler import SlackerLogHandler
 
 class SSHTelescope(object):
@@ -33,6 +38,21 @@ class SSHTelescope(object):
     # logger for class
     log = None
 
+    # status fields whose changes are written to the database immediately
+    transitions = {'status', 'slit', 'lock'}
+
+    # the queries that can be run in a `batch`; this maps the name
+    # of each method to the command in config.telescope that it runs. The
+    # outside temperature is parsed from the output of `get_weather` with
+    # config.telescope.get_temperature_re (i.e. r'(?<=temp=)-?\d+\.?\d*')
+    queries = {'get_taux': 'get_weather',
+               'get_where': 'get_where',
+               'get_sun_alt': 'get_sun_alt',
+               'get_moon_alt': 'get_moon_alt',
+               'get_temperature': 'get_weather',
+               'dome_open': 'dome_open',
+               'current_filter': 'current_filter'}
+
     def __init__(self):
         """ Create a new SSHTelescope object by connecting to the telescope server
         via SSH and initializing the logging system.
@@ -42,8 +62,20 @@ class SSHTelescope(object):
         if not SSHTelescope.log:
             SSHTelescope.__init_log()
 
-        # SSH connection to telescope server
-        self.ssh: paramiko.SSHClient = None
+        # persistent SSH connection to telescope server
+        self.connection: connection.SSHConnection = None
+
+        # pooled SFTP channels for copying files over the connection
+        self.transfers: transfer.SFTPPool = None
+
+        # set by another thread to stop long operations (see `cancel`)
+        self.cancelled = threading.Event()
+
+        # functions that are called with every status update (see `update`)
+        self.listeners = []
+
+        # write-behind buffer for status updates
+        self.buffer: buffer.WriteBuffer = None
 
         # connect to telescope
         self.connect()
@@ -54,62 +86,108 @@ class SSHTelescope(object):
             # The ismaster command is cheap and does not require auth.
             db.client.admin.command('ismaster')
 
-            # we can connect to database, let us set the update function
-            self.update = lambda x: db.telescopes.update_one(
-                {'name': config.general.name}, {'$set': x})
+            # we can connect to database, let us set the store function; updates
+            # are merged and written in the background, except for state transitions
+            self.buffer = buffer.WriteBuffer(db.telescopes, log=self.log)
+            self.store = lambda x: self.buffer.set({'name': config.general.name}, x,
+                                                   flush=not self.transitions.isdisjoint(x))
 
         except Exception as e:
             self.log.warning(
                 'Unable to connect to database... Disabling updates...')
-            self.update = lambda x: True
+            self.store = lambda x: True
+
+        # the focus model needs the temperature; without it, it ignores temperature
+        if getattr(telescope_cmds, 'get_temperature_re', None) is None:
+            self.log.warning('config.telescope has no get_temperature_re... The focus model '
+                             'will not correct for temperature...')
+
+        # publish telescope events (i.e. each finished exposure) to the MQTT broker
+        try:
+            self.events = mqtt.Client()
+            self.events.connect(config.mqtt.host or 'localhost', config.mqtt.port or 1883, 60)
+            self.events.loop_start()
+        except Exception as e:
+            self.log.warning('Unable to connect to MQTT broker... Disabling events...')
+            self.events = None
+
+    def update(self, values: dict) -> bool:
+        """ Save a status update (a dictionary of, possibly dotted, field names
+        and values) to the database, and pass it to every listener.
+
+        This does not wait for the database; see `buffer.WriteBuffer`.
+        """
+        for listener in self.listeners:
+            try:
+                listener(values)
+            except Exception as e:
+                self.log.warning(f'Error in status listener: {e}')
+
+        return self.store(values)
 
     def connect(self) -> bool:
         """ Create a SSH connection to the telescope control server.
 
         Will raise ConnectionException if there is any error in connection to the telescope.
         """
-        self.ssh: paramiko.SSHClient = self.__connect()
+        self.connection = connection.SSHConnection(config.telescope.host, config.telescope.username,
+                                                   log=self.log)
+        self.connection.connect()
+        self.transfers = transfer.SFTPPool(self.connection, size=2)
 
         return True
 
-    @staticmethod
-    def __connect() -> paramiko.SSHClient:
-        """ Create a SSH connection to the telescope control server.
+    @property
+    def ssh(self) -> paramiko.SSHClient:
+        """ The underlying SSH client, or None if we are not connected.
+        """
+        return self.connection.client if self.connection else None
 
-        Will raise ConnectionException if there is any error in connection to the telescope.
+    def disconnect(self) -> bool:
+        """ Disconnect the Telescope from the TelescopeServer.
         """
-        ssh: paramiko.SSHClient = paramiko.SSHClient()
+        # write any buffered status updates
+        if self.buffer:
+            self.buffer.flush()
 
-        # load host keys for verified connection
-        ssh.load_system_host_keys()
+        if self.transfers:
+            self.transfers.close()
+        self.transfers = None
 
-        # insert keys - this needs to be removed ASAP - should manually add server key
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if self.connection:
+            self.connection.close()
+        self.connection = None
 
-        # connect!
-        try:
-            ssh.connect(config.telescope.host,
-                        username=config.telescope.username)
-            SSHTelescope.log.info(
-                'Successfully connected to the telescope control server')
-        except paramiko.AuthenticationException:  # unable to authenticate
-            SSHTelescope.log.critical(
-                'Unable to authenticate connection to telescope control server. Please check that your SSH key has been setup correctly.')
-            raise ConnectionException
-        except Exception as e:
-            SSHTelescope.log.critical(f'SSHTelescope has encountered an unknown error in '
-                                      f'connecting to the control server. \n Error: "{e}"')
-            raise ConnectionException
+        if getattr(self, 'events', None):
+            self.events.loop_stop()
+            self.events.disconnect()
+        self.events = None
 
-        return ssh
+        return True
 
-    def disconnect(self) -> bool:
-        """ Disconnect the Telescope from the TelescopeServer.
+    def publish(self, event: str, **values) -> None:
+        """ Publish a telescope event (see modules.status) on the telescope topic;
+        i.e. the ingest server copies each frame as soon as its 'exposure' event arrives.
+        """
+        if getattr(self, 'events', None):
+            message = dict(values, event=event, telescope=config.general.name)
+            self.events.publish('/'.join(['', config.mqtt.root, 'telescope']),
+                                json.dumps(message, separators=(',', ':')))
+
+    def cancel(self) -> None:
+        """ Ask the current long operation (wait, wait_until_good, take_exposure)
+        to stop; it will raise CancelledException at its next check. This
+        is safe to call from another thread.
         """
-        self.ssh.close()
-        self.ssh = None
+        self.cancelled.set()
 
-        return True
+    def check_cancelled(self) -> None:
+        """ Raise CancelledException if `cancel` has been called.
+        """
+        if self.cancelled.is_set():
+            self.cancelled.clear()
+            self.log.warning('Operation has been cancelled.')
+            raise CancelledException
 
     def is_alive(self) -> bool:
         """ Check whether connection to telescope server is alive/working, and whether
@@ -144,12 +222,14 @@ class SSHTelescope(object):
         # in any other scenario, return False
         return False
 
-    def dome_open(self) -> bool:
+    def dome_open(self, result: str = None) -> bool:
         """ Checks whether the telescope slit is open or closed.
 
-        Returns True if open, False if closed.
+        Returns True if open, False if closed. If `result` is given, it is
+        parsed instead of running the command (see `batch`).
         """
-        result = self.run_command(telescope_cmds.dome_open)
+        if result is None:
+            result = self.run_command(telescope_cmds.dome_open)
         slit = re.search(telescope_cmds.dome_open_re, result)
 
         # if open, return True
@@ -290,11 +370,14 @@ class SSHTelescope(object):
         # TODO: Parse output to extract username and lock status
         return True
 
-    def get_taux(self) -> (float, float, float):
+    def get_taux(self, result: str = None) -> (float, float, float):
         """ Get the current cloud coverage.
+
+        If `result` is given, it is parsed instead of running the command (see `batch`).
         """
         # run the command
-        result = self.run_command(telescope_cmds.get_weather)
+        if result is None:
+            result = self.run_command(telescope_cmds.get_weather)
 
         # run regex
         cloud = re.search(telescope_cmds.get_cloud_re, result)
@@ -326,6 +409,33 @@ class SSHTelescope(object):
 
         return (cloud, dew, rain)
 
+    def get_temperature(self, result: str = None) -> float:
+        """ Get the current outside temperature (in C) from the weather station,
+        or None if it can't be parsed.
+
+        If `result` is given, it is parsed instead of running the command (see `batch`).
+        Returns None if the telescope config has no `get_temperature_re`.
+        """
+        # not every telescope config knows how to find the temperature
+        pattern = getattr(telescope_cmds, 'get_temperature_re', None)
+        if pattern is None:
+            return None
+
+        # run the command
+        if result is None:
+            result = self.run_command(telescope_cmds.get_weather)
+
+        # run regex
+        temperature = re.search(pattern, result or '')
+
+        # extract group and return
+        if temperature:
+            self.update({'weather.temperature': temperature.group(0)})
+            return float(temperature.group(0))
+        else:
+            self.log.warning(f'Unable to parse get_temperature: \"{result}\"')
+            return None
+
     def get_cloud(self) -> float:
         """ Get the current cloud coverage.
         """
@@ -377,11 +487,14 @@ class SSHTelescope(object):
             self.log.warning(f'Unable to parse get_rain: \"{result}\"')
             return 1.0  # return the safest value
 
-    def get_where(self) -> str:
+    def get_where(self, result: str = None) -> str:
         """ Get the current telescope pointing location.
+
+        If `result` is given, it is parsed instead of running the command (see `batch`).
         """
         # run the command
-        result = self.run_command(telescope_cmds.get_where)
+        if result is None:
+            result = self.run_command(telescope_cmds.get_where)
 
         # run regex
         ra = re.search(telescope_cmds.where_ra_re, result)
@@ -396,11 +509,14 @@ class SSHTelescope(object):
             self.log.warning(f'Unable to parse get_where: \"{result}\"')
             return ''  # return the safest value
 
-    def get_sun_alt(self) -> float:
+    def get_sun_alt(self, result: str = None) -> float:
         """ Get the current altitude of the sun.
+
+        If `result` is given, it is parsed instead of running the command (see `batch`).
         """
         # run the command
-        result = self.run_command(telescope_cmds.get_sun_alt)
+        if result is None:
+            result = self.run_command(telescope_cmds.get_sun_alt)
 
         # run regex
         alt = re.search(telescope_cmds.get_sun_alt_re, result)
@@ -413,18 +529,21 @@ class SSHTelescope(object):
             self.log.warning(f'Unable to parse get_sun_alt: \"{result}\"')
             return 90.0  # return the safest altitude we can
 
-    def get_moon_alt(self) -> float:
+    def get_moon_alt(self, result: str = None) -> float:
         """ Get the current altitude of the moon.
+
+        If `result` is given, it is parsed instead of running the command (see `batch`).
         """
         # run the command
-        result = self.run_command(telescope_cmds.get_moon_alt)
+        if result is None:
+            result = self.run_command(telescope_cmds.get_moon_alt)
 
         # run regex
         alt = re.search(telescope_cmds.get_moon_alt_re, result)
 
         # extract group and return
         if alt:
-            self.update({'weather.sun': float(alt.group(0))})
+            self.update({'weather.moon': float(alt.group(0))})
             return float(alt.group(0))
         else:
             self.log.warning(f'Unable to parse get_moon_alt: \"{result}\"')
@@ -447,27 +566,36 @@ class SSHTelescope(object):
             self.log.warning(f'Unable to parse get_mean_image_count: \"{result}\"')
             return -1
 
-    # TODO - make one 'tx taux' call instead of 5
-    def get_weather(self) -> dict:
+    def get_weather(self, where: bool = False) -> dict:
         """ Extract all the values for the current weather
         and return it as a python dictionary.
+
+        This is a single round trip to the telescope server. If `where` is True,
+        the current pointing location is queried in the same round trip.
         """
-        (cloud, dew, rain) = self.get_taux()
+        queries = (['get_taux', 'get_temperature', 'get_sun_alt', 'get_moon_alt']
+                   + (['get_where'] if where else []))
+        (cloud, dew, rain), temperature, sun, moon, *location = self.batch(queries)
 
         weather = {'rain': rain,
                    'cloud': cloud,
                    'dew': dew,
-                   'sun': self.get_sun_alt(),
-                   'moon': self.get_moon_alt()}
+                   'temperature': temperature,
+                   'sun': sun,
+                   'moon': moon}
+        if where:
+            weather['where'] = location[0]
+
         return weather
 
-    def weather_ok(self, sun: float=None) -> bool:
+    def weather_ok(self, sun: float=None, weather: dict=None) -> bool:
         """ Checks whether the sun has set, there is no rain (rain=0) and that
         it is less than 30% cloudy. Returns true if the weather is OK to open up,
-        false otherwise.
+        false otherwise. If `weather` is given, it is used instead of querying
+        the current weather.
         """
         # get the current weather
-        weather = self.get_weather()
+        weather = weather or self.get_weather()
 
         # check sun is at proper altitude
         desired_sun_alt = sun or config.telescope.max_sun_alt
@@ -552,27 +680,6 @@ class SSHTelescope(object):
 
         return True
 
-    def goto_point_for_flats(self) -> bool:
-        """ Point the telescope east of zenith with a bit of wiggle.
-        """
-
-        # point scope east of zenith
-        ha = config.telescope.ha_for_flats  # eastward
-        dec = config.general.latitude  # zenith
-
-        # randomize
-        dHa = 0.5*random.random()
-        dDec = 0.5*random.random()
-        ha += dHa
-        dec += dDec
-
-        # print ('ha=%f, dec=%f'%(ha,dec))
-
-        self.run_command(telescope_cmds.goto_for_flats.format(
-            ha='%0.4f' % ha, dec='%0.4f' % dec))
-
-        return True
-
     def goto_point(self, ra: str, dec: str, rough=False) -> (bool, float, float):
         """ Point the telescope at a given RA/Dec.
 
@@ -771,10 +878,13 @@ class SSHTelescope(object):
         """
         return focus.focus(self)
 
-    def current_filter(self) -> str:
+    def current_filter(self, result: str = None) -> str:
         """ Return the string name of the current filter.
+
+        If `result` is given, it is used instead of running the command (see `batch`).
         """
-        result = self.run_command(telescope_cmds.current_filter)
+        if result is None:
+            result = self.run_command(telescope_cmds.current_filter)
         self.update({'filter': result})
 
         return result
@@ -831,14 +941,14 @@ class SSHTelescope(object):
             tick += 1
             status_tick += 1
 
-            # do status updates
+            # do status updates; the location and weather are one round trip
             if status_tick >= num_status_ticks:
-                self.get_where()
-                self.weather_ok()
+                self.weather_ok(weather=self.get_weather(where=True))
                 status_tick = 0
 
-            # sleep config.telescope.base_wait_time_s minutes
-            time.sleep(config.telescope.base_wait_time_s)
+            # sleep config.telescope.base_wait_time_s minutes, waking up if cancelled
+            self.cancelled.wait(config.telescope.base_wait_time_s)
+            self.check_cancelled()
 
         return
 
@@ -896,6 +1006,9 @@ class SSHTelescope(object):
         self.update({'status': 'exposing'})
         while i < count:
 
+            # stop between exposures if we have been cancelled
+            self.check_cancelled()
+
             # create filename
             if count == 1:  # don't add count if just one exposure
                 fname = filename + f'.fits'
@@ -903,14 +1016,16 @@ class SSHTelescope(object):
                 fname = filename + f'_{i}.fits'
 
             self.log.info(f'Taking exposure {i+1}/{count} with name: {fname}')
+            self.update({'exposure.filename': fname, 'exposure.frame': i+1, 'exposure.count': count,
+                         'exposure.time': exposure_time, 'exposure.start': time.time()})
 
-            # take exposure
-
-            self.run_command(telescope_cmds.take_exposure.format(time=exposure_time, binning=binning,
-                                                            filename=fname))
+            # take exposure, and check the slit in the same round trip
+            _, slit_open = self.batch([telescope_cmds.take_exposure.format(time=exposure_time, binning=binning,
+                                                                           filename=fname),
+                                       'dome_open'])
 
             # if the telescope has randomly closed, open up and repeat the exposure
-            if not self.dome_open():
+            if not slit_open:
                 self.log.warning(
                     'Slit closed during exposure - repeating previous exposure!')
                 self.wait_until_good()
@@ -919,6 +1034,7 @@ class SSHTelescope(object):
                 continue
             else:  # this was a successful exposure - take the next one
 
+                self.publish('exposure', filename=fname)
                 i += 1  # increment counter
 
         self.update({'status': 'open'})
@@ -938,6 +1054,7 @@ class SSHTelescope(object):
 
             self.run_command(telescope_cmds.take_dark.format(time=exposure_time, binning=binning,
                                                         filename=fname))
+            self.publish('exposure', filename=fname)
 
         self.update({'status': 'open'})
         return True
@@ -959,6 +1076,7 @@ class SSHTelescope(object):
 
             self.run_command(telescope_cmds.take_dark.format(time=0.1, binning=binning,
                                                         filename=fname))
+            self.publish('exposure', filename=fname)
             time.sleep(1)
 
         self.update({'status': 'open'})
@@ -968,13 +1086,9 @@ class SSHTelescope(object):
         """ Copy a file at `remotepath` on the telescope control server to `localpath`
         on localhost.
         """
-        # create sftp context
-        sftp = paramiko.SFTPClient.from_transport(self.ssh.get_transport())
-
         try:
-            # get file from remote and then close connection
-            sftp.get(remotepath, localpath)
-            sftp.close
+            # large files are read in parallel over the pooled SFTP channels
+            self.transfers.get(remotepath, localpath)
             self.log.info('File successfully copied.')
             return True
         except Exception as e:
@@ -985,19 +1099,69 @@ class SSHTelescope(object):
         """ Copy a file at `localpath` on localhost to `remotepath`
         on the telescope control server.
         """
-        # create sftp context
-        sftp = paramiko.SFTPClient.from_transport(self.ssh.get_transport())
-
         try:
-            # get file from remote and then close connection
-            sftp.put(localpath, remotepath)
-            sftp.close
+            self.transfers.put(localpath, remotepath)
             self.log.info('File successfully copied.')
             return True
         except Exception as e:
             self.log.info(f'Error occured while copying file: {e}')
             return False
 
+    def batch(self, commands: List[str]) -> List:
+        """ Run several commands on the telescope server in a single round trip.
+
+        Each entry is either the name of one of the query methods in `queries`
+        (i.e. 'get_sun_alt'), in which case its output is parsed by that method
+        using the regexes in config.telescope, or a raw command string, in which
+        case its output is returned as in `run_command`. Queries that run the
+        same command (i.e. 'get_taux' and 'get_temperature') only run it once.
+
+        Parameters
+        ----------
+        commands: List[str]
+            The query names or commands to be run, in order
+
+        Returns
+        -------
+        results: List
+            The parsed result of each query, or the output of each command
+        """
+        if self.connection is None:
+            self.log.warn(
+                'SSH is not connected. Please reconnect to the telescope server.')
+            return [None]*len(commands)
+
+        # the actual commands to run, and which of them each entry uses
+        commands = list(commands)
+        wanted = [getattr(telescope_cmds, self.queries[command]) if command in self.queries else command
+                  for command in commands]
+        lines = list(dict.fromkeys(wanted))
+
+        self.log.info(f'Executing: {" ; ".join(lines)}')
+        try:
+            results = self.connection.batch(lines)
+        except Exception as e:
+            self.log.critical(f'batch: {e}')
+            self.log.critical(f'Failed while executing {lines}')
+            raise UnknownErrorException
+
+        outputs = []
+        for line, (exit_code, result) in zip(lines, results):
+
+            # retry any failed commands on their own
+            if exit_code != 0:
+                self.log.warn(f'{line} returned {exit_code}. Retrying...')
+                outputs.append(self.run_command(line))
+            else:
+                result = ' '.join(result.splitlines(True)).strip()
+                self.log.info(f'Result: {result}')
+                outputs.append(result or None)
+
+        # and parse the results of any queries
+        outputs = dict(zip(lines, outputs))
+        return [getattr(self, command)(result=outputs[line]) if command in self.queries else outputs[line]
+                for command, line in zip(commands, wanted)]
+
     def run_command(self, command: str) -> str:
         """ Run a command on the telescope server.
 
@@ -1010,19 +1174,13 @@ class SSHTelescope(object):
             The command to be run
 
         """
-        if self.ssh == None:
+        if self.connection is None:
             self.log.warn(
                 'SSH is not connected. Please reconnect to the telescope server.')
             return None
 
-        # make sure the connection hasn't timed out due to sleep
-        # if it has, reconnect
-        try:
-            self.ssh.exec_command('echo its alive')
-        except Exception as e:
-            self.ssh = self.connect()
-
-        # try and execute command 5 times if it fails
+        # try and execute command 5 times if it fails; the connection
+        # reconnects by itself if it has timed out due to sleep
         numtries = 0
         exit_code = 1
         while numtries < 5 and exit_code != 0:
@@ -1031,17 +1189,15 @@ class SSHTelescope(object):
                 # deal with weird keepopen behavior
                 if re.search('keepopen*', command):
                     try:
-                        self.ssh.exec_command(command, timeout=10)
+                        self.connection.execute(command, timeout=10, wait=False)
                         return None
                     except Exception as e:
                         pass
                 else:
-                    stdin, stdout, stderr = self.ssh.exec_command(command)
                     numtries += 1
-                    result = stdout.readlines()
+                    exit_code, result = self.connection.run(command)
 
                     # check exit code
-                    exit_code = stdout.channel.recv_exit_status()
                     if exit_code != 0:
                         self.log.warn(f'Command returned {exit_code}. Retrying in 3 seconds...')
                         time.sleep(3)
@@ -1049,10 +1205,9 @@ class SSHTelescope(object):
 
                     if result:
                         # valid result received
-                        if len(result) > 0:
-                            result = ' '.join(result).strip()
-                            self.log.info(f'Result: {result}')
-                            return result
+                        result = ' '.join(result.splitlines(True)).strip()
+                        self.log.info(f'Result: {result}')
+                        return result
 
             except Exception as e:
                 self.log.critical(f'run_command: {e}')
@@ -0,0 +1,125 @@
+""" This file implements the read-only telemetry channel of the TelescopeServer.
+The state of the telescope (pointing, weather, dome, filter, and exposure progress)
+is collected once, from the status updates of the telescope and from periodic
+polls when it is idle, and is pushed to every subscribed websocket.
+"""
+import json
+import time
+import asyncio
+import logging
+import websockets
+from typing import Dict, Set
+
+
+class Telemetry(object):
+    """ This class stores the latest telemetry of the telescope and
+    broadcasts every change to any number of subscribers.
+
+    Subscribers receive a snapshot of the full state when they subscribe,
+    and then each update as a dictionary of (possibly dotted) field names
+    and values, i.e. {'weather.cloud': 0.1}. Messages from subscribers are
+    ignored; the telemetry channel can't control the telescope.
+    """
+
+    def __init__(self, log: logging.Logger = None, interval: float = 30, timeout: float = 5):
+        """ Create a new (empty) telemetry channel.
+
+        Parameters
+        ----------
+        log: logging.Logger
+            The logger to use
+        interval: float
+            The time (in seconds) between polls of the telescope when it is idle
+        timeout: float
+            The time (in seconds) to wait for a subscriber to receive a message
+            before disconnecting it
+        """
+        self.log = log or logging.getLogger('telescope_server')
+        self.interval = interval
+        self.timeout = timeout
+
+        # the current state of the telescope
+        self.state: Dict = {}
+
+        # the websockets that are subscribed
+        self.subscribers: Set[websockets.WebSocketServerProtocol] = set()
+
+    def publish(self, values: Dict) -> None:
+        """ Merge a status update into the state, and send it to every subscriber.
+
+        This must be called from the event loop thread.
+        """
+        for key, value in values.items():
+
+            # expand dotted keys into nested dictionaries
+            *parents, field = key.split('.')
+            state = self.state
+            for parent in parents:
+                if not isinstance(state.get(parent), dict):
+                    state[parent] = {}
+                state = state[parent]
+            state[field] = value
+
+        if self.subscribers:
+            asyncio.ensure_future(self.broadcast({'telemetry': values, 'time': time.time()}))
+
+    async def send(self, websocket, message: str) -> bool:
+        """ Send a message to a subscriber, returning False if it
+        has disconnected or is too slow to keep up.
+        """
+        try:
+            await asyncio.wait_for(websocket.send(message), self.timeout)
+            return True
+        except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed) as _:
+            return False
+
+    async def broadcast(self, message: Dict) -> None:
+        """ Send a message to every subscriber; the message is only serialized once.
+        """
+        message = json.dumps(message, default=str)
+        subscribers = list(self.subscribers)
+        results = await asyncio.gather(*[self.send(websocket, message) for websocket in subscribers])
+
+        # drop any subscribers that we couldn't reach
+        for websocket, sent in zip(subscribers, results):
+            if not sent:
+                self.subscribers.discard(websocket)
+
+    async def subscribe(self, websocket) -> None:
+        """ Handle a subscriber for the lifetime of its connection.
+        """
+        self.log.info(f'Telemetry subscriber connected; {len(self.subscribers)+1} subscribers.')
+        self.subscribers.add(websocket)
+        try:
+            # send the current state
+            await self.send(websocket, json.dumps({'snapshot': self.state, 'time': time.time()},
+                                                  default=str))
+
+            # the channel is read-only, so we just wait for the client to leave
+            async for _ in websocket:
+                pass
+        except websockets.exceptions.ConnectionClosed as _:
+            pass
+        finally:
+            self.subscribers.discard(websocket)
+            self.log.info(f'Telemetry subscriber disconnected; {len(self.subscribers)} subscribers.')
+
+    async def poll(self, telescope) -> None:
+        """ Periodically query the telescope status while there are subscribers
+        and the telescope is idle. The results reach the subscribers through
+        the status updates of the telescope, so this returns nothing.
+
+        Parameters
+        ----------
+        telescope: AsyncTelescope
+            The telescope to poll
+        """
+        while True:
+            if self.subscribers and not telescope.busy:
+                try:
+                    await telescope.batch(['get_where', 'get_taux', 'get_temperature', 'get_sun_alt',
+                                           'get_moon_alt', 'dome_open', 'current_filter'])
+                except Exception as e:
+                    self.log.warning(f'Unable to poll telescope telemetry: {e}')
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,215 @@
+""" This file implements file transfers to and from the telescope control server
+over a pool of SFTP channels on a persistent SSH connection. Large files are
+read in chunks, in parallel over several channels, with the requests of each
+chunk pipelined; interrupted transfers can be resumed from the chunks that
+were already written.
+"""
+import os
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
+import paramiko
+from typing import Callable, Iterable, List, Set
+from telescope import connection
+
+# the size (in bytes) of each chunk that is read in parallel
+CHUNK = 1024*1024
+
+
+class SFTPPool(object):
+    """ A pool of SFTP channels on a single SSH connection.
+
+    Channels are opened on demand, up to `size`, and reused; a channel that
+    fails during a transfer is closed rather than returned to the pool, and
+    is replaced (on a reconnected transport, if necessary) the next time
+    one is needed.
+    """
+
+    def __init__(self, connection: connection.SSHConnection, size: int = 4):
+        """ Create a pool of up to `size` SFTP channels on `connection`.
+        """
+        self.connection = connection
+        self.size = size
+
+        # channels that are not in use, and the number that are open; waiters
+        # are woken whenever a channel is released or discarded
+        self.idle: List[paramiko.SFTPClient] = []
+        self.count = 0
+        self.available = threading.Condition()
+
+        # reads the chunks of large files in parallel
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=size,
+                                                              thread_name_prefix='sftp')
+
+    def acquire(self) -> paramiko.SFTPClient:
+        """ Return an open SFTP channel, opening a new one if none are idle and
+        the pool is not full, and waiting for one otherwise.
+        """
+        while True:
+            with self.available:
+                while not self.idle and self.count >= self.size:
+                    self.available.wait()
+
+                # reuse the most recently used channel, or open a new one
+                if self.idle:
+                    sftp = self.idle.pop()
+                else:
+                    self.count += 1
+                    break
+
+            # the connection may have dropped since the channel was used
+            if not sftp.get_channel().closed and self.connection.is_active():
+                return sftp
+            self.discard(sftp)
+
+        try:
+            transport = self.connection.ensure().get_transport()
+            return paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            with self.available:
+                self.count -= 1
+                self.available.notify()
+            raise
+
+    def release(self, sftp: paramiko.SFTPClient) -> None:
+        """ Return a channel to the pool.
+        """
+        with self.available:
+            self.idle.append(sftp)
+            self.available.notify()
+
+    def discard(self, sftp: paramiko.SFTPClient) -> None:
+        """ Close a channel that is no longer usable.
+        """
+        try:
+            sftp.close()
+        except Exception as _:
+            pass
+
+        # a waiter can now open a new channel in its place
+        with self.available:
+            self.count -= 1
+            self.available.notify()
+
+    @contextlib.contextmanager
+    def channel(self) -> paramiko.SFTPClient:
+        """ A context manager that borrows a channel from the pool; the channel is
+        discarded if the body raises.
+        """
+        sftp = self.acquire()
+        try:
+            yield sftp
+        except BaseException:
+            self.discard(sftp)
+            raise
+        self.release(sftp)
+
+    def stat(self, remotepath: str) -> paramiko.SFTPAttributes:
+        """ Return the attributes of the file at `remotepath`.
+        """
+        with self.channel() as sftp:
+            return sftp.stat(remotepath)
+
+    def read_chunk(self, remotepath: str, fd: int, offset: int, length: int) -> int:
+        """ Read `length` bytes at `offset` of `remotepath` into the local file
+        descriptor `fd`. The reads are pipelined (see paramiko's readv).
+        """
+        with self.channel() as sftp:
+            with sftp.open(remotepath, 'rb') as remote:
+                position = offset
+                for data in remote.readv([(offset, length)]):
+                    os.pwrite(fd, data, position)
+                    position += len(data)
+
+        if position != offset + length:
+            raise IOError(f'Short read of {remotepath} at {offset}')
+
+        return offset
+
+    def get(self, remotepath: str, localpath: str, size: int = None, done: Iterable[int] = (),
+            progress: Callable[[int], None] = None) -> str:
+        """ Copy `remotepath` on the telescope control server to `localpath`.
+
+        The file is written to `localpath`.part, in chunks that are read in
+        parallel, and moved to `localpath` once it is complete.
+
+        Parameters
+        ----------
+        remotepath: str
+            The file to copy
+        localpath: str
+            Where to copy it to
+        size: int
+            The size of the file, if it is known
+        done: Iterable[int]
+            The offsets of chunks that are already in `localpath`.part (i.e. from an
+            interrupted transfer); these are not read again
+        progress: Callable[[int], None]
+            Called with the offset of each chunk once it has been written
+
+        Returns
+        -------
+        sha256: str
+            The SHA-256 of the copied file
+        """
+        if size is None:
+            size = self.stat(remotepath).st_size
+
+        os.makedirs(os.path.dirname(os.path.abspath(localpath)), exist_ok=True)
+        partial = localpath + '.part'
+
+        # we can only resume into the partial file if it is still there
+        done: Set[int] = set(done) if os.path.exists(partial) else set()
+        offsets = [offset for offset in range(0, size, CHUNK) if offset not in done]
+
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            futures = [self.executor.submit(self.read_chunk, remotepath, fd, offset,
+                                            min(CHUNK, size - offset))
+                       for offset in offsets]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    offset = future.result()
+                    if progress:
+                        progress(offset)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+                raise
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        checksum = sha256(partial)
+        os.replace(partial, localpath)
+
+        return checksum
+
+    def put(self, localpath: str, remotepath: str) -> paramiko.SFTPAttributes:
+        """ Copy `localpath` to `remotepath` on the telescope control server.
+        """
+        with self.channel() as sftp:
+            return sftp.put(localpath, remotepath)
+
+    def close(self) -> None:
+        """ Close every channel in the pool.
+        """
+        self.executor.shutdown(wait=False)
+        with self.available:
+            idle, self.idle = self.idle, []
+        for sftp in idle:
+            self.discard(sftp)
+
+
+def sha256(path: str, block: int = CHUNK) -> str:
+    """ Return the SHA-256 (in hex) of the local file `path`.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            digest.update(data)
+
+    return digest.hexdigest()